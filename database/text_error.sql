@@ -148,20 +148,72 @@ create table django_session
 create index django_session_expire_date_a5c62663
     on django_session (expire_date);
 
+create table correction_job
+(
+    id          int auto_increment
+        primary key,
+    document_id int          not null,
+    owner       varchar(100) not null,
+    priority    int          not null,
+    status      varchar(100) not null,
+    attempts    int          not null,
+    worker      varchar(100) not null,
+    lease_until datetime(6)  null,
+    position    int          not null,
+    partial     longtext     not null,
+    partial_ops longtext     not null,
+    error       longtext     not null,
+    reused      int          not null,
+    recomputed  int          not null,
+    create_time datetime(6)  not null,
+    modify_time datetime(6)  not null
+)
+    charset = utf8mb3
+    row_format = DYNAMIC;
+
+create index correction_job_document_id
+    on correction_job (document_id);
+
+create index correction_job_status_priority
+    on correction_job (status, priority);
+
+create index correction_job_owner_status
+    on correction_job (owner, status);
+
 create table document
 (
     id          int auto_increment
         primary key,
     name        varchar(100) not null,
-    src         varchar(500) not null,
-    dest        varchar(500) not null,
+    src         longtext     not null,
+    dest        longtext     not null,
     owner       varchar(100) not null,
     status      varchar(100) not null,
+    ops         longtext     not null,
     create_time datetime(6)  not null
 )
     charset = utf8mb3
     row_format = DYNAMIC;
 
+create table document_paragraph
+(
+    id          int auto_increment
+        primary key,
+    document_id int          not null,
+    owner       varchar(100) not null,
+    number      int          not null,
+    hash        varchar(64)  not null,
+    dest        longtext     not null,
+    create_time datetime(6)  not null,
+    constraint document_paragraph_document_id_number
+        unique (document_id, number)
+)
+    charset = utf8mb3
+    row_format = DYNAMIC;
+
+create index document_paragraph_owner_hash
+    on document_paragraph (owner, hash);
+
 create table resources
 (
     id             int auto_increment
@@ -186,6 +238,7 @@ create table text
     dest        varchar(500) not null,
     owner       varchar(100) not null,
     status      varchar(100) not null,
+    ops         longtext     not null,
     create_time datetime(6)  not null,
     modify_time datetime(6)  not null
 )
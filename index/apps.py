@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class IndexConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'index'
+
+    def ready(self):
+        # 进程启动时后台预热 RAG 向量库，避免第一个请求承担加载开销
+        if getattr(settings, 'RAG_WARM_ON_STARTUP', False):
+            from llm.RAG.registry import get_registry
+            get_registry().warm_up()
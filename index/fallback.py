@@ -0,0 +1,56 @@
+from django.http import JsonResponse
+
+from llm.config import get_setting
+from llm.limiter import LLMUnavailable
+
+
+def fallback_enabled():
+    """
+    :return: 模型服务熔断或繁忙时是否降级为原文（状态为未检测），否则快速失败
+    """
+    return get_setting('LLM_FALLBACK_ON_UNAVAILABLE', True)
+
+
+def correction_status(text, result):
+    """
+    :return: 纠错记录的状态：无错误或有错误
+    """
+    return '无错误' if text == result else '有错误'
+
+
+def correct_or_fallback(text, compute):
+    """
+    执行纠错并确定状态。模型服务熔断或繁忙时按 LLM_FALLBACK_ON_UNAVAILABLE 配置降级为原文、状态为未检测，
+    不降级时继续抛出 LLMUnavailable，由调用方用 unavailable_response 返回 503。
+    :param text: 原文
+    :param compute: 返回纠错结果的函数
+    :return: (纠错结果, 状态)
+    """
+    try:
+        result = compute()
+    except LLMUnavailable:
+        if not fallback_enabled():
+            raise
+        return text, '未检测'
+    return result, correction_status(text, result)
+
+
+async def correct_or_fallback_async(text, compute):
+    """
+    correct_or_fallback 的异步版本
+    :param compute: 返回协程的函数
+    """
+    try:
+        result = await compute()
+    except LLMUnavailable:
+        if not fallback_enabled():
+            raise
+        return text, '未检测'
+    return result, correction_status(text, result)
+
+
+def unavailable_response(error):
+    """
+    模型服务熔断或繁忙且不降级时的响应
+    """
+    return JsonResponse({'error': 1, 'message': str(error)}, status=503)
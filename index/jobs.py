@@ -0,0 +1,442 @@
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+from collections import Counter
+
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from llm.TextHighlighter import ParagraphHighlighter, render_ops
+from llm.client import backoff_delay, get_async_client
+from llm.config import get_setting
+from llm.correction import DocumentCorrector
+from llm.diff import encode_ops
+from llm.limiter import LLMUnavailable
+from llm.qwen import PROMPT_VERSION
+from .fallback import correction_status, fallback_enabled
+from .models import CorrectionJob, Document, DocumentParagraph
+
+logger = logging.getLogger(__name__)
+
+# 任务状态，排队中和纠错中同时也写入文档记录的状态
+QUEUED = '排队中'
+RUNNING = '纠错中'
+DONE = '完成'
+FAILED = '失败'
+# 文档记录处于这些状态时还没有纠错结果
+UNFINISHED_STATUSES = (QUEUED, RUNNING, FAILED)
+
+
+def paragraph_hash(paragraph, model=None):
+    """
+    :param paragraph: 段落原文
+    :param model: 模型名称，默认读取 LLM_MODEL 配置
+    :return: 段落内容哈希，模型名称和 prompt 版本参与计算
+    """
+    model = model or get_setting('LLM_MODEL', "gpt-3.5-turbo")
+    raw = json.dumps([paragraph, model, PROMPT_VERSION], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def lookup_paragraphs(owner, hashes, batch_size=500):
+    """
+    :param owner: 用户名，只复用该用户自己文档中的段落
+    :param hashes: 段落哈希
+    :return: {哈希: 纠错后段落}，同一哈希有多条记录时取最新的一条
+    """
+    hashes = list(set(hashes))
+    stored = {}
+    for start in range(0, len(hashes), batch_size):
+        rows = DocumentParagraph.objects.filter(owner=owner, hash__in=hashes[start:start + batch_size]) \
+            .order_by('id').values_list('hash', 'dest')
+        stored.update(rows)
+    return stored
+
+
+def submit_document(name, text, owner, priority=0):
+    """
+    保存文档记录并提交纠错任务，立即返回，由工作进程在后台纠错。
+    该用户之前上传的文档中纠错过的相同段落直接复制到新文档，工作进程只纠错新增或修改的段落。
+    :param name: 文档名称
+    :param text: 文档文本
+    :param owner: 用户名
+    :param priority: 优先级，数值越大越先处理
+    :return: (Document, CorrectionJob)
+    """
+    document = Document.objects.create(name=name,
+                                       src=text,
+                                       dest='',
+                                       status=QUEUED,
+                                       owner=owner,
+                                       )
+    # 空白段落不需要纠错，不计入复用和重新纠错的段落数
+    paragraphs = [(number, paragraph_hash(paragraph))
+                  for number, paragraph in enumerate(text.split('\n')) if paragraph.strip()]
+    stored = lookup_paragraphs(owner, [digest for number, digest in paragraphs])
+    DocumentParagraph.objects.bulk_create([
+        DocumentParagraph(document_id=document.id, owner=owner, number=number, hash=digest, dest=stored[digest])
+        for number, digest in paragraphs if digest in stored
+    ], batch_size=500)
+    reused = sum(1 for number, digest in paragraphs if digest in stored)
+    job = CorrectionJob.objects.create(document_id=document.id, owner=owner, priority=priority,
+                                       reused=reused, recomputed=len(paragraphs) - reused)
+    return document, job
+
+
+def next_segment(text, position, size):
+    """
+    :return: 从 position 开始、约 size 个字的一段的结束位置，尽量在段落末尾切分
+    """
+    end = position + size
+    if end >= len(text):
+        return len(text)
+    newline = text.rfind('\n', position, end)
+    if newline == -1:
+        # 单个段落超过 size 时整段处理，由 DocumentCorrector 继续拆块
+        newline = text.find('\n', end)
+        if newline == -1:
+            return len(text)
+    return newline + 1
+
+
+def claim_job(worker, lease=None, user_concurrency=None):
+    """
+    领取一个任务：排队中（且不在重试等待中）或租约已过期（工作进程崩溃）的任务中，优先级最高、最早提交的一个。
+    正在处理的任务数达到上限的用户的任务暂不领取。领取某个用户的任务时先锁住该用户的所有任务行并重新统计，
+    多个工作进程同时领取同一用户的任务时依次进行，不会超过上限，也不会重复领取同一个任务。
+    :param worker: 工作进程名称
+    :param lease: 租约时长（秒），默认读取 LLM_JOB_LEASE 配置
+    :param user_concurrency: 每个用户同时处理的最大任务数，默认读取 LLM_JOB_USER_CONCURRENCY 配置
+    :return: 领取到的 CorrectionJob，没有可领取的任务时返回 None
+    """
+    lease = lease or get_setting('LLM_JOB_LEASE', 300)
+    user_concurrency = user_concurrency or get_setting('LLM_JOB_USER_CONCURRENCY', 1)
+    now = timezone.now()
+    # 预先排除已达上限的用户，领取时还会在锁内重新检查
+    running = Counter(CorrectionJob.objects.filter(status=RUNNING, lease_until__gt=now)
+                      .values_list('owner', flat=True))
+    busy = [owner for owner, count in running.items() if count >= user_concurrency]
+    ready = Q(status=QUEUED) & (Q(lease_until__isnull=True) | Q(lease_until__lte=now))
+    expired = Q(status=RUNNING, lease_until__lte=now)
+    candidates = CorrectionJob.objects.filter(ready | expired).exclude(owner__in=busy) \
+        .order_by('-priority', 'id')[:20]
+    for job in candidates:
+        with transaction.atomic():
+            # 加锁读取该用户所有任务的最新状态（SQLite 不支持行锁，写操作本身是串行的）
+            rows = {pk: (status, lease_until) for pk, status, lease_until in CorrectionJob.objects.select_for_update()
+                    .filter(owner=job.owner).values_list('id', 'status', 'lease_until')}
+            if sum(1 for status, lease_until in rows.values()
+                   if status == RUNNING and lease_until is not None and lease_until > now) >= user_concurrency:
+                continue
+            # 任务已被其他工作进程领取或状态已变化
+            if rows.get(job.id) != (job.status, job.lease_until):
+                continue
+            CorrectionJob.objects.filter(id=job.id).update(status=RUNNING, worker=worker, attempts=F('attempts') + 1,
+                                                           lease_until=now + datetime.timedelta(seconds=lease))
+        if job.status == RUNNING:
+            logger.warning('任务 %d 的租约已过期（工作进程 %s），从第 %d 字继续', job.id, job.worker, job.position)
+        job.refresh_from_db()
+        Document.objects.filter(id=job.document_id).update(status=RUNNING)
+        return job
+    return None
+
+
+def segment_ops(ops, source, result, i, j):
+    """
+    逐段比对一段原文和纠错结果，把编辑操作换算到全文坐标后追加到已有的编辑操作之后。
+    :param ops: 已纠错部分的编辑操作（encode_ops 的结果）
+    :param source: 该段原文
+    :param result: 该段纠错结果
+    :param i: 该段在原文中的起始位置
+    :param j: 该段纠错结果在已纠错部分中的起始位置
+    :return: 追加后的编辑操作
+    """
+    highlighter = ParagraphHighlighter(source, result)
+    # 编辑操作在逐段比对时收集
+    for fragment in highlighter.fragments():
+        pass
+    added = encode_ops([(tag, i1 + i, i2 + i, j1 + j, j2 + j) for tag, i1, i2, j1, j2 in highlighter.edits])
+    if not ops or ops == '[]':
+        return added
+    if added == '[]':
+        return ops
+    # 两个 JSON 数组直接拼接，不必解析已有的编辑操作
+    return ops[:-1] + ',' + added[1:]
+
+
+def queue_position(job):
+    """
+    :return: 排在该任务之前、等待处理的任务数
+    """
+    return CorrectionJob.objects.filter(status=QUEUED).filter(
+        Q(priority__gt=job.priority) | Q(priority=job.priority, id__lt=job.id)).count()
+
+
+def job_progress(job, document):
+    """
+    :return: 未完成任务的进度和已纠错部分的结果，供 get_result 接口返回
+    """
+    total = len(document.src)
+    data = {
+        'status': job.status,
+        'progress': job.position / total if total else 0.0,
+        'result': job.partial,
+        # 只标记已纠错的部分，按每段完成时保存的编辑操作渲染
+        'highlighted': render_ops(job.partial_ops, document.src[:job.position], job.partial) if job.partial else '',
+        'attempts': job.attempts,
+        'reused': job.reused,
+        'recomputed': job.recomputed,
+        'error': 0,
+    }
+    if job.status == QUEUED:
+        data['queue_position'] = queue_position(job)
+    elif job.status == FAILED:
+        data['error'] = 1
+        data['message'] = job.error
+    return data
+
+
+def queue_stats():
+    """
+    :return: 各状态的任务数
+    """
+    return dict(Counter(CorrectionJob.objects.values_list('status', flat=True)))
+
+
+class JobWorker:
+    """
+    文档纠错任务的工作线程：领取任务后按段落分段纠错，纠错期间定期续约，每段完成后保存进度。
+    工作进程崩溃时租约到期，任务由其他工作进程从已保存的位置继续；
+    失败的任务退避后重新排队，超过最大尝试次数后标记为失败（模型服务不可用时按配置降级为未检测）。
+    """
+
+    def __init__(self, name=None, lease=None, segment_chars=None, max_attempts=None, retry_delay=None,
+                 user_concurrency=None, corrector=None, stopping=None):
+        """
+        :param name: 工作线程名称，记录在领取的任务上，默认为 主机名:进程号:线程名
+        :param lease: 租约时长（秒），默认读取 LLM_JOB_LEASE 配置
+        :param segment_chars: 每段纠错的字数，默认读取 LLM_JOB_SEGMENT_CHARS 配置
+        :param max_attempts: 最大尝试次数，默认读取 LLM_JOB_MAX_ATTEMPTS 配置
+        :param retry_delay: 失败重试的基础间隔（秒），默认读取 LLM_JOB_RETRY_DELAY 配置
+        :param user_concurrency: 每个用户同时处理的最大任务数，默认读取 LLM_JOB_USER_CONCURRENCY 配置
+        :param corrector: DocumentCorrector 实例
+        :param stopping: threading.Event，设置后处理完当前一段即归还任务
+        """
+        self.name = name or '%s:%d:%s' % (socket.gethostname(), os.getpid(), threading.current_thread().name)
+        self.lease = lease or get_setting('LLM_JOB_LEASE', 300)
+        self.segment_chars = segment_chars or get_setting('LLM_JOB_SEGMENT_CHARS', 4000)
+        self.max_attempts = max_attempts or get_setting('LLM_JOB_MAX_ATTEMPTS', 3)
+        self.retry_delay = retry_delay or get_setting('LLM_JOB_RETRY_DELAY', 30.0)
+        self.user_concurrency = user_concurrency
+        self.corrector = corrector
+        self.stopping = stopping or threading.Event()
+        # 工作线程自己的事件循环，见 _run
+        self._loop = None
+
+    def _lease_until(self):
+        return timezone.now() + datetime.timedelta(seconds=self.lease)
+
+    def _update(self, job, **fields):
+        """
+        只有任务仍归本线程所有时才更新。
+        :return: 是否更新成功；租约过期后被其他工作进程接手或任务已删除时返回 False
+        """
+        return bool(CorrectionJob.objects.filter(id=job.id, worker=self.name, status=RUNNING).update(**fields))
+
+    @contextlib.contextmanager
+    def heartbeat(self, job):
+        """
+        纠错一段期间在后台线程中定期续约，模型响应慢或多次重试时租约不会在这一段完成之前过期。
+        """
+        stopped = threading.Event()
+
+        def run():
+            try:
+                while not stopped.wait(self.lease / 3):
+                    if not self._update(job, lease_until=self._lease_until()):
+                        # 任务已被接手或删除，这一段完成后保存进度时停止处理
+                        return
+            except Exception:
+                logger.exception('任务 %d 续约失败', job.id)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run, name='%s-heartbeat' % self.name, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def _run(self, coroutine):
+        """
+        在本工作线程的事件循环中运行协程。async_to_sync 每次调用都新建事件循环，而异步 HTTP 客户端的连接池
+        绑定在事件循环上，每段纠错都会新建连接池、无法复用连接，旧的连接池也不会关闭；
+        同一个工作线程始终使用同一个事件循环，连接保持复用。
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coroutine)
+
+    def close(self):
+        """
+        关闭本工作线程的事件循环及其连接池。
+        """
+        if self._loop is not None:
+            self._loop.run_until_complete(get_async_client().aclose())
+            self._loop.close()
+            self._loop = None
+
+    def run_once(self):
+        """
+        领取并处理一个任务。
+        :return: 是否领取到任务
+        """
+        job = claim_job(self.name, self.lease, self.user_concurrency)
+        if job is None:
+            return False
+        try:
+            self.process(job)
+        except Exception:
+            # 保存结果时出错（如数据库断开），租约到期后由其他工作进程接手
+            logger.exception('处理任务 %d 出错', job.id)
+        return True
+
+    def process(self, job):
+        document = Document.objects.filter(id=job.document_id).first()
+        if document is None:
+            # 文档已删除
+            CorrectionJob.objects.filter(id=job.id).delete()
+            return
+        if job.attempts > self.max_attempts:
+            self._fail(job, document, job.error or '超过最大尝试次数')
+            return
+
+        text = document.src
+        position, partial, ops = job.position, job.partial, self._partial_ops(job, text)
+        corrector = self.corrector or DocumentCorrector()
+        try:
+            while position < len(text):
+                if self.stopping.is_set():
+                    # 正常退出时立即归还任务，不计入尝试次数
+                    self._update(job, status=QUEUED, worker='', lease_until=None, attempts=F('attempts') - 1)
+                    Document.objects.filter(id=document.id).update(status=QUEUED)
+                    return
+                end = next_segment(text, position, self.segment_chars)
+                with self.heartbeat(job):
+                    result = self.correct_segment(corrector, document, text[position:end],
+                                                  text.count('\n', 0, position))
+                ops = segment_ops(ops, text[position:end], result, position, len(partial))
+                partial += result
+                position = end
+                if not self._update(job, position=position, partial=partial, partial_ops=ops,
+                                    lease_until=self._lease_until()):
+                    logger.warning('任务 %d 已被其他工作进程接手或删除，停止处理', job.id)
+                    return
+        except LLMUnavailable as e:
+            self._retry(job, document, e, unavailable=True)
+            return
+        except Exception as e:
+            self._retry(job, document, e)
+            return
+        self._finish(job, document, partial, ops)
+
+    def correct_segment(self, corrector, document, segment, first):
+        """
+        纠错一段：已保存纠错结果的段落（提交时复用的、或崩溃前已完成的）直接使用，
+        其余段落合并为一次 DocumentCorrector 调用，结果按段落保存。
+        :param segment: 段落对齐的一段原文
+        :param first: 该段第一个段落在文档中的序号
+        :return: 该段的纠错结果
+        """
+        # 段落对齐的一段以换行结尾，split 后最后的空元素不是本段的段落，只对换行之前的段落逐一对应
+        ends = segment.endswith('\n')
+        lines = (segment[:-1] if ends else segment).split('\n')
+        stored = dict(DocumentParagraph.objects.filter(document_id=document.id, number__gte=first,
+                                                       number__lt=first + len(lines)).values_list('number', 'dest'))
+        pending = [k for k, line in enumerate(lines) if line.strip() and first + k not in stored]
+        if pending:
+            results = self._run(corrector.correct('\n'.join(lines[k] for k in pending))).split('\n')
+            if len(results) != len(pending):
+                # 模型增删了换行，无法按段落对应，逐段重新纠错
+                results = [self._run(corrector.correct(lines[k])) for k in pending]
+            # 另一个工作进程接手同一任务时可能已经保存过
+            DocumentParagraph.objects.bulk_create([
+                DocumentParagraph(document_id=document.id, owner=document.owner, number=first + k,
+                                  hash=paragraph_hash(lines[k]), dest=result)
+                for k, result in zip(pending, results)
+            ], batch_size=500, ignore_conflicts=True)
+            stored.update((first + k, result) for k, result in zip(pending, results))
+        result = '\n'.join(stored.get(first + k, line) for k, line in enumerate(lines))
+        return result + '\n' if ends else result
+
+    @staticmethod
+    def _partial_ops(job, text):
+        """
+        :return: 已纠错部分的编辑操作；没有保存编辑操作的旧任务对已纠错部分比对一次
+        """
+        if job.partial and not job.partial_ops:
+            return segment_ops('', text[:job.position], job.partial, 0, 0)
+        return job.partial_ops
+
+    def _finish(self, job, document, result, ops, status=None):
+        """
+        :param ops: 全文的编辑操作，由各段完成时保存的编辑操作拼接而成
+        """
+        # 降级时状态已经是未检测
+        if status is None:
+            status = correction_status(document.src, result)
+        if not self._update(job, status=DONE, partial='', partial_ops='', position=len(document.src),
+                            lease_until=None):
+            return
+        Document.objects.filter(id=document.id).update(dest=result, status=status, ops=ops or '[]')
+        logger.info('任务 %d 完成，文档 %d，共 %d 字', job.id, document.id, len(document.src))
+
+    def _fail(self, job, document, message):
+        if self._update(job, status=FAILED, error=message, lease_until=None):
+            Document.objects.filter(id=document.id).update(status=FAILED)
+            logger.error('任务 %d 失败: %s', job.id, message)
+
+    def _retry(self, job, document, error, unavailable=False):
+        message = '%s: %s' % (type(error).__name__, error)
+        if job.attempts < self.max_attempts:
+            delay = backoff_delay(job.attempts - 1, self.retry_delay, self.retry_delay * 16)
+            logger.warning('任务 %d 第 %d 次尝试失败，%.0f 秒后重试: %s', job.id, job.attempts, delay, message)
+            if self._update(job, status=QUEUED, worker='', error=message,
+                            lease_until=timezone.now() + datetime.timedelta(seconds=delay)):
+                Document.objects.filter(id=document.id).update(status=QUEUED)
+            return
+        if unavailable and fallback_enabled():
+            # 模型服务持续不可用：已纠错的部分保留，其余部分原样保存，状态为未检测
+            job.refresh_from_db()
+            # 原样保存的部分没有编辑操作，已纠错部分的编辑操作即为全文的编辑操作
+            self._finish(job, document, job.partial + document.src[job.position:],
+                         self._partial_ops(job, document.src), status='未检测')
+            return
+        self._fail(job, document, message)
+
+    def run(self, poll_interval=None, once=False):
+        """
+        循环领取任务直到 stopping 被设置。
+        :param poll_interval: 没有任务时的轮询间隔（秒），默认读取 LLM_JOB_POLL_INTERVAL 配置
+        :param once: 为 True 时队列中没有可领取的任务即退出
+        """
+        poll_interval = poll_interval or get_setting('LLM_JOB_POLL_INTERVAL', 1.0)
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                if not self.run_once():
+                    if once:
+                        return
+                    self.stopping.wait(poll_interval)
+        finally:
+            self.close()
+            connection.close()
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from llm.TextHighlighter import TextHighlighter
+from index.jobs import UNFINISHED_STATUSES
+from index.models import Document, Text
+
+
+class Command(BaseCommand):
+    help = '为升级前保存、没有编辑操作的纠错记录补存编辑操作（列表页只读取，不再在查看时补存）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='每批读取的记录数')
+
+    def handle(self, *args, **options):
+        for model in (Text, Document):
+            pending = model.objects.filter(ops='').exclude(status='知识库').exclude(status__in=UNFINISHED_STATUSES)
+            count = 0
+            last_id = 0
+            while True:
+                # 按主键分批读取，已补存的记录不再满足条件，不用 offset
+                records = list(pending.filter(id__gt=last_id).order_by('id')[:options['batch_size']])
+                if not records:
+                    break
+                for record in records:
+                    model.objects.filter(id=record.id, ops='').update(ops=TextHighlighter(record.src, record.dest).ops())
+                last_id = records[-1].id
+                count += len(records)
+            self.stdout.write('%s：补存 %d 条记录的编辑操作' % (model._meta.db_table, count))
@@ -0,0 +1,88 @@
+import random
+import time
+from difflib import SequenceMatcher
+
+from django.core.management.base import BaseCommand
+
+from llm.TextHighlighter import TextHighlighter
+from llm.loadtest import SAMPLE_SENTENCES
+
+
+def legacy_highlight(original_text, corrected_text):
+    """
+    原来的实现：SequenceMatcher（默认 autojunk）比对，逐段 += 拼接 HTML。
+    """
+    matcher = SequenceMatcher(None, original_text, corrected_text)
+    highlighted_text = ""
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'replace' or tag == 'delete' or tag == 'insert':
+            highlighted_text += f'<span style="text-decoration: underline wavy red;">{corrected_text[j1:j2]}</span>'
+        else:
+            highlighted_text += corrected_text[j1:j2]
+    return highlighted_text
+
+
+def make_pair(size, rate, sentences, rng):
+    """
+    生成一对原文和更正文本：原文由句子随机拼接，更正文本按比例随机替换、删除、重复字符。
+    """
+    parts, length = [], 0
+    while length < size:
+        sentence = rng.choice(sentences)
+        parts.append(sentence)
+        length += len(sentence)
+    original = ''.join(parts)[:size]
+    alphabet = ''.join(sentences)
+    corrected = []
+    for char in original:
+        roll = rng.random()
+        if roll < rate / 3:
+            corrected.append(rng.choice(alphabet))
+        elif roll < rate * 2 / 3:
+            continue
+        elif roll < rate:
+            corrected.append(char * 2)
+        else:
+            corrected.append(char)
+    return original, ''.join(corrected)
+
+
+class Command(BaseCommand):
+    help = '比较 TextHighlighter 的 Myers 差分与原来的 SequenceMatcher 实现在不同长度文本上的耗时和标记字数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000', help='逗号分隔的文本长度（字符）')
+        parser.add_argument('--rate', type=float, default=0.01, help='更正文本中被修改的字符比例')
+        parser.add_argument('--corpus', help='生成文本使用的句子文件，每行一个句子，默认使用内置句子')
+        parser.add_argument('--repeat', type=int, default=3, help='每种实现重复运行的次数，取最短耗时')
+        parser.add_argument('--seed', type=int, default=0, help='随机种子')
+        parser.add_argument('--legacy-max-size', type=int, help='超过该长度时不运行原来的实现（长文本上可能耗时数分钟）')
+
+    def handle(self, *args, **options):
+        sentences = SAMPLE_SENTENCES
+        if options['corpus']:
+            with open(options['corpus'], encoding='utf-8') as f:
+                sentences = [line.strip() for line in f if line.strip()] or SAMPLE_SENTENCES
+        rng = random.Random(options['seed'])
+
+        def measure(func):
+            best, result = None, None
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                result = func()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            return best, result
+
+        self.stdout.write('%-8s %-12s %10s %10s' % ('size', 'impl', 'time', 'marked'))
+        for size in [int(value) for value in options['sizes'].split(',') if value]:
+            original, corrected = make_pair(size, options['rate'], sentences, rng)
+            highlighter = TextHighlighter(original, corrected)
+            results = []
+            if not options['legacy_max_size'] or size <= options['legacy_max_size']:
+                results.append(('difflib', measure(lambda: legacy_highlight(original, corrected))))
+            results.append(('myers', measure(highlighter.highlight_differences)))
+            for name, (elapsed, html) in results:
+                # 被标记的字数越少，比对越准确
+                marked = sum(len(part.split('</span>')[0]) for part in html.split('wavy red;">')[1:])
+                self.stdout.write('%-8d %-12s %9.3fs %10d' % (size, name, elapsed, marked))
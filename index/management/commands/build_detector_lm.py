@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from llm.RAG.ingest import expand_sources
+from llm.detector import CharNgramLM, read_corpus
+
+
+class Command(BaseCommand):
+    help = '用语料训练本地错误检测的字符 n-gram 语言模型'
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus', nargs='*', help='语料文件或目录（txt/pdf/docx），默认使用 RAG_PDF_PATH')
+        parser.add_argument('--order', type=int, default=3, help='n-gram 阶数')
+        parser.add_argument('--output', help='输出路径，默认使用 LLM_DETECTOR_LM_PATH')
+
+    def handle(self, *args, **options):
+        paths = []
+        for corpus in options['corpus'] or [settings.RAG_PDF_PATH]:
+            # 目录下只收集 pdf/docx，txt 语料需要直接指定文件
+            paths.extend(expand_sources(corpus))
+
+        def texts():
+            for path in paths:
+                self.stdout.write('读取 %s' % path)
+                yield from read_corpus(path)
+
+        lm = CharNgramLM(order=options['order']).train(texts())
+        output = options['output'] or settings.LLM_DETECTOR_LM_PATH
+        lm.save(output)
+        self.stdout.write('语言模型已保存到 %s：%d 字，%d 个不同的字' % (output, lm.total, len(lm.vocabulary())))
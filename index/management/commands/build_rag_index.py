@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from llm.RAG.RAGprompt import RAGPromptEnhancer
+from llm.RAG.registry import get_registry
+
+
+class Command(BaseCommand):
+    help = '构建（或加载已存在的）RAG 向量库，并输出导入进度和吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', help='知识源文件或目录，默认使用 RAG_PDF_PATH')
+        parser.add_argument('--workers', type=int, help='解析文档的进程数，默认使用 RAG_INGEST_WORKERS')
+        parser.add_argument('--batch-size', type=int, help='每个嵌入批次的块数量，默认使用 RAG_INGEST_BATCH_SIZE')
+
+    def handle(self, *args, **options):
+        registry = get_registry()
+        enhancer_options = dict(registry.enhancer_options)
+        if options['workers']:
+            enhancer_options['ingest_workers'] = options['workers']
+        if options['batch_size']:
+            enhancer_options['ingest_batch_size'] = options['batch_size']
+        enhancer_options['progress'] = self.report
+
+        enhancer = RAGPromptEnhancer(options['source'] or registry.pdf_path, registry.model_path,
+                                     index_dir=registry.index_dir, **enhancer_options)
+        self.stdout.write('向量库就绪：%s，共 %d 块' % (enhancer.index_path or '（未持久化）',
+                                                enhancer.index.ntotal))
+
+    def report(self, stats):
+        progress = stats.as_dict()
+        self.stdout.write('任务 %s  页/段落 %d  块 %d（已嵌入 %d）  %.1f 页/秒  %.1f 块/秒' % (
+            progress['tasks'], progress['pages'], progress['chunks'], progress['embedded'],
+            progress['pages_per_second'], progress['chunks_per_second']))
@@ -0,0 +1,40 @@
+import threading
+
+from django.core.management.base import BaseCommand
+
+from index.jobs import JobWorker
+from llm.config import get_setting
+
+
+class Command(BaseCommand):
+    help = '启动文档纠错任务的工作进程：从数据库队列中按优先级领取任务并在后台纠错，Ctrl+C 退出时归还处理中的任务'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='工作线程数，默认使用 LLM_JOB_WORKERS')
+        parser.add_argument('--once', action='store_true', help='队列中没有可领取的任务时退出')
+        parser.add_argument('--poll-interval', type=float, help='空闲时的轮询间隔（秒），默认使用 LLM_JOB_POLL_INTERVAL')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or get_setting('LLM_JOB_WORKERS', 2)
+        stopping = threading.Event()
+        threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self.work, args=(stopping, options), name='correction-worker-%d' % number)
+            thread.start()
+            threads.append(thread)
+        self.stdout.write('已启动 %d 个工作线程' % workers)
+        try:
+            for thread in threads:
+                # 带超时等待，主线程才能及时响应 Ctrl+C
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stdout.write('正在退出，处理完当前一段后归还任务……')
+            stopping.set()
+            for thread in threads:
+                thread.join()
+
+    @staticmethod
+    def work(stopping, options):
+        # 在工作线程中创建，名称中包含线程名
+        JobWorker(stopping=stopping).run(options['poll_interval'], once=options['once'])
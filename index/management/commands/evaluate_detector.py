@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from llm.detector import CharNgramLM, LocalDetector, load_confusions
+
+
+class Command(BaseCommand):
+    help = '在标注样本上评估本地错误检测：各阈值下节省的大模型调用比例和漏检率'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sample', help='标注样本，每行 “原句<TAB>正确句”，两者相同表示无错误')
+        parser.add_argument('--thresholds', default='0.5,0.8,0.9,0.95,0.99', help='逗号分隔的阈值')
+
+    def handle(self, *args, **options):
+        samples = []
+        with open(options['sample'], encoding='utf-8') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) >= 2:
+                    samples.append((parts[0], parts[1]))
+        if not samples:
+            raise CommandError('样本文件中没有 “原句<TAB>正确句” 格式的行')
+
+        try:
+            lm = CharNgramLM.load(settings.LLM_DETECTOR_LM_PATH)
+        except FileNotFoundError:
+            raise CommandError('语言模型 %s 不存在，请先运行 build_detector_lm' % settings.LLM_DETECTOR_LM_PATH)
+        detector = LocalDetector(lm, confusions=load_confusions(settings.LLM_DETECTOR_CONFUSION_PATH),
+                                 threshold=settings.LLM_DETECTOR_THRESHOLD)
+        thresholds = [float(value) for value in options['thresholds'].split(',')]
+
+        self.stdout.write('%-10s %8s %10s %10s %12s' % ('threshold', 'skipped', 'saved', 'missed', 'miss_rate'))
+        results = detector.evaluate(samples, thresholds)
+        for result in results:
+            self.stdout.write('%-10s %8d %9.1f%% %10d %11.1f%%' % (
+                result['threshold'], result['skipped'], result['saved_rate'] * 100,
+                result['false_negatives'], result['false_negative_rate'] * 100))
+        self.stdout.write('样本 %d 条，其中有错误 %d 条' % (len(samples), results[0]['with_errors']))
@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from llm.loadtest import LoadTester
+
+
+class Command(BaseCommand):
+    help = '按目标 RPS 压测纠错接口，输出 p50/p95/p99 延迟、吞吐量和错误分类'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Django 服务地址')
+        parser.add_argument('--endpoint', default='correct_text', choices=LoadTester.ENDPOINTS, help='压测的接口')
+        parser.add_argument('--rps', type=float, default=5.0, help='目标每秒请求数')
+        parser.add_argument('--duration', type=float, default=30.0, help='压测时长（秒）')
+        parser.add_argument('--sentences', type=int, default=3, help='每个请求的句子数')
+        parser.add_argument('--corpus', help='压测文本文件，每行一个句子，默认使用内置句子')
+        parser.add_argument('--max-in-flight', type=int, default=256, help='最大在途请求数，超过时丢弃')
+        parser.add_argument('--timeout', type=float, default=120.0, help='单个请求的超时（秒）')
+        parser.add_argument('--poisson', action='store_true', help='请求按泊松过程到达，默认等间隔')
+        parser.add_argument('--seed', type=int, help='随机种子')
+        parser.add_argument('--json', action='store_true', help='以 JSON 格式输出报告')
+
+    def handle(self, *args, **options):
+        sentences = None
+        if options['corpus']:
+            with open(options['corpus'], encoding='utf-8') as f:
+                sentences = [line.strip() for line in f if line.strip()]
+            if not sentences:
+                raise CommandError('压测文本文件 %s 为空' % options['corpus'])
+
+        tester = LoadTester(
+            options['url'],
+            endpoint=options['endpoint'],
+            rps=options['rps'],
+            duration=options['duration'],
+            sentences=sentences,
+            sentences_per_request=options['sentences'],
+            max_in_flight=options['max_in_flight'],
+            timeout=options['timeout'],
+            poisson=options['poisson'],
+            seed=options['seed'],
+        )
+        self.stdout.write('压测 %s/%s：%.1f RPS，持续 %.0f 秒' % (
+            options['url'].rstrip('/'), options['endpoint'], options['rps'], options['duration']))
+        report = asyncio.run(tester.run())
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+
+        def ms(value):
+            return '-' if value is None else '%.0fms' % (value * 1000)
+
+        self.stdout.write('请求 %d，完成 %d，耗时 %.1f 秒，吞吐量 %.2f 请求/秒，成功率 %.1f%%' % (
+            report['requests'], report['completed'], report['duration'], report['throughput'],
+            report['success_rate'] * 100))
+        latency = report['latency']
+        self.stdout.write('延迟 p50 %s  p95 %s  p99 %s  max %s' % (
+            ms(latency['p50']), ms(latency['p95']), ms(latency['p99']), ms(latency['max'])))
+        if report['first_byte']:
+            first_byte = report['first_byte']
+            self.stdout.write('首个片段 p50 %s  p95 %s  p99 %s' % (
+                ms(first_byte['p50']), ms(first_byte['p95']), ms(first_byte['p99'])))
+        self.stdout.write('结果分类：')
+        for outcome, count in report['outcomes'].items():
+            self.stdout.write('  %-20s %6d  %5.1f%%' % (outcome, count, count / report['requests'] * 100))
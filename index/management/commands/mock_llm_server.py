@@ -0,0 +1,63 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from llm.mock_server import LatencyModel, MockCorrector, MockLLMServer
+
+
+class Command(BaseCommand):
+    help = '启动 OpenAI 兼容的模拟模型服务，用于在没有真实模型服务时压测和联调'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+        parser.add_argument('--port', type=int, default=8001, help='监听端口')
+        parser.add_argument('--latency', default='lognormal', choices=LatencyModel.DISTRIBUTIONS,
+                            help='首字节耗时分布')
+        parser.add_argument('--latency-mean', type=float, default=0.5, help='首字节耗时均值（秒）')
+        parser.add_argument('--latency-stddev', type=float, default=0.2, help='首字节耗时标准差（秒）')
+        parser.add_argument('--token-delay', type=float, default=0.01, help='每输出一个字的耗时（秒）')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='返回错误状态码的比例')
+        parser.add_argument('--error-codes', default='500,503', help='逗号分隔的错误状态码')
+        parser.add_argument('--timeout-rate', type=float, default=0.0, help='长时间不响应的比例')
+        parser.add_argument('--timeout', type=float, default=300.0, help='不响应的时长（秒）')
+        parser.add_argument('--replace', action='append', default=[], metavar='错误=正确',
+                            help='模拟纠错的替换规则，可重复指定，默认 万=玩、火火=火')
+        parser.add_argument('--seed', type=int, help='随机种子')
+        parser.add_argument('--stats-interval', type=float, default=10.0, help='输出统计信息的间隔（秒），0 表示不输出')
+
+    def handle(self, *args, **options):
+        replacements = {}
+        for rule in options['replace'] or ['万=玩', '火火=火']:
+            wrong, sep, right = rule.partition('=')
+            if not sep or not wrong:
+                raise CommandError('替换规则 %s 格式应为 错误=正确' % rule)
+            replacements[wrong] = right
+
+        server = MockLLMServer(
+            (options['host'], options['port']),
+            latency=LatencyModel(options['latency'], options['latency_mean'], options['latency_stddev'],
+                                 options['token_delay'], seed=options['seed']),
+            corrector=MockCorrector(replacements),
+            error_rate=options['error_rate'],
+            error_codes=[int(code) for code in options['error_codes'].split(',') if code],
+            timeout_rate=options['timeout_rate'],
+            timeout=options['timeout'],
+        )
+        host, port = server.server_address[:2]
+        self.stdout.write('模拟模型服务已启动：http://%s:%d/v1/chat/completions（Ctrl+C 停止）' % (host, port))
+
+        if options['stats_interval']:
+            def report():
+                while True:
+                    time.sleep(options['stats_interval'])
+                    self.stdout.write('请求 %(requests)d，错误 %(errors)d，不响应 %(timeouts)d，在途 %(in_flight)d'
+                                      % server.stats())
+
+            threading.Thread(target=report, daemon=True).start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -7,6 +7,8 @@ class Text(models.Model):
     dest = models.CharField(verbose_name="纠错后文本",default='',max_length=500)
     owner = models.CharField(verbose_name='',default='',max_length=100)
     status = models.CharField(verbose_name='状态',default='',max_length=100)
+    # 原文到纠错后文本的编辑操作（JSON），展示时按它渲染标记，不必重新比对
+    ops = models.TextField(verbose_name='编辑操作',default='',blank=True)
     create_time = models.DateTimeField('创建时间', auto_now_add=True)
     modify_time = models.DateTimeField('最后修改时间', auto_now=True)
 
@@ -21,10 +23,13 @@ class Text(models.Model):
 class Document(models.Model):
     id=models.AutoField(primary_key=True)
     name = models.CharField(verbose_name='文档名称',default='',max_length=100)
-    src = models.CharField(verbose_name='纠正文本',default='',max_length=500)
-    dest = models.CharField(verbose_name="纠错后文本",default='',max_length=500)
+    # 整篇文档（包括知识库文档）的原文和纠错结果，不限长度
+    src = models.TextField(verbose_name='纠正文本',default='')
+    dest = models.TextField(verbose_name="纠错后文本",default='')
     owner = models.CharField(verbose_name='',default='',max_length=100)
     status = models.CharField(verbose_name='状态',default='',max_length=100)
+    # 原文到纠错后文本的编辑操作（JSON），展示时按它渲染标记，不必重新比对
+    ops = models.TextField(verbose_name='编辑操作',default='',blank=True)
     create_time = models.DateTimeField('创建时间', auto_now_add=True)
 
 
@@ -34,6 +39,61 @@ class Document(models.Model):
     class Meta:
         db_table = 'document'
 
+
+class CorrectionJob(models.Model):
+    """
+    文档纠错任务：上传后入队，由 correction_worker 命令启动的工作进程按优先级领取，
+    逐段纠错并保存进度，进程崩溃后租约到期，其他工作进程从已保存的位置继续。
+    """
+    id = models.AutoField(primary_key=True)
+    document_id = models.IntegerField(verbose_name='文档ID', db_index=True)
+    owner = models.CharField(verbose_name='用户', default='', max_length=100)
+    # 数值越大越先处理
+    priority = models.IntegerField(verbose_name='优先级', default=0)
+    status = models.CharField(verbose_name='状态', default='排队中', max_length=100)
+    attempts = models.IntegerField(verbose_name='尝试次数', default=0)
+    worker = models.CharField(verbose_name='工作进程', default='', max_length=100)
+    # 纠错中的任务在此之前归 worker 所有；排队中的任务（如重试退避）在此之前不被领取
+    lease_until = models.DateTimeField(verbose_name='租约到期时间', null=True, blank=True)
+    # 原文中已纠错部分的长度，以及这部分的纠错结果
+    position = models.IntegerField(verbose_name='已处理长度', default=0)
+    partial = models.TextField(verbose_name='部分结果', default='', blank=True)
+    # 已纠错部分的编辑操作（格式同 Document.ops），每段完成时追加，轮询进度时直接渲染，不必重新比对
+    partial_ops = models.TextField(verbose_name='部分结果编辑操作', default='', blank=True)
+    error = models.TextField(verbose_name='错误信息', default='', blank=True)
+    # 提交时可以复用已有纠错结果的段落数和需要请求模型的段落数
+    reused = models.IntegerField(verbose_name='复用段落数', default=0)
+    recomputed = models.IntegerField(verbose_name='重新纠错段落数', default=0)
+    create_time = models.DateTimeField('创建时间', auto_now_add=True)
+    modify_time = models.DateTimeField('最后修改时间', auto_now=True)
+
+    def __str__(self):
+        return '%s#%s' % (self.owner, self.document_id)
+
+    class Meta:
+        db_table = 'correction_job'
+        index_together = [('status', 'priority'), ('owner', 'status')]
+
+
+class DocumentParagraph(models.Model):
+    """
+    文档逐段的纠错结果。重新上传修改过的文档时，内容哈希相同的段落直接复用，只有新增或修改的段落请求模型。
+    """
+    id = models.AutoField(primary_key=True)
+    document_id = models.IntegerField(verbose_name='文档ID')
+    owner = models.CharField(verbose_name='用户', default='', max_length=100)
+    # 段落在文档中的序号，从 0 开始
+    number = models.IntegerField(verbose_name='段落序号')
+    # 段落原文、模型名称和 prompt 版本的 SHA-256，模型或 prompt 变化后不再复用
+    hash = models.CharField(verbose_name='段落哈希', max_length=64)
+    dest = models.TextField(verbose_name='纠错后段落', default='', blank=True)
+    create_time = models.DateTimeField('创建时间', auto_now_add=True)
+
+    class Meta:
+        db_table = 'document_paragraph'
+        unique_together = [('document_id', 'number')]
+        index_together = [('owner', 'hash')]
+
 #
 # class Resources(models.Model):
 #     # 主键 id，自动增长
@@ -0,0 +1,56 @@
+import logging
+import queue
+import threading
+
+from django.db import connection
+from django.http import StreamingHttpResponse
+
+logger = logging.getLogger(__name__)
+
+# 生产线程结束的标记
+_END = object()
+
+
+def thread_stream(produce, name='sse-producer'):
+    """
+    在单独的线程中运行 produce(emit)，emit 产出的消息放入队列，返回的生成器只从队列中取出消息。
+    阻塞读取模型输出、比对和写数据库都在该线程中完成，迭代响应的一方（WSGI 工作线程，或 ASGI 下 website.asgi 的线程池）
+    只等待队列，浏览器断开后生产线程仍会运行结束并保存纠错记录。
+    :param produce: 生产函数，参数为 emit(message)
+    :param name: 线程名称
+    :return: 消息生成器
+    """
+    messages = queue.Queue()
+
+    def run():
+        try:
+            produce(messages.put)
+        except Exception:
+            logger.exception('流式响应生产线程出错')
+        finally:
+            # 线程中打开的数据库连接不会被请求结束的信号关闭
+            connection.close()
+            messages.put(_END)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+
+    def drain():
+        while True:
+            message = messages.get()
+            if message is _END:
+                return
+            yield message
+
+    return drain()
+
+
+def event_stream_response(events):
+    """
+    :param events: Server-Sent Events 消息的迭代器
+    :return: text/event-stream 流式响应
+    """
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    # 禁止缓存和反向代理缓冲，保证片段及时到达浏览器
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,3 +1,1510 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import difflib
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock, skipIf
 
-# Create your tests here.
+import docx
+import numpy as np
+import requests
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import HttpRequest
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from llm.RAG.cache import RetrievalCache
+from llm.RAG.indexes import build_faiss_index, index_memory_bytes
+from llm.TextHighlighter import IncrementalHighlighter, ParagraphHighlighter, render_ops
+from llm.batching import SentenceBatcher
+from llm.chunking import chunk_text
+from llm.client import AsyncLLMHttpClient, LLMHttpClient
+from llm.correction import DocumentCorrector
+from llm.correction_cache import CorrectionCache
+from llm.detector import CharNgramLM, LocalDetector
+from llm.diff import decode_ops, diff_opcodes, encode_ops, matching_blocks
+from llm.endpoints import EndpointPool, health_url
+from llm.limiter import AdaptiveLimiter, BackendGuard, CircuitBreaker, CircuitOpenError, LLMOverloaded, LLMResponseError
+from llm.loadtest import LoadTester, percentile
+from llm.mock_server import LatencyModel, MockCorrector, extract_input, start_mock_server
+from llm.qwen import AsyncChatCompletion, ChatCompletion, parse_batch_content
+from llm.singleflight import AsyncSingleFlight, SharedFlightStore, SingleFlight, flight_key
+try:
+    from langchain_core.embeddings import Embeddings
+    from llm.RAG import RAGprompt, registry
+    from llm.RAG.batching import BatchingEmbeddings
+    from llm.RAG.ingest import IngestionPipeline, expand_sources
+    from llm.RAG.knowledge import KnowledgeIndex, KnowledgePool
+    from llm.RAG.lexical import BM25Index, reciprocal_rank_fusion
+except ImportError:
+    # 未安装 RAG 依赖（如 langchain_huggingface）时跳过 RAG 测试
+    Embeddings, RAGprompt, registry = object, None, None
+    BatchingEmbeddings = KnowledgeIndex = KnowledgePool = BM25Index = reciprocal_rank_fusion = None
+    IngestionPipeline = expand_sources = None
+from .jobs import QUEUED, RUNNING, JobWorker, claim_job, job_progress, next_segment, submit_document
+from .models import CorrectionJob, Document, Text
+
+
+class FakeCorrector:
+    """
+    代替 DocumentCorrector：每个非空段落末尾加上“对”，并记录每次请求的文本
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def correct(self, text):
+        self.calls.append(text)
+        return '\n'.join(line + '对' if line.strip() else line for line in text.split('\n'))
+
+
+def apply_opcodes(opcodes, a, b):
+    """
+    按编辑操作由原文重建更正后的文本，检查操作是否连续、完整
+    """
+    parts = []
+    i = j = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        if (i1, j1) != (i, j):
+            raise AssertionError('编辑操作不连续: %r' % ((tag, i1, i2, j1, j2),))
+        parts.append(a[i1:i2] if tag == 'equal' else b[j1:j2])
+        if tag == 'equal' and a[i1:i2] != b[j1:j2]:
+            raise AssertionError('相同片段不一致: %r' % ((tag, i1, i2, j1, j2),))
+        i, j = i2, j2
+    if (i, j) != (len(a), len(b)):
+        raise AssertionError('编辑操作没有覆盖全文')
+    return ''.join(parts)
+
+
+# 原文与更正文本的样例：普通纠错、大量重复字、空文本、完全不同的文本
+DIFF_CASES = [
+    ('今天是周一，可以出去万足球。', '今天是周一，可以出去踢足球。'),
+    ('的的的的的的的的的的的的的的的的的的的的的', '的的的地的的的的的的的的的的得的的的的的'),
+    ('', '新增的内容'),
+    ('被删除的内容', ''),
+    ('abcdefg', 'hijklmn'),
+    ('他的的确确是在在这里。' * 50, '他的的确确是在这里。' * 50),
+]
+
+
+def run_jobs(corrector, **kwargs):
+    worker = JobWorker(name='test', corrector=corrector, **kwargs)
+    while worker.run_once():
+        pass
+    worker.close()
+
+
+class ParagraphReuseTests(TestCase):
+
+    def test_reupload_reuses_unchanged_paragraphs(self):
+        paragraphs = ['这是第%d个段落，内容保持不变。' % number for number in range(6)]
+        submit_document('a.docx', '\n'.join(paragraphs) + '\n', 'alice')
+        run_jobs(FakeCorrector(), segment_chars=80)
+
+        paragraphs[3] = '这是修改过的段落。'
+        document, job = submit_document('a.docx', '\n'.join(paragraphs) + '\n', 'alice')
+        self.assertEqual((job.reused, job.recomputed), (5, 1))
+        corrector = FakeCorrector()
+        # 每段约 4 个段落，复用的段落跨越分段边界
+        run_jobs(corrector, segment_chars=80)
+
+        self.assertEqual(corrector.calls, ['这是修改过的段落。'])
+        document.refresh_from_db()
+        self.assertEqual(document.dest, ''.join(paragraph + '对\n' for paragraph in paragraphs))
+        self.assertEqual(document.status, '有错误')
+
+    def test_paragraphs_of_other_users_are_not_reused(self):
+        text = '第一段。\n第二段。\n'
+        submit_document('a.docx', text, 'alice')
+        run_jobs(FakeCorrector())
+        document, job = submit_document('a.docx', text, 'bob')
+        self.assertEqual((job.reused, job.recomputed), (0, 2))
+
+
+class DiffTests(SimpleTestCase):
+
+    def test_opcodes_rebuild_corrected_text(self):
+        for a, b in DIFF_CASES:
+            self.assertEqual(apply_opcodes(diff_opcodes(a, b), a, b), b)
+
+    def test_matching_blocks_are_at_least_as_long_as_difflib(self):
+        for a, b in DIFF_CASES:
+            matched = sum(size for i, j, size in matching_blocks(a, b))
+            expected = sum(block.size for block in difflib.SequenceMatcher(None, a, b, autojunk=False)
+                           .get_matching_blocks())
+            self.assertGreaterEqual(matched, expected)
+
+    def test_max_cost_still_produces_valid_opcodes(self):
+        a, b = DIFF_CASES[-1]
+        self.assertEqual(apply_opcodes(diff_opcodes(a, b, max_cost=3), a, b), b)
+
+    def test_encode_decode_round_trip(self):
+        for a, b in DIFF_CASES:
+            opcodes = diff_opcodes(a, b)
+            self.assertEqual(decode_ops(encode_ops(opcodes), len(a), len(b)), opcodes)
+
+
+class ChunkingTests(SimpleTestCase):
+    text = '第一句。第二句比较长一些！第三句？\n\n  第二段只有一句。\n没有标点的长句' + '字' * 30 + '\n'
+
+    def test_chunks_rebuild_text(self):
+        for pack in (True, False):
+            chunks = chunk_text(self.text, max_tokens=10, count=len, pack=pack)
+            self.assertEqual(''.join(chunk + separator for chunk, separator in chunks), self.text)
+
+    def test_chunks_respect_token_budget_and_paragraphs(self):
+        chunks = chunk_text(self.text, max_tokens=10, count=len)
+        self.assertTrue(all(len(chunk) <= 10 for chunk, separator in chunks))
+        self.assertTrue(all('\n' not in chunk for chunk, separator in chunks))
+        self.assertIn(('第一句。', ''), chunks)
+
+    def test_short_paragraph_is_one_chunk_when_packing(self):
+        self.assertEqual(chunk_text('第一句。第二句。\n', count=len), [('第一句。第二句。', '\n'), ('', '')])
+        self.assertEqual(chunk_text('第一句。第二句。', count=len, pack=False), [('第一句。', ''), ('第二句。', '')])
+
+
+class FakeAsyncChat:
+    """
+    代替 AsyncChatCompletion：把“万”改为“玩”，记录请求和最大并发数；含“失败”的块第一次请求抛出异常
+    """
+    model = 'fake'
+
+    def __init__(self):
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_response(self, text):
+        self.calls.append(text)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if '失败' in text and self.calls.count(text) == 1:
+                raise ValueError('响应解析失败')
+            return text.replace('万', '玩')
+        finally:
+            self.in_flight -= 1
+
+
+@override_settings(LLM_CACHE_ENABLED=False, LLM_DETECTOR_ENABLED=False, LLM_BATCH_ENABLED=False)
+class DocumentCorrectorTests(SimpleTestCase):
+
+    def test_chunks_are_corrected_concurrently_in_order(self):
+        paragraphs = ['我想出去万。', '今天天气好。', '  我想出去万。', '这一段第一次会失败。', '', '最后一段万。']
+        text = '\n'.join(paragraphs) + '\n'
+        chat = FakeAsyncChat()
+        corrector = DocumentCorrector(chat=chat, concurrency=3, backoff_base=0.001, backoff_max=0.001)
+        self.assertEqual(asyncio.run(corrector.correct(text)), text.replace('万', '玩'))
+        # 重复的块只请求一次，失败的块单独重试，空段落不请求
+        self.assertEqual(sorted(chat.calls), sorted(['我想出去万。', '今天天气好。', '这一段第一次会失败。',
+                                                     '这一段第一次会失败。', '最后一段万。']))
+        self.assertEqual(chat.max_in_flight, 3)
+
+    def test_chunk_gives_up_after_max_retries(self):
+        chat = FakeAsyncChat()
+        chat.get_response = mock.AsyncMock(side_effect=ValueError('响应解析失败'))
+        corrector = DocumentCorrector(chat=chat, max_retries=2, backoff_base=0.001, backoff_max=0.001)
+        with self.assertRaises(ValueError):
+            asyncio.run(corrector.correct('甲。\n'))
+        self.assertEqual(chat.get_response.await_count, 1 + 2)
+
+
+@override_settings(LLM_DETECTOR_ENABLED=False, LLM_BATCH_ENABLED=False)
+class CorrectionCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.cache = CorrectionCache(directory, size_limit_mb=8)
+
+    def test_key(self):
+        key = CorrectionCache.key('我想出去万。', 'qwen', 1)
+        # 首尾空白和 Unicode 等价形式不影响键，上下文为空与 None 相同
+        self.assertEqual(CorrectionCache.key(' 我想出去万。\n', 'qwen', 1, ''), key)
+        self.assertEqual(CorrectionCache.key('e\u0301', 'qwen', 1), CorrectionCache.key('\u00e9', 'qwen', 1))
+        # 全角标点可能就是要纠正的错误，不做转换
+        self.assertNotEqual(CorrectionCache.key('我想出去万.', 'qwen', 1), key)
+        for other in (('我想出去万。', 'gpt', 1), ('我想出去万。', 'qwen', 2), ('我想出去万。', 'qwen', 1, '上下文')):
+            self.assertNotEqual(CorrectionCache.key(*other), key)
+
+    def test_cached_sentences_skip_the_model(self):
+        text = '我想出去万。今天天气好。\n'
+        first = FakeAsyncChat()
+        self.assertEqual(asyncio.run(DocumentCorrector(chat=first, cache=self.cache).correct(text)),
+                         '我想出去玩。今天天气好。\n')
+        # 同一段落的两句合并为一次请求，结果按句子保存
+        self.assertEqual(first.calls, ['我想出去万。今天天气好。'])
+        second = FakeAsyncChat()
+        self.assertEqual(asyncio.run(DocumentCorrector(chat=second, cache=self.cache).correct(
+            '今天天气好。\n我想出去万。\n')), '今天天气好。\n我想出去玩。\n')
+        self.assertEqual(second.calls, [])
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+
+@override_settings(LLM_CACHE_ENABLED=False, LLM_BATCH_ENABLED=False)
+class LocalDetectorTests(SimpleTestCase):
+
+    def setUp(self):
+        lm = CharNgramLM().train(['我想出去玩。', '我们出去玩吧。', '他想去玩。', '今天去哪里玩。'] * 20 + ['一万元。'])
+        self.detector = LocalDetector(lm, {'万': {'玩'}}, threshold=0.9)
+
+    def test_is_clean(self):
+        self.assertTrue(self.detector.is_clean('我想出去玩。'))
+        self.assertFalse(self.detector.is_clean('我想出去万。'))
+        self.assertEqual(self.detector.stats()['skipped'], 1)
+        self.assertEqual(self.detector.stats()['sent_to_llm'], 1)
+
+    def test_clean_sentences_skip_the_model(self):
+        chat = FakeAsyncChat()
+        corrector = DocumentCorrector(chat=chat, detector=self.detector)
+        self.assertEqual(asyncio.run(corrector.correct('我想出去玩。\n我想出去万。\n')), '我想出去玩。\n我想出去玩。\n')
+        self.assertEqual(chat.calls, ['我想出去万。'])
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def test_concurrent_calls_run_once(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return '结果'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('键', compute))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        # 第二个线程进入等待后再放行计算
+        deadline = time.monotonic() + 5
+        while flight.stats()['shared'] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, ['结果', '结果'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats()['in_flight'], 0)
+        # 计算结束后相同的键重新计算
+        flight.do('键', compute)
+        self.assertEqual(len(calls), 2)
+
+    def test_error_is_shared(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def compute():
+            release.wait(5)
+            raise ValueError('出错')
+
+        errors = []
+
+        def run():
+            try:
+                flight.do('键', compute)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while flight.stats()['shared'] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    def test_async_calls_run_once(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return '结果'
+
+        async def main():
+            first = asyncio.ensure_future(flight.do('键', compute))
+            second = asyncio.ensure_future(flight.do('键', compute))
+            await asyncio.sleep(0.01)
+            # 第一个请求取消不影响其他等待者
+            first.cancel()
+            return await second
+
+        self.assertEqual(asyncio.run(main()), '结果')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats()['shared'], 1)
+
+    def test_shared_store_across_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        store = SharedFlightStore(directory)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return '结果'
+
+        # 两个实例代表两个进程，后到的进程直接读取先到的进程写入的结果
+        first, second = SingleFlight(store), SingleFlight(store)
+        self.assertEqual(first.do('键', compute), '结果')
+        self.assertEqual(second.do('键', compute), '结果')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(second.stats()['shared_across_processes'], 1)
+
+    def test_flight_key(self):
+        self.assertEqual(flight_key('correct_doc', 'e\u0301'), flight_key('correct_doc', '\u00e9'))
+        self.assertNotEqual(flight_key('correct_doc', '文本'), flight_key('correct_text', '文本'))
+
+
+class IncrementalHighlighterTests(SimpleTestCase):
+    original = '下一代发动机技树正在改变航空运输方式。新的超音速客机正在研发中，预计将大大缩短全球飞行时件。'
+    corrected = '下一代发动机技术正在改变航空运输方式。新的超音速客机正在研发中，预计将缩短全球飞行时间。'
+
+    def test_stable_prefix_is_emitted_while_streaming(self):
+        highlighter = IncrementalHighlighter(self.original)
+        fragments = [highlighter.feed(self.corrected[start:start + 3]) for start in range(0, len(self.corrected), 3)]
+        # 修改之后的文本到达后，修改处就已经输出
+        self.assertIn('<span style="text-decoration: underline wavy red;">术</span>', ''.join(fragments[:6]))
+        html = ''.join(fragments) + highlighter.finish()
+        # 删除的“大大”标记为空片段
+        self.assertEqual(re.findall(r'<span[^>]*>(.*?)</span>', html), ['术', '', '间'])
+        self.assertEqual(re.sub(r'<[^>]+>', '', html), self.corrected)
+        self.assertEqual(highlighter.corrected_text, self.corrected)
+
+
+class ParagraphHighlighterTests(SimpleTestCase):
+
+    def check(self, source, target):
+        highlighter = ParagraphHighlighter(source, target)
+        html = ''.join(highlighter.fragments())
+        # 保存的编辑操作渲染结果与逐段产出的片段一致，并能由原文重建更正文本
+        self.assertEqual(render_ops(highlighter.ops(), source, target), html)
+        self.assertEqual(apply_opcodes(decode_ops(highlighter.ops(), len(source), len(target)), source, target),
+                         target)
+        return html
+
+    def test_same_paragraph_count(self):
+        html = self.check('第一段万足球。\n第二段没有错。\n', '第一段踢足球。\n第二段没有错。\n')
+        self.assertIn('underline wavy red;">踢</span>', html)
+        self.assertTrue(html.endswith('第二段没有错。\n'))
+
+    def test_paragraphs_merged_or_split(self):
+        self.check('第一段。\n第二段。\n第三段有错。\n第四段。', '第一段。\n第二段。第三段有对。\n第四段。')
+        self.check('第一段。\n第二段。', '第一段。\n新增的段落。\n第二段。\n')
+
+    def test_unchanged_text_has_no_marks(self):
+        source = '完全相同的段落。\n第二段。'
+        self.assertEqual(self.check(source, source), source)
+
+
+class ParseBatchContentTests(SimpleTestCase):
+
+    def test_json_array(self):
+        self.assertEqual(parse_batch_content('```json\n["甲。", "乙。"]\n```', 2), ['甲。', '乙。'])
+
+    def test_numbered_list(self):
+        self.assertEqual(parse_batch_content('1. 甲。\n2、"乙。"', 2), ['甲。', '乙。'])
+
+    def test_count_mismatch_and_empty_items(self):
+        self.assertEqual(parse_batch_content('["甲。"]', 2), [None, None])
+        self.assertEqual(parse_batch_content('["甲。", " "]', 2), ['甲。', None])
+        self.assertEqual(parse_batch_content('无法解析的输出', 2), [None, None])
+
+
+class FakeBatchChat:
+    """
+    代替 AsyncChatCompletion：记录合并请求的句子和单独请求的内容
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.singles = []
+
+    async def get_batch_response(self, sentences, context=None):
+        self.batches.append(list(sentences))
+        # 含“漏”的句子模拟模型漏掉的结果
+        return [None if '漏' in sentence else sentence + '对' for sentence in sentences]
+
+    async def get_response(self, text):
+        self.singles.append(text)
+        return text
+
+
+def prompt(prefix):
+    return lambda text: prefix + text
+
+
+class SentenceBatcherTests(SimpleTestCase):
+
+    def correct_all(self, requests, max_sentences=10):
+        chat = FakeBatchChat()
+        batcher = SentenceBatcher(chat=chat, max_tokens=1000, max_sentences=max_sentences, window=0.01, concurrency=4)
+
+        async def run():
+            return await asyncio.gather(*(batcher.correct(sentence, context, render)
+                                          for sentence, context, render in requests))
+
+        return chat, asyncio.run(run())
+
+    def test_same_prompt_from_different_requests_is_merged(self):
+        chat, results = self.correct_all([('甲。', '上下文', prompt('提示')), ('乙。', '上下文', prompt('提示'))])
+        self.assertEqual(chat.batches, [['甲。', '乙。']])
+        self.assertEqual(results, ['甲。对', '乙。对'])
+
+    def test_different_prompts_are_not_merged(self):
+        chat, results = self.correct_all([('甲。', '上下文', prompt('提示一')), ('乙。', '上下文', prompt('提示二'))])
+        self.assertEqual(chat.batches, [])
+        # 各自按自己的 prompt 单独请求
+        self.assertEqual(sorted(chat.singles), ['提示一甲。', '提示二乙。'])
+
+    def test_batches_are_split_by_sentence_count(self):
+        chat, results = self.correct_all([(sentence, None, None) for sentence in '甲。 乙。 丙。 丁。 戊。'.split()],
+                                         max_sentences=2)
+        self.assertEqual(chat.batches, [['甲。', '乙。'], ['丙。', '丁。']])
+        # 剩下的一个句子在等待窗口结束后单独请求
+        self.assertEqual(chat.singles, ['戊。'])
+        self.assertEqual(results, ['甲。对', '乙。对', '丙。对', '丁。对', '戊。'])
+
+    def test_missing_results_are_retried_alone(self):
+        chat, results = self.correct_all([('甲。', None, prompt('提示')), ('漏了。', None, prompt('提示'))])
+        self.assertEqual(chat.batches, [['甲。', '漏了。']])
+        self.assertEqual(chat.singles, ['提示漏了。'])
+        self.assertEqual(results, ['甲。对', '提示漏了。'])
+
+
+class JobQueueTests(TestCase):
+
+    def submit(self, owner, priority=0):
+        return submit_document('a.docx', '一段。\n', owner, priority=priority)[1]
+
+    def test_higher_priority_first_then_submission_order(self):
+        first = self.submit('alice')
+        urgent = self.submit('bob', priority=5)
+        second = self.submit('carol')
+        claimed = [claim_job('w', user_concurrency=3).id for _ in range(3)]
+        self.assertEqual(claimed, [urgent.id, first.id, second.id])
+        self.assertIsNone(claim_job('w'))
+
+    def test_per_user_concurrency(self):
+        first = self.submit('alice')
+        self.submit('alice')
+        other = self.submit('bob')
+        self.assertEqual(claim_job('w', user_concurrency=1).id, first.id)
+        # alice 已有一个任务在处理，跳过她的第二个任务
+        self.assertEqual(claim_job('w', user_concurrency=1).id, other.id)
+        self.assertIsNone(claim_job('w', user_concurrency=1))
+
+    def test_expired_lease_is_reclaimed(self):
+        job = self.submit('alice')
+        claim_job('w1', user_concurrency=1)
+        self.assertIsNone(claim_job('w2', user_concurrency=1))
+        CorrectionJob.objects.filter(id=job.id).update(lease_until=timezone.now() - datetime.timedelta(seconds=1))
+        job = claim_job('w2', user_concurrency=1)
+        self.assertEqual((job.status, job.worker, job.attempts), (RUNNING, 'w2', 2))
+
+    def test_retry_backoff_is_not_claimed_early(self):
+        job = self.submit('alice')
+        CorrectionJob.objects.filter(id=job.id).update(
+            status=QUEUED, lease_until=timezone.now() + datetime.timedelta(seconds=60))
+        self.assertIsNone(claim_job('w'))
+
+    def test_next_segment_ends_at_paragraph_boundary(self):
+        text = '第一段。\n第二段。\n第三段。\n'
+        self.assertEqual(next_segment(text, 0, 7), 5)
+        self.assertEqual(next_segment(text, 5, 7), 10)
+        self.assertEqual(next_segment(text, 10, 100), len(text))
+        # 单个段落超过 size 时整段处理
+        self.assertEqual(next_segment('很长的一段' * 5 + '\n短段\n', 0, 3), 26)
+
+
+class CorrectSegmentTests(TestCase):
+
+    def test_only_missing_paragraphs_are_corrected(self):
+        document, job = submit_document('a.docx', '甲。\n\n乙。\n', 'alice')
+        worker = JobWorker(name='test')
+        corrector = FakeCorrector()
+        self.assertEqual(worker.correct_segment(corrector, document, '甲。\n\n', 0), '甲。对\n\n')
+        # 段落已保存，再次处理同一段不请求模型；空行不纠错也不保存
+        self.assertEqual(worker.correct_segment(corrector, document, '甲。\n\n乙。\n', 0), '甲。对\n\n乙。对\n')
+        self.assertEqual(corrector.calls, ['甲。', '乙。'])
+
+    def test_segment_without_trailing_newline(self):
+        document, job = submit_document('a.docx', '甲。\n乙。', 'alice')
+        self.assertEqual(JobWorker(name='test').correct_segment(FakeCorrector(), document, '甲。\n乙。', 0),
+                         '甲。对\n乙。对')
+
+    def test_segments_share_one_event_loop(self):
+        loops = []
+
+        class LoopCorrector(FakeCorrector):
+            async def correct(self, text):
+                loops.append(asyncio.get_running_loop())
+                return await super().correct(text)
+
+        paragraphs = ['第%d个段落有错误需要纠正。' % number for number in range(6)]
+        document, job = submit_document('a.docx', '\n'.join(paragraphs) + '\n', 'alice')
+        run_jobs(LoopCorrector(), segment_chars=40)
+        # 异步 HTTP 客户端按事件循环持有连接池，各段使用同一个事件循环才能复用连接
+        self.assertGreater(len(loops), 1)
+        self.assertEqual(len(set(map(id, loops))), 1)
+        self.assertTrue(loops[0].is_closed())
+
+
+class FakeStreamChat:
+    """
+    代替 ChatCompletion：先产出第一段，等 release 被设置后再产出其余部分
+    """
+    release = threading.Event()
+
+    def stream_response(self, user_message):
+        yield '今天是周一，'
+        if not self.release.wait(10):
+            raise TimeoutError('测试没有收到第一段')
+        yield '可以出去踢足球。'
+
+
+class FakeEnhancer:
+
+    def enhance_prompt(self, text, owner=None):
+        return text
+
+
+class TextStreamTests(TransactionTestCase):
+    text = '今天是周一，可以出去万足球。'
+
+    def setUp(self):
+        FakeStreamChat.release = threading.Event()
+        patchers = [mock.patch('index.views.ChatCompletion', FakeStreamChat),
+                    mock.patch('index.views.get_enhancer', FakeEnhancer)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_first_delta_arrives_before_the_model_finishes(self):
+        response = self.client.post('/correct_text_stream', {'text': self.text})
+        events = iter(response.streaming_content)
+        self.assertTrue(next(events).startswith(b'event: delta'))
+        FakeStreamChat.release.set()
+        rest = b''.join(events).decode()
+        self.assertIn('event: done', rest)
+        self.assertEqual(Text.objects.get().dest, '今天是周一，可以出去踢足球。')
+
+    def test_stream_under_asgi(self):
+        from website.asgi import application
+        body = ('text=' + self.text).encode()
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+                 'scheme': 'http', 'path': '/correct_text_stream', 'raw_path': b'/correct_text_stream',
+                 'query_string': b'', 'root_path': '', 'client': ('127.0.0.1', 1), 'server': ('testserver', 80),
+                 'headers': [(b'content-type', b'application/x-www-form-urlencoded'),
+                             (b'content-length', str(len(body)).encode()), (b'host', b'testserver')]}
+        chunks = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and message.get('body'):
+                chunks.append(message['body'])
+                # 收到第一段后模型才继续生成，说明片段是边生成边推送的
+                FakeStreamChat.release.set()
+
+        async def run():
+            await asyncio.wait_for(application(scope, receive, send), 20)
+
+        asyncio.run(run())
+        self.assertTrue(chunks[0].startswith(b'event: delta'))
+        self.assertIn('event: done', b''.join(chunks).decode())
+        self.assertEqual(Text.objects.count(), 1)
+
+
+class FailingCorrector(FakeCorrector):
+    """
+    前 succeed 次请求正常纠错，之后抛出异常
+    """
+
+    def __init__(self, succeed):
+        super().__init__()
+        self.succeed = succeed
+
+    async def correct(self, text):
+        if len(self.calls) >= self.succeed:
+            raise RuntimeError('模型服务出错')
+        return await super().correct(text)
+
+
+class JobProgressTests(TestCase):
+    paragraphs = ['第%d个段落有错误需要纠正。' % number for number in range(6)]
+
+    def test_progress_renders_saved_segment_ops(self):
+        text = '\n'.join(self.paragraphs) + '\n'
+        document, job = submit_document('a.docx', text, 'alice')
+        run_jobs(FailingCorrector(1), segment_chars=40)
+        job.refresh_from_db()
+        self.assertEqual(job.status, QUEUED)
+        self.assertTrue(0 < job.position < len(text))
+        expected = ''.join(ParagraphHighlighter(text[:job.position], job.partial).fragments())
+        # 轮询进度时不再比对
+        with mock.patch('index.jobs.ParagraphHighlighter', side_effect=AssertionError):
+            self.assertEqual(job_progress(job, document)['highlighted'], expected)
+
+    def test_finished_document_ops_are_joined_from_segments(self):
+        text = '\n'.join(self.paragraphs) + '\n'
+        document, job = submit_document('a.docx', text, 'alice')
+        run_jobs(FakeCorrector(), segment_chars=40)
+        document.refresh_from_db()
+        self.assertEqual(apply_opcodes(decode_ops(document.ops, len(text), len(document.dest)), text, document.dest),
+                         document.dest)
+        self.assertEqual(render_ops(document.ops, text, document.dest),
+                         ''.join(ParagraphHighlighter(text, document.dest).fragments()))
+
+
+class LegacyOpsTests(TestCase):
+    def setUp(self):
+        session = self.client.session
+        session['username'] = 'alice'
+        session.save()
+
+    def test_list_does_not_write_legacy_ops(self):
+        record = Text.objects.create(src='今天天汽很好', dest='今天天气很好', owner='alice', status='纠错')
+        response = self.client.get('/get_wb', {'page': 1, 'limit': 10})
+        self.assertEqual(response.json()['code'], 0)
+        self.assertIn('气', response.json()['data'][0]['highlighted'])
+        record.refresh_from_db()
+        self.assertEqual(record.ops, '')
+
+    def test_backfill_command_saves_ops(self):
+        record = Text.objects.create(src='今天天汽很好', dest='今天天气很好', owner='alice', status='纠错')
+        knowledge = Text.objects.create(src='知识', dest='', owner='alice', status='知识库')
+        call_command('backfill_ops', stdout=io.StringIO())
+        record.refresh_from_db()
+        knowledge.refresh_from_db()
+        self.assertEqual(render_ops(record.ops, record.src, record.dest), render_ops('', record.src, record.dest))
+        self.assertNotEqual(record.ops, '')
+        self.assertEqual(knowledge.ops, '')
+
+
+class FakeDocumentCorrector:
+
+    async def correct(self, text):
+        return text.replace('万', '踢')
+
+
+def docx_upload(paragraphs):
+    content = docx.Document()
+    for paragraph in paragraphs:
+        content.add_paragraph(paragraph)
+    data = io.BytesIO()
+    content.save(data)
+    return SimpleUploadedFile('a.docx', data.getvalue())
+
+
+class DocumentStreamTests(TransactionTestCase):
+
+    def test_fragments_are_streamed_and_document_saved(self):
+        paragraphs = ['可以出去万足球。' * 100] * 20
+        with mock.patch('index.views.DocumentCorrector', FakeDocumentCorrector):
+            response = self.client.post('/correct_doc_stream', {'document': docx_upload(paragraphs)})
+            events = [event.decode() for event in response.streaming_content]
+        deltas = [event for event in events if event.startswith('event: delta')]
+        # 按约 4096 字分批推送
+        self.assertGreater(len(deltas), 1)
+        self.assertTrue(events[-1].startswith('event: done'))
+        document = Document.objects.get()
+        self.assertEqual(document.dest, '\n'.join(paragraphs).replace('万', '踢') + '\n')
+        self.assertEqual(render_ops(document.ops, document.src, document.dest),
+                         ''.join(ParagraphHighlighter(document.src, document.dest).fragments()))
+
+    def test_requires_post(self):
+        self.assertEqual(self.client.get('/correct_doc_stream').status_code, 400)
+
+
+class AsyncViewBodyTests(TransactionTestCase):
+
+    def test_upload_is_parsed_off_event_loop(self):
+        on_loop = []
+        load = HttpRequest._load_post_and_files
+
+        def record(request):
+            on_loop.append(asyncio._get_running_loop() is not None)
+            load(request)
+
+        with mock.patch.object(HttpRequest, '_load_post_and_files', record), \
+                mock.patch('index.views.DocumentCorrector', FakeDocumentCorrector):
+            response = self.client.post('/correct_doc_sync', {'document': docx_upload(['可以出去万足球。'])})
+        self.assertEqual(response.json()['error'], 0)
+        self.assertEqual(on_loop, [False])
+
+
+class FakeStreamResponse:
+
+    def __init__(self, status_code, lines=()):
+        self.status_code = status_code
+        self.text = 'error' if status_code != 200 else ''
+        self.lines = lines
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self.lines)
+
+    def close(self):
+        pass
+
+
+class FakeHttpClient:
+    """
+    地址中含 bad 的副本总是返回 502，其余副本返回两段流式输出
+    """
+    max_retries = 3
+    backoff_base = backoff_max = 0.001
+
+    def __init__(self):
+        self.urls = []
+        self.retries = 0
+
+    def post(self, url, max_retries=None, **kwargs):
+        self.urls.append((url, max_retries))
+        if 'bad' in url:
+            return FakeStreamResponse(502)
+        return FakeStreamResponse(200, ['data: {"choices":[{"delta":{"content":"%s"}}]}' % content
+                                        for content in ('今天', '是周一')] + ['data: [DONE]'])
+
+
+class StreamRetryTests(SimpleTestCase):
+
+    def chat(self, *urls):
+        chat = ChatCompletion(url='http://unused')
+        chat.pool = EndpointPool(list(urls), health_check_interval=0)
+        chat.client = FakeHttpClient()
+        # 不影响进程共享的熔断器
+        chat.guard = BackendGuard(AdaptiveLimiter(), CircuitBreaker(failure_threshold=100))
+        return chat
+
+    def test_retry_picks_another_replica_before_first_byte(self):
+        chat = self.chat('http://bad/v1/chat/completions', 'http://good/v1/chat/completions')
+        for _ in range(5):
+            self.assertEqual(''.join(chat.stream_response('今天是周一')), '今天是周一')
+        # 客户端不在同一个副本上重试
+        self.assertTrue(all(max_retries == 0 for url, max_retries in chat.client.urls))
+        self.assertLessEqual(sum(1 for url, max_retries in chat.client.urls if 'bad' in url), 3)
+
+    def test_gives_up_after_client_max_retries(self):
+        chat = self.chat('http://bad/v1/chat/completions')
+        with self.assertRaises(LLMResponseError):
+            list(chat.stream_response('今天是周一'))
+        self.assertEqual(len(chat.client.urls), FakeHttpClient.max_retries + 1)
+
+    def test_slot_is_released_during_backoff(self):
+        chat = self.chat('http://bad/v1/chat/completions')
+        in_flight = []
+        with mock.patch('llm.qwen.time.sleep', lambda delay: in_flight.append(chat.guard.limiter.in_flight)):
+            with self.assertRaises(LLMResponseError):
+                list(chat.stream_response('今天是周一'))
+        self.assertEqual(in_flight, [0] * FakeHttpClient.max_retries)
+
+
+class AdaptiveLimiterTests(SimpleTestCase):
+
+    def test_limit_increases_additively_and_decreases_multiplicatively(self):
+        limiter = AdaptiveLimiter(initial=2, max_limit=4, latency_threshold=1.0, queue_timeout=0)
+        limiter.acquire()
+        limiter.acquire()
+        # 达到上限后排队超时
+        with self.assertRaises(LLMOverloaded):
+            limiter.acquire()
+        self.assertEqual(limiter.stats()['rejected'], 1)
+        limiter.release(0.1)
+        self.assertAlmostEqual(limiter.limit, 2.5)
+        limiter.release(0.1, failed=True)
+        self.assertAlmostEqual(limiter.limit, 1.75)
+        # 同一批并发请求的拥塞只缩小一次
+        limiter.acquire()
+        limiter.release(5.0)
+        self.assertAlmostEqual(limiter.limit, 1.75)
+        self.assertEqual(limiter.stats()['decreases'], 1)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_timed_out_waiter_passes_wakeup_on(self):
+        limiter = AdaptiveLimiter(initial=1, max_limit=1)
+        limiter.acquire()
+        first, second = threading.Event(), threading.Event()
+        self.assertFalse(limiter._acquire_or_wait(first.set))
+        self.assertFalse(limiter._acquire_or_wait(second.set))
+        limiter.release()
+        self.assertTrue(first.is_set())
+        self.assertFalse(second.is_set())
+        # 第一个调用方被唤醒的同时排队超时，空闲的名额交给第二个调用方
+        with self.assertRaises(LLMOverloaded):
+            limiter._give_up(first.set)
+        self.assertTrue(second.is_set())
+
+    def test_cancelled_async_waiter_passes_wakeup_on(self):
+        limiter = AdaptiveLimiter(initial=1, max_limit=1)
+
+        async def run():
+            limiter.acquire()
+            first = asyncio.ensure_future(limiter.acquire_async())
+            second = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0)
+            # 第一个调用方在被唤醒的同时被取消
+            first.cancel()
+            limiter.release()
+            await asyncio.wait_for(second, 1)
+            self.assertTrue(first.cancelled())
+
+        asyncio.run(run())
+        self.assertEqual(limiter.in_flight, 1)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        breaker.record_failure()
+        breaker.record_failure()
+        # 成功清零连续失败次数
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow()
+        self.assertEqual(breaker.stats()['short_circuited'], 1)
+
+    def test_half_open_lets_one_probe_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.allow()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow()
+        # 探测失败重新打开
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.opens, 2)
+        # 探测没有发出时下一个请求继续探测，探测成功则关闭
+        breaker.allow()
+        breaker.cancel_probe()
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.allow()
+        breaker.allow()
+
+    def test_guard_counts_only_backend_failures(self):
+        guard = BackendGuard(AdaptiveLimiter(initial=4), CircuitBreaker(failure_threshold=1, reset_timeout=60))
+        # 4xx 说明服务能正常响应，不计入熔断
+        with self.assertRaises(LLMResponseError):
+            with guard.call():
+                raise LLMResponseError(400, '输入过长')
+        self.assertEqual(guard.breaker.state, CircuitBreaker.CLOSED)
+        with self.assertRaises(LLMResponseError):
+            with guard.call():
+                raise LLMResponseError(503, '服务不可用')
+        self.assertEqual(guard.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(guard.limiter.in_flight, 0)
+        with self.assertRaises(CircuitOpenError):
+            with guard.call():
+                pass
+
+
+class EndpointPoolTests(SimpleTestCase):
+    urls = ['http://a/v1/chat/completions', 'http://b/v1/chat/completions']
+
+    def fail(self, pool, url, status_code):
+        with mock.patch.object(pool, 'choose', return_value=pool.endpoints[self.urls.index(url)]):
+            with self.assertRaises(LLMResponseError):
+                with pool.route():
+                    raise LLMResponseError(status_code, '出错')
+
+    def test_ejects_after_consecutive_backend_failures(self):
+        pool = EndpointPool(self.urls, failure_threshold=2, ejection_time=60, health_check_interval=0)
+        a, b = pool.endpoints
+        # 4xx 与副本无关，不计为失败
+        for _ in range(3):
+            self.fail(pool, a.url, 400)
+        self.assertEqual(a.failures, 0)
+        self.fail(pool, a.url, 503)
+        self.assertFalse(a.ejected)
+        self.fail(pool, a.url, 503)
+        self.assertTrue(a.ejected)
+        self.assertEqual(a.stats()['ejections'], 1)
+        self.assertEqual({pool.choose().url for _ in range(20)}, {b.url})
+        # 摘除到期后（没有主动健康检查）直接恢复
+        a.ejected_until = time.monotonic() - 1
+        pool.choose()
+        self.assertFalse(a.ejected)
+        self.assertEqual(a.failures, 0)
+
+    def test_all_ejected_falls_back_to_earliest(self):
+        pool = EndpointPool(self.urls, failure_threshold=1, ejection_time=60, health_check_interval=0)
+        self.fail(pool, self.urls[1], 503)
+        self.fail(pool, self.urls[0], 503)
+        self.assertEqual(pool.choose().url, self.urls[1])
+        # 摘除期间成功的请求说明副本已恢复
+        with pool.route():
+            pass
+        self.assertFalse(pool.endpoints[1].ejected)
+
+    def test_prefers_less_loaded_endpoint(self):
+        pool = EndpointPool(self.urls, health_check_interval=0)
+        a, b = pool.endpoints
+        a.latency_ewma, b.latency_ewma = 1.0, 0.5
+        self.assertEqual({pool.choose().url for _ in range(20)}, {b.url})
+        b.outstanding = 2
+        self.assertEqual({pool.choose().url for _ in range(20)}, {a.url})
+
+    def test_health_check(self):
+        client = mock.Mock()
+        client.get.side_effect = lambda url, timeout: mock.Mock(status_code=503 if url.startswith('http://a') else 200)
+        pool = EndpointPool(self.urls, ejection_time=0, client=client)
+        pool.check()
+        self.assertEqual([endpoint.ejected for endpoint in pool.endpoints], [True, False])
+        self.assertEqual(client.get.call_args_list[0], mock.call('http://a/v1/models', timeout=2.0))
+        client.get.side_effect = lambda url, timeout: mock.Mock(status_code=200)
+        pool.check()
+        self.assertEqual([endpoint.ejected for endpoint in pool.endpoints], [False, False])
+        self.assertEqual(health_url('http://a/v1'), 'http://a/v1/models')
+
+
+class MockServerTestCase(SimpleTestCase):
+    """
+    在本机随机端口启动模拟模型服务，首字节耗时为 0
+    """
+
+    def server(self, **kwargs):
+        kwargs.setdefault('latency', LatencyModel('fixed', mean=0.0))
+        kwargs.setdefault('corrector', MockCorrector({'万': '玩'}))
+        server = start_mock_server(**kwargs)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    @staticmethod
+    def url(server):
+        return 'http://%s:%d/v1/chat/completions' % server.server_address
+
+
+class MockServerTests(MockServerTestCase):
+
+    def post(self, server, content, **kwargs):
+        return requests.post(self.url(server), json={'messages': [{'role': 'user', 'content': content}], **kwargs})
+
+    def test_reply(self):
+        corrector = MockCorrector({'万': '玩'})
+        # 去掉纠错 prompt 和 RAG 上下文
+        self.assertEqual(extract_input('纠错要求……如果没有帮助请忽略。\n我想出去万。'), '我想出去万。')
+        self.assertEqual(extract_input('<context>万</context>\n## 请修改以下内容：我想出去万。\n'), '我想出去万。')
+        self.assertEqual(corrector.reply('如果没有帮助请忽略。\n我想出去万。'), '我想出去玩。')
+        # 多句合并请求按 JSON 数组返回
+        self.assertEqual(json.loads(corrector.reply('如果没有帮助请忽略。\n["我想出去万。", "一万元。"]')),
+                         ['我想出去玩。', '一玩元。'])
+        with self.assertRaises(ValueError):
+            LatencyModel('poisson')
+
+    def test_completions_and_stream(self):
+        server = self.server()
+        response = self.post(server, '我想出去万。')
+        self.assertEqual(response.json()['choices'][0]['message']['content'], '我想出去玩。')
+        with self.post(server, '我想出去万。', stream=True) as response:
+            self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+            events = [line[len(b'data: '):].decode('utf-8') for line in response.iter_lines()
+                      if line.startswith(b'data: ')]
+        self.assertEqual(events[-1], '[DONE]')
+        self.assertEqual(''.join(json.loads(event)['choices'][0]['delta']['content'] for event in events[:-1]),
+                         '我想出去玩。')
+        models = requests.get('http://%s:%d/v1/models' % server.server_address).json()
+        self.assertEqual(models['data'][0]['id'], 'mock')
+
+    def test_errors(self):
+        server = self.server(error_rate=1.0, error_codes=(503,))
+        self.assertEqual(self.post(server, '我想出去万。').status_code, 503)
+        self.assertEqual(requests.post(self.url(server), data='不是 JSON').status_code, 400)
+        self.assertEqual(server.stats(), {'requests': 1, 'errors': 1, 'timeouts': 0, 'in_flight': 0})
+
+
+class LoadTestTests(SimpleTestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, q) for q in (0, 50, 95, 99, 100)], [1, 50, 95, 99, 100])
+        self.assertEqual(percentile([3.0], 99), 3.0)
+        self.assertIsNone(percentile([], 50))
+
+    def test_classify(self):
+        self.assertEqual(LoadTester.classify(503, ''), 'http_503')
+        self.assertEqual(LoadTester.classify(200, '<html>'), 'invalid_json')
+        self.assertEqual(LoadTester.classify(200, '{"error": "出错"}'), 'app_error')
+        self.assertEqual(LoadTester.classify(200, '{"status": "排队中"}'), 'queued')
+        self.assertEqual(LoadTester.classify(200, '{"status": "未检测"}'), 'degraded')
+        self.assertEqual(LoadTester.classify(200, '{"status": "已完成"}'), 'ok')
+
+
+class HttpClientTests(MockServerTestCase):
+
+    def payload(self, text):
+        return {'model': 'mock', 'messages': [{'role': 'user', 'content': text}]}
+
+    def test_connections_are_kept_alive(self):
+        server = self.server()
+        client = LLMHttpClient(pool_size=2)
+        for _ in range(5):
+            response = client.post(self.url(server), json=self.payload('我想出去万。'))
+            self.assertEqual(response.json()['choices'][0]['message']['content'], '我想出去玩。')
+        pools = client.pool_stats()
+        self.assertEqual([pool['connections_created'] for pool in pools.values()], [1])
+        self.assertEqual(client.stats()['status_counts'], {'200': 5})
+
+    def test_server_errors_are_retried_with_backoff(self):
+        server = self.server(error_rate=1.0, error_codes=(503,))
+        client = LLMHttpClient(max_retries=2, backoff_base=0.001, backoff_max=0.001)
+        self.assertEqual(client.post(self.url(server), json=self.payload('甲')).status_code, 503)
+        self.assertEqual((server.requests, client.retries, client.failures), (3, 2, 1))
+        # 在多个副本间重试的调用方自行重试
+        client.post(self.url(server), max_retries=0, json=self.payload('甲'))
+        self.assertEqual(server.requests, 4)
+
+    def test_connection_errors_are_retried(self):
+        server = self.server()
+        url = self.url(server)
+        server.shutdown()
+        server.server_close()
+        client = LLMHttpClient(max_retries=1, backoff_base=0.001, backoff_max=0.001)
+        with self.assertRaises(requests.ConnectionError):
+            client.post(url, json=self.payload('甲'))
+        self.assertEqual((client.requests, client.retries, client.failures), (2, 1, 1))
+
+
+class AsyncChatCompletionTests(MockServerTestCase):
+
+    def test_concurrent_requests_wait_concurrently(self):
+        server = self.server(latency=LatencyModel('fixed', mean=0.2))
+        chat = AsyncChatCompletion(url=self.url(server))
+        chat.client = AsyncLLMHttpClient()
+        chat.guard = BackendGuard(AdaptiveLimiter(initial=16), CircuitBreaker(failure_threshold=100))
+
+        async def run():
+            started = time.monotonic()
+            results = await asyncio.gather(*(chat.get_response('我想出去万%d。' % number) for number in range(8)))
+            elapsed = time.monotonic() - started
+            await chat.client.aclose()
+            return results, elapsed
+
+        results, elapsed = asyncio.run(run())
+        self.assertEqual(results, ['我想出去玩%d。' % number for number in range(8)])
+        # 8 个请求并发等待，而不是依次等待 0.2 秒
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(chat.client.stats()['requests'], 8)
+
+
+class CharEmbeddings(Embeddings):
+    """
+    代替 HuggingFaceEmbeddings：按字符哈希计数的 32 维向量，相同字符多的文本距离近
+    """
+
+    def __init__(self, model_name=None, **kwargs):
+        self.calls = 0
+
+    def _vector(self, text):
+        vector = np.zeros(32, dtype=np.float32)
+        for char in text:
+            vector[int(hashlib.md5(char.encode()).hexdigest(), 16) % 32] += 1
+        return (vector / (np.linalg.norm(vector) + 1e-9)).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += len(texts)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        return self._vector(text)
+
+
+@skipIf(RAGprompt is None, '未安装 RAG 依赖')
+class BatchingEmbeddingsTests(SimpleTestCase):
+
+    def embed_concurrently(self, embedding, texts):
+        barrier = threading.Barrier(len(texts))
+        results = {}
+
+        def run(text):
+            barrier.wait()
+            try:
+                results[text] = embedding.embed_query(text)
+            except Exception as e:
+                results[text] = e
+
+        threads = [threading.Thread(target=run, args=(text,)) for text in texts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_queries_share_one_forward_pass(self):
+        model = CharEmbeddings()
+        embedding = BatchingEmbeddings(model, window_ms=200, max_batch_size=32)
+        texts = ['查询%d' % number for number in range(8)]
+        results = self.embed_concurrently(embedding, texts)
+        # 每个调用方拿到自己的向量
+        self.assertEqual(results, {text: model._vector(text) for text in texts})
+        self.assertEqual(embedding.stats()['batches'], 1)
+        self.assertEqual(embedding.stats()['max_batch_size'], 8)
+
+    def test_batch_error_is_raised_to_every_caller(self):
+        model = CharEmbeddings()
+        model.embed_documents = mock.Mock(side_effect=RuntimeError('模型出错'))
+        results = self.embed_concurrently(BatchingEmbeddings(model, window_ms=200), ['甲', '乙'])
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results.values()))
+
+
+PDF_PARAGRAPHS = ['涡轮风扇发动机通过压气机和燃烧室产生推力。', '推力推动飞机前进并提高效率。',
+                  '涵道比越大推进效率越高。', '燃烧室把燃油的化学能转化为热能。']
+
+
+@skipIf(RAGprompt is None, '未安装 RAG 依赖')
+class RAGTestCase(SimpleTestCase):
+    """
+    用小的 DOCX 知识源构建真实的 RAGPromptEnhancer，嵌入模型换成 CharEmbeddings
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.source = os.path.join(self.directory, 'source.docx')
+        content = docx.Document()
+        for paragraph in PDF_PARAGRAPHS:
+            content.add_paragraph(paragraph)
+        content.save(self.source)
+        patcher = mock.patch.object(RAGprompt, 'HuggingFaceEmbeddings', CharEmbeddings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def enhancer(self, **kwargs):
+        kwargs.setdefault('index_dir', os.path.join(self.directory, 'index'))
+        kwargs.setdefault('embed_batch_window_ms', 0)
+        return RAGprompt.RAGPromptEnhancer(self.source, os.path.join(self.directory, 'model'), ingest_workers=1,
+                                           **kwargs)
+
+
+class IngestionPipelineTests(RAGTestCase):
+
+    def sources(self):
+        directory = os.path.join(self.directory, 'sources')
+        os.makedirs(os.path.join(directory, 'b'))
+        for name, paragraphs in (('b/2.docx', ['第三段。', '第四段。']), ('1.docx', ['第一段。', '', '第二段。'])):
+            content = docx.Document()
+            for paragraph in paragraphs:
+                content.add_paragraph(paragraph)
+            content.save(os.path.join(directory, name))
+        with open(os.path.join(directory, 'notes.txt'), 'w') as f:
+            f.write('不是知识源')
+        return directory
+
+    def pipeline(self, embedding=None, **kwargs):
+        return IngestionPipeline(embedding or CharEmbeddings(), ['\n', '。'], 40, 0, batch_size=3, **kwargs)
+
+    def test_chunks_keep_source_order(self):
+        directory = self.sources()
+        paths = expand_sources(directory)
+        self.assertEqual(paths, [os.path.join(directory, '1.docx'), os.path.join(directory, 'b', '2.docx')])
+        reports = []
+        for workers in (1, 2):
+            texts, metadatas, vectors = self.pipeline(workers=workers, progress=lambda stats: reports.append(
+                stats.as_dict())).run(paths)
+            self.assertEqual(texts, ['第一段。', '第二段。', '第三段。', '第四段。'])
+            self.assertEqual([metadata['paragraph'] for metadata in metadatas], [0, 2, 0, 1])
+            self.assertEqual(vectors.shape, (4, 32))
+        self.assertEqual(reports[-1]['tasks'], '2/2')
+        self.assertEqual(reports[-1]['embedded'], 4)
+
+    def test_embedding_errors_and_empty_sources(self):
+        paths = expand_sources(self.sources())
+        embedding = CharEmbeddings()
+        embedding.embed_documents = mock.Mock(side_effect=RuntimeError('模型出错'))
+        with self.assertRaises(RuntimeError):
+            self.pipeline(embedding, workers=1).run(paths)
+        empty = os.path.join(self.directory, 'empty.docx')
+        docx.Document().save(empty)
+        with self.assertRaises(ValueError):
+            self.pipeline(workers=1).run([empty])
+
+
+class EnhancerRegistryTests(RAGTestCase):
+
+    def test_enhancer_is_built_once_and_rebuilt_when_source_changes(self):
+        enhancers = registry.EnhancerRegistry(self.source, os.path.join(self.directory, 'model'), check_interval=0,
+                                              embed_batch_window_ms=0, ingest_workers=1)
+        first = enhancers.get()
+        self.assertIs(enhancers.get(), first)
+        self.assertEqual(enhancers.status()['state'], 'ready')
+
+        content = docx.Document()
+        content.add_paragraph('新的知识源内容。')
+        content.save(self.source)
+        os.utime(self.source, ns=(0, os.stat(self.source).st_mtime_ns + 10 ** 9))
+        second = enhancers.get()
+        self.assertIsNot(second, first)
+        self.assertNotEqual(second.index_key, first.index_key)
+        self.assertIs(enhancers.get(), second)
+
+    def test_old_enhancer_is_served_while_rebuilding(self):
+        enhancers = registry.EnhancerRegistry(self.source, os.path.join(self.directory, 'model'), check_interval=0,
+                                              embed_batch_window_ms=0, ingest_workers=1)
+        first = enhancers.get()
+        os.utime(self.source, ns=(0, os.stat(self.source).st_mtime_ns + 10 ** 9))
+        with enhancers._build_lock:
+            # 另一个线程正在重建
+            self.assertIs(enhancers.get(), first)
+
+
+class IndexPersistenceTests(RAGTestCase):
+
+    def test_saved_index_is_memory_mapped(self):
+        built = self.enhancer()
+        with mock.patch.object(RAGprompt.IngestionPipeline, 'run', side_effect=AssertionError), \
+                mock.patch.object(RAGprompt.faiss, 'read_index', wraps=RAGprompt.faiss.read_index) as read_index:
+            loaded = self.enhancer()
+        # IO_FLAG_MMAP 会把向量复制到进程内存中，只有 IO_FLAG_MMAP_IFC 直接使用映射的文件
+        self.assertTrue(read_index.call_args[0][1] & RAGprompt.faiss.IO_FLAG_MMAP_IFC)
+        self.assertIsInstance(loaded.chunks._data, np.memmap)
+        self.assertEqual([loaded._doc(position).page_content for position in range(len(loaded.chunks))],
+                         [built._doc(position).page_content for position in range(len(built.chunks))])
+        self.assertEqual(loaded.retrieve('涵道比和推进效率')[0].page_content, '涵道比越大推进效率越高。')
+
+    def test_index_key_follows_source_and_settings(self):
+        key = self.enhancer().index_key
+        self.assertEqual(self.enhancer().index_key, key)
+        self.assertNotEqual(self.enhancer(chunk_size=20).index_key, key)
+        content = docx.Document()
+        content.add_paragraph('新的知识源内容。')
+        content.save(self.source)
+        changed = self.enhancer()
+        self.assertNotEqual(changed.index_key, key)
+        self.assertEqual(changed.retrieve('知识源')[0].page_content, '新的知识源内容。')
+
+    def test_unsaved_index_is_searched_in_memory(self):
+        enhancer = self.enhancer(index_dir=None)
+        self.assertEqual(enhancer.retrieve('涵道比和推进效率')[0].page_content, '涵道比越大推进效率越高。')
+
+
+class KnowledgeIndexTests(RAGTestCase):
+
+    def index(self, **kwargs):
+        return KnowledgeIndex(CharEmbeddings(), RAGprompt.RecursiveCharacterTextSplitter(chunk_size=40, chunk_overlap=0),
+                              index_file=os.path.join(self.directory, 'knowledge', 'alice.pkl'), **kwargs)
+
+    def contents(self, index, query='贾宝玉是谁的孙子'):
+        return [doc.page_content for doc, score in index.search(CharEmbeddings().embed_query(query), k=10)]
+
+    def test_removed_document_is_tombstoned_then_compacted(self):
+        index = self.index(compact_ratio=0.9)
+        index.add_document(1, '贾宝玉是贾母的孙子。')
+        index.add_document(2, '林黛玉是贾母的外孙女。')
+        index.remove_document(1)
+        # 只记录墓碑，向量仍在索引中
+        self.assertEqual(index.vector_store.index.ntotal, 2)
+        self.assertEqual(len(index), 1)
+        self.assertNotIn('贾宝玉是贾母的孙子。', self.contents(index))
+        index.compact()
+        self.assertEqual(index.vector_store.index.ntotal, 1)
+        self.assertEqual(self.contents(index), ['林黛玉是贾母的外孙女。'])
+
+    def test_tombstones_over_ratio_compact_automatically(self):
+        index = self.index(compact_ratio=0.5)
+        index.add_document(1, '贾宝玉是贾母的孙子。')
+        index.add_document(2, '林黛玉是贾母的外孙女。')
+        index.remove_document(1)
+        self.assertEqual(index.vector_store.index.ntotal, 1)
+        self.assertEqual(index.tombstones, set())
+
+    def test_reupload_replaces_chunks_and_other_processes_reload(self):
+        index = self.index(compact_ratio=0.9)
+        index.add_document(1, '贾宝玉是贾母的孙子。')
+        index.add_document(1, '贾宝玉是贾政的儿子。')
+        self.assertEqual(self.contents(index), ['贾宝玉是贾政的儿子。'])
+        # 另一个工作进程从文件加载同一个分区
+        self.assertEqual(self.contents(self.index()), ['贾宝玉是贾政的儿子。'])
+
+
+@skipIf(RAGprompt is None, '未安装 RAG 依赖')
+class LexicalTests(SimpleTestCase):
+
+    def test_bm25_ranks_chunks_sharing_rare_terms_first(self):
+        index = BM25Index(PDF_PARAGRAPHS)
+        self.assertEqual(index.search('涵道比', k=1)[0][0], 2)
+        positions = [position for position, score in index.search('燃烧室的推力')]
+        self.assertEqual(set(positions[:2]), {0, 3})
+        self.assertEqual(index.search('，。'), [])
+        self.assertEqual(index.search('贾宝玉'), [])
+
+    def test_reciprocal_rank_fusion(self):
+        fused = reciprocal_rank_fusion([['a', 'b', 'c'], ['b', 'd'], []])
+        # 两路都排在前面的 b 排第一，只出现在一路的按名次排列
+        self.assertEqual([key for key, score in fused], ['b', 'a', 'd', 'c'])
+        self.assertAlmostEqual(fused[0][1], 1 / 62 + 1 / 61)
+
+
+class KnowledgeRetrievalTests(RAGTestCase):
+
+    def test_lexical_mode_returns_owner_knowledge(self):
+        enhancer = self.enhancer(retrieval_mode='lexical', top_k=2)
+        enhancer.knowledge.add_document('alice', 1, '贾宝玉是贾母的孙子。')
+        contents = [doc.page_content for doc in enhancer.retrieve('贾宝玉是谁的孙子', owner='alice')]
+        self.assertIn('贾宝玉是贾母的孙子。', contents)
+        # 其他用户看不到 alice 的知识库
+        contents = [doc.page_content for doc in enhancer.retrieve('贾宝玉是谁的孙子', owner='bob')]
+        self.assertNotIn('贾宝玉是贾母的孙子。', contents)
+
+    def test_hybrid_mode_fuses_knowledge_lexical_hits(self):
+        enhancer = self.enhancer(retrieval_mode='hybrid', top_k=2)
+        enhancer.knowledge.add_document('alice', 1, '贾宝玉是贾母的孙子。')
+        contents = [doc.page_content for doc in enhancer.retrieve('贾宝玉是谁的孙子', owner='alice')]
+        self.assertEqual(contents[0], '贾宝玉是贾母的孙子。')
+
+    def test_deleted_knowledge_is_not_returned_by_bm25(self):
+        enhancer = self.enhancer(retrieval_mode='lexical', top_k=2)
+        enhancer.knowledge.add_document('alice', 1, '贾宝玉是贾母的孙子。')
+        enhancer.knowledge.remove_document('alice', 1)
+        contents = [doc.page_content for doc in enhancer.retrieve('贾宝玉是谁的孙子', owner='alice')]
+        self.assertNotIn('贾宝玉是贾母的孙子。', contents)
+
+
+class RetrievalCacheTests(SimpleTestCase):
+
+    def test_hit_after_normalization_and_counters(self):
+        cache = RetrievalCache(max_size=4, ttl=0)
+        self.assertIsNone(cache.get('今天 天气', 1))
+        cache.put('今天 天气', 1, ['文档'])
+        # 全半角和连续空白规范化后是同一个键
+        self.assertEqual(cache.get(' 今天\u3000 天气 ', 1), ['文档'])
+        self.assertIsNone(cache.get('今天 天气', 1, namespace='bob'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (1, 2, 1 / 3))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = RetrievalCache(max_size=2, ttl=0)
+        cache.put('甲', 1, 'a')
+        cache.put('乙', 1, 'b')
+        cache.get('甲', 1)
+        cache.put('丙', 1, 'c')
+        self.assertIsNone(cache.get('乙', 1))
+        self.assertEqual((cache.get('甲', 1), cache.get('丙', 1)), ('a', 'c'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expired_and_stale_entries_miss(self):
+        cache = RetrievalCache(max_size=4, ttl=10)
+        with mock.patch('llm.RAG.cache.time.monotonic', return_value=100.0):
+            cache.put('甲', 1, 'a')
+            cache.put('乙', 1, 'b')
+        with mock.patch('llm.RAG.cache.time.monotonic', return_value=111.0):
+            self.assertIsNone(cache.get('甲', 1))
+        self.assertIsNone(cache.get('乙', 2))
+        stats = cache.stats()
+        self.assertEqual((stats['expirations'], stats['invalidations'], stats['size']), (1, 1, 0))
+
+
+class KnowledgePoolTests(RAGTestCase):
+
+    def test_partitions_over_budget_are_evicted_and_reloaded(self):
+        pool = KnowledgePool(CharEmbeddings(), RAGprompt.RecursiveCharacterTextSplitter(chunk_size=40, chunk_overlap=0),
+                             index_dir=os.path.join(self.directory, 'knowledge'), memory_budget=1)
+        pool.add_document('alice', 1, '贾宝玉是贾母的孙子。')
+        version = pool.version('alice')
+        pool.add_document('bob', 1, '林黛玉是贾母的外孙女。')
+        # 超出预算，最久未使用的 alice 被淘汰，正在写入的 bob 保留
+        self.assertEqual(pool.stats()['loaded_partitions'], 1)
+        self.assertEqual(pool.evictions, 1)
+        self.assertEqual(pool.version('alice'), version)
+
+        query = CharEmbeddings().embed_query('贾宝玉')
+        self.assertEqual([doc.page_content for doc, score in pool.search('alice', query)], ['贾宝玉是贾母的孙子。'])
+        self.assertEqual(pool.loads, 3)
+        # 各用户只检索自己的分区
+        self.assertEqual([doc.page_content for doc, score in pool.search('bob', query)], ['林黛玉是贾母的外孙女。'])
+        self.assertEqual(pool.search('carol', query), [])
+        # 重新加载后版本号继续递增
+        pool.add_document('alice', 2, '贾母是贾政的母亲。')
+        self.assertGreater(pool.version('alice'), version)
+
+
+class RetrievalCacheVersionTests(RAGTestCase):
+
+    def test_other_users_uploads_keep_cached_retrievals(self):
+        enhancer = self.enhancer()
+        enhancer.knowledge.add_document('alice', 1, '贾宝玉是贾母的孙子。')
+        enhancer.retrieve('发动机的推力', owner='bob')
+        enhancer.retrieve('发动机的推力', owner='alice')
+        enhancer.knowledge.add_document('alice', 2, '林黛玉是贾母的外孙女。')
+        hits = enhancer.cache.hits
+        enhancer.retrieve('发动机的推力', owner='bob')
+        self.assertEqual(enhancer.cache.hits, hits + 1)
+        # alice 自己的知识库变化，她的缓存失效
+        enhancer.retrieve('发动机的推力', owner='alice')
+        self.assertEqual(enhancer.cache.hits, hits + 1)
+        self.assertEqual(enhancer.cache.invalidations, 1)
+
+    def test_partition_version_survives_eviction(self):
+        enhancer = self.enhancer(knowledge_memory_budget_mb=0)
+        enhancer.knowledge.add_document('alice', 1, '贾宝玉是贾母的孙子。')
+        version = enhancer.knowledge.version('alice')
+        # 预算为 0，加载 bob 的分区时淘汰 alice 的分区
+        enhancer.knowledge.add_document('bob', 1, '薛宝钗是薛姨妈的女儿。')
+        self.assertEqual(enhancer.knowledge.stats()['loaded_partitions'], 1)
+        self.assertEqual(enhancer.knowledge.version('alice'), version)
+        enhancer.knowledge.refresh('alice')
+        self.assertGreater(enhancer.knowledge.version('alice'), version)
+        self.assertEqual(enhancer.knowledge.version(None), 0)
+
+
+@skipIf(RAGprompt is None, '未安装 RAG 依赖')
+class IndexTypeTests(SimpleTestCase):
+    vectors = np.random.default_rng(0).random((2000, 32), dtype=np.float32)
+
+    def test_compressed_indexes_are_smaller_and_find_exact_matches(self):
+        flat = build_faiss_index(self.vectors, 'flat')
+        for index_type in ('ivf_flat', 'ivf_pq', 'sq8'):
+            index = build_faiss_index(self.vectors, index_type, nlist=16, pq_m=8, pq_nbits=4, nprobe=16)
+            distances, positions = index.search(self.vectors[:20], 1)
+            self.assertGreaterEqual((positions[:, 0] == np.arange(20)).mean(), 0.9, index_type)
+            if index_type != 'ivf_flat':
+                self.assertLess(index_memory_bytes(index), index_memory_bytes(flat) / 2, index_type)
+
+    def test_nprobe_is_clipped_to_nlist(self):
+        index = build_faiss_index(self.vectors, 'ivf_flat', nlist=8, nprobe=100)
+        self.assertEqual(index.nprobe, 8)
+
+    def test_unknown_index_type(self):
+        with self.assertRaises(ValueError):
+            build_faiss_index(self.vectors, 'hnsw')
+
+
+class IndexReportTests(SimpleTestCase):
+
+    def test_report_labels_flat_fallback(self):
+        vectors = np.random.default_rng(0).random((500, 32), dtype=np.float32)
+        enhancer = mock.Mock(load_vectors=mock.Mock(return_value=vectors))
+        output = io.StringIO()
+        with mock.patch('index.management.commands.rag_index_report.get_enhancer', return_value=enhancer):
+            call_command('rag_index_report', types='ivf_flat,ivf_pq', nlist=4, pq_m=8, nprobe='1', queries=20,
+                         stdout=output)
+        lines = {line.split()[0]: line for line in output.getvalue().splitlines() if line.startswith('ivf')}
+        self.assertIn('IndexIVFFlat', lines['ivf_flat'])
+        self.assertNotIn('退化', lines['ivf_flat'])
+        # 500 个样本不足以训练 ivf_pq
+        self.assertIn('IndexFlatL2（样本不足，已退化为 flat）', lines['ivf_pq'])
@@ -14,16 +14,23 @@ urlpatterns = [
     path('wbgl',views.wbgl), # 跳转文本管理页面
     path('get_wb',views.get_wb), # 获取文本
     path('del_wb',views.del_wb), # 删除文本
-    path('correct_text',views.correct_textv2), # 纠错文本
+    path('correct_text',views.correct_textv2_async), # 纠错文本（异步，ASGI 下不占用工作线程）
+    path('correct_text_stream', views.correct_text_stream), # 流式纠错文本（SSE）
     # path('correct_textv2', views.correct_textv2),  # RAG增强，纠错文本
+    path('rag_status', views.rag_status), # RAG向量库加载状态
+    path('llm_status', views.llm_status), # 大模型客户端连接池状态
+    path('llm_metrics', views.llm_metrics), # 大模型并发限制和熔断器状态
 
     # 文档模块
     path('wdjc',views.wdjc), # 跳转文档纠错页面
     path('wdgl',views.wdgl), # 跳转文档分页页面
     path('get_wd',views.get_wdv1), # 文档分页功能
     path('del_doc',views.del_doc), # 删除文档
-    path('correct_doc', views.correct_doc), # 纠错文档
-    path('get_result/<doc_id>',views.getdoccorrectresult), # 根据文档ID获取纠错结果
+    path('correct_doc', views.correct_doc_submit), # 提交文档纠错任务，后台纠错，通过 get_result 轮询
+    path('correct_doc_sync', views.correct_doc_async), # 纠错文档（异步视图，请求内完成纠错）
+    path('correct_doc_stream', views.correct_doc_stream), # 流式纠错文档（SSE，按段落推送标记结果）
+    path('get_result/<doc_id>',views.getdoccorrectresult), # 根据文档ID获取纠错结果和标记文本
+    path('get_text_result/<text_id>', views.gettextcorrectresult), # 根据文本ID获取纠错结果和标记文本
     path('get_knowledge',views.get_knowledge), # 文档分页功能
     path('upload_knowledge',views.upload_knowledge), # 跳转文档分页页面
 ]
@@ -1,17 +1,31 @@
+from asgiref.sync import sync_to_async
 from django.core.paginator import Paginator
 from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
 
-from llm.RAG.RAGprompt import RAGPromptEnhancer
-from llm.TextHighlighter import TextHighlighter
+from llm.RAG.registry import get_enhancer, get_registry, submit_knowledge_document, submit_knowledge_removal
+from llm.TextHighlighter import IncrementalHighlighter, ParagraphHighlighter, TextHighlighter, render_ops
+from llm.batching import get_batcher
+from llm.client import get_async_client, get_client
+from llm.correction import DocumentCorrector
+from llm.correction_cache import get_correction_cache
+from llm.detector import get_detector
+from llm.endpoints import get_endpoint_pool
+from llm.limiter import LLMUnavailable, get_guard
 from llm.qwen import ChatCompletion
+from llm.singleflight import flight_key, get_async_singleflight, get_singleflight
 from user.models import User
+from .fallback import correct_or_fallback, correct_or_fallback_async, correction_status, fallback_enabled, \
+    unavailable_response
+from .jobs import DONE, UNFINISHED_STATUSES, job_progress, queue_stats, submit_document
 from .models import *
+from .streaming import event_stream_response, thread_stream
 import os
 
 workdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 import datetime
 import docx
+import json
 
 
 def day_get():
@@ -129,6 +143,7 @@ def get_wb(request):
                 "id": res.id, # 文本id
                 "src": res.src, # 原文
                 "dest": res.dest, # 更正后的文本
+                "highlighted": record_highlight(res), # 标记后的更正文本
                 "status": res.status, # 状态
                 "owner": res.owner, # 用户
                 'create_time': res.create_time.strftime('%Y-%m-%d %H:%m:%S'), # 创建时间
@@ -192,7 +207,14 @@ def del_doc(request):
         if not result:
             response_data = {'error': '删除失败！', 'message': '找不到id为%s' % doc_id}
             return JsonResponse(response_data, status=403)
+        is_knowledge = result.status == '知识库'
         result.delete()
+        # 未完成的纠错任务和逐段纠错结果随文档一起删除
+        CorrectionJob.objects.filter(document_id=doc_id).delete()
+        DocumentParagraph.objects.filter(document_id=doc_id).delete()
+        if is_knowledge:
+            # 知识库文档：后台将其向量标记为删除
+            submit_knowledge_removal(result.owner, int(doc_id))
         response_data = {'message': '删除成功！'}
         return JsonResponse(response_data, status=201)
     except Exception as e:
@@ -264,6 +286,7 @@ def get_wdv1(request):
                 "name": res.name,
                 "src": res.src,
                 "dest": res.dest,
+                "highlighted": record_highlight(res),
                 "owner": res.owner,
                 "status": res.status,
                 'create_time': res.create_time.strftime('%Y-%m-%d %H:%m:%S'),
@@ -297,6 +320,7 @@ def get_wdv2(request):
                 "name": res.name,
                 "src": res.src,
                 "dest": res.dest,
+                "highlighted": record_highlight(res),
                 "owner": res.owner,
                 "status": res.status,
                 'create_time': res.create_time.strftime('%Y-%m-%d %H:%m:%S'),
@@ -316,44 +340,71 @@ def correct_doc(request):
     for paragraph in doc_content.paragraphs:
         text += paragraph.text + "\n"
 
+    # 相同的文档同时只请求一次大模型
     chat = ChatCompletion()
-    result = chat.get_response(text)
+    try:
+        result, status = correct_or_fallback(
+            text, lambda: get_singleflight().do(flight_key('correct_doc', text), lambda: chat.get_response(text)))
+    except LLMUnavailable as e:
+        # 模型服务熔断或繁忙且不降级：快速失败
+        return unavailable_response(e)
 
     highlighter = TextHighlighter(text, result)
     highlighted_text = highlighter.highlight_differences()
 
-    if text == result:
-        status='无错误'
-    else:
-        status='有错误'
-
     Document.objects.create(name=doc.name,
                        src=text,
                        dest=result,
                        status=status,
+                       ops=highlighter.ops(),
                        owner=request.session.get('username', 'admin'),
                        )
     return JsonResponse({"result": highlighted_text, 'status': status, 'error': 0})
 
+def correct_doc_submit(request):
+    """
+    提交文档纠错任务：保存文档后立即返回文档 ID，状态为排队中，由 correction_worker 命令启动的工作进程在后台纠错，
+    前端通过 get_result/<doc_id> 轮询进度和结果。大文档不会因为请求耗时过长被反向代理断开，也不占用 Web 工作进程。
+    重新上传修改过的文档时，未修改的段落复用之前的纠错结果，返回复用和重新纠错的段落数。
+    """
+    if request.method == 'POST':
+        doc = request.FILES.get('document')
+    doc_content = docx.Document(doc)
+
+    text = ""
+    for paragraph in doc_content.paragraphs:
+        text += paragraph.text + "\n"
+
+    try:
+        priority = int(request.POST.get('priority', 0))
+    except ValueError:
+        priority = 0
+    owner = request.session.get('username', 'admin')
+    document, job = submit_document(doc.name, text, owner, priority)
+    return JsonResponse({'id': document.id, 'job_id': job.id, 'status': job.status,
+                         'reused': job.reused, 'recomputed': job.recomputed, 'error': 0})
+
 def correct_text(request):
     text = request.POST.get('text')
     #text = 这理风景绣丽，而且天汽不错，我的心情各外舒畅!
 
+    # 相同的文本同时只请求一次大模型
     chat = ChatCompletion()
-    result = chat.get_response(text)
+    try:
+        result, status = correct_or_fallback(
+            text, lambda: get_singleflight().do(flight_key('correct_text', text), lambda: chat.get_response(text)))
+    except LLMUnavailable as e:
+        # 模型服务熔断或繁忙且不降级：快速失败
+        return unavailable_response(e)
 
     highlighter = TextHighlighter(text, result)
     highlighted_text = highlighter.highlight_differences()
 
-    if text ==result:
-        status = '无错误'
-    else:
-        status = '有错误'
-
     Text.objects.create(
                        src=text,
                        dest=result,
                        status=status,
+                       ops=highlighter.ops(),
                        owner=request.session.get('username', 'admin'),
                        )
 
@@ -363,41 +414,298 @@ def correct_textv2(request):
     text = request.POST.get('text')
     #text = 涡伦风扇发动机通过压起机和燃烧室产生推力，推动飞机前进并提高效率，大大提高比腿力。
 
-    # RAG增强
-    # 用于增强的文本
-    pdf_path = "C:\\Users\\18817\\Desktop\\text_error_correction\\llm\\RAG\\RAGResources\\RAG.pdf"
-    # 分词模型
-    model_path = "C:\\Users\\18817\\Desktop\\text_error_correction\\llm\\RAG\\EmbeddingModels\\m3e-base"
-    # 创建 RAGPromptEnhancer 实例
-    enhancer = RAGPromptEnhancer(pdf_path, model_path)
-    # 增强的文本
-    enhanced_text = enhancer.enhance_prompt(text)
-
-    # 大模型更正
-    chat = ChatCompletion()
-    result = chat.get_response(enhanced_text)
+    owner = request.session.get('username', 'admin')
+
+    def compute():
+        # RAG增强
+        # 获取进程内共享的 RAGPromptEnhancer 实例（只加载一次，源文件变化时重建）
+        enhancer = get_enhancer()
+        # 增强的文本
+        enhanced_text = enhancer.enhance_prompt(text, owner=owner)
+
+        # 大模型更正
+        chat = ChatCompletion()
+        return chat.get_response(enhanced_text)
+
+    # 同一用户相同的文本同时只检索、请求一次（知识库按用户划分，用户名参与请求键）
+    try:
+        result, status = correct_or_fallback(
+            text, lambda: get_singleflight().do(flight_key('correct_textv2', owner, text), compute))
+    except LLMUnavailable as e:
+        # 模型服务熔断或繁忙且不降级：快速失败
+        return unavailable_response(e)
 
     highlighter = TextHighlighter(text, result)
     highlighted_text = highlighter.highlight_differences()
 
-    if text ==result:
-        status = '无错误'
-    else:
-        status = '有错误'
-
     Text.objects.create(
                        src=text,
                        dest=result,
                        status=status,
-                       owner=request.session.get('username', 'admin'),
+                       ops=highlighter.ops(),
+                       owner=owner,
+                       )
+
+    return JsonResponse({"result": highlighted_text, 'status': status, 'error': 0})
+
+async def parse_body(request):
+    """
+    在线程池中解析请求体：multipart 上传会读取请求体并写临时文件，不能在事件循环中进行
+    :return: (request.POST, request.FILES)
+    """
+    return await sync_to_async(lambda: (request.POST, request.FILES), thread_sensitive=False)()
+
+async def correct_doc_async(request):
+    """
+    correct_doc 的异步版本：文档拆成 token 预算以内的块并发纠错，等待大模型响应时不占用工作线程，
+    数据库写入放到线程池中执行
+    """
+    if request.method == 'POST':
+        post, files = await parse_body(request)
+        doc = files.get('document')
+    doc_content = await sync_to_async(docx.Document, thread_sensitive=False)(doc)
+
+    text = ""
+    for paragraph in doc_content.paragraphs:
+        text += paragraph.text + "\n"
+
+    # 按句子/段落拆块并发纠错，再按顺序拼接；相同的文档同时只计算一次
+    try:
+        result, status = await correct_or_fallback_async(
+            text, lambda: get_async_singleflight().do(flight_key('correct_doc', text),
+                                                      lambda: DocumentCorrector().correct(text)))
+    except LLMUnavailable as e:
+        # 模型服务熔断或繁忙且不降级：快速失败
+        return unavailable_response(e)
+
+    highlighter = TextHighlighter(text, result)
+    highlighted_text = highlighter.highlight_differences()
+
+    owner = await sync_to_async(request.session.get)('username', 'admin')
+    await sync_to_async(Document.objects.create)(name=doc.name,
+                       src=text,
+                       dest=result,
+                       status=status,
+                       ops=highlighter.ops(),
+                       owner=owner,
+                       )
+    return JsonResponse({"result": highlighted_text, 'status': status, 'error': 0})
+
+async def correct_textv2_async(request):
+    """
+    correct_textv2 的异步版本：RAG 检索是 CPU 计算，放到线程池中执行
+    """
+    post, files = await parse_body(request)
+    text = post.get('text')
+    owner = await sync_to_async(request.session.get)('username', 'admin')
+
+    async def compute():
+        # RAG增强
+        enhancer = await sync_to_async(get_enhancer, thread_sensitive=False)()
+        context = await sync_to_async(enhancer.build_context, thread_sensitive=False)(text, owner=owner)
+
+        # 大模型更正（按句子查询纠错缓存，只有未命中的句子请求模型）
+        return await DocumentCorrector().correct(
+            text, context=context, render=lambda chunk: enhancer.format_prompt(context, chunk))
+
+    # 同一用户相同的文本同时只检索、纠错一次（知识库按用户划分，用户名参与请求键）
+    try:
+        result, status = await correct_or_fallback_async(
+            text, lambda: get_async_singleflight().do(flight_key('correct_textv2', owner, text), compute))
+    except LLMUnavailable as e:
+        # 模型服务熔断或繁忙且不降级：快速失败
+        return unavailable_response(e)
+
+    highlighter = TextHighlighter(text, result)
+    highlighted_text = highlighter.highlight_differences()
+
+    await sync_to_async(Text.objects.create)(
+                       src=text,
+                       dest=result,
+                       status=status,
+                       ops=highlighter.ops(),
+                       owner=owner,
                        )
 
     return JsonResponse({"result": highlighted_text, 'status': status, 'error': 0})
 
+def sse_event(event, data):
+    """
+    构造一条 Server-Sent Events 消息
+    """
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data, ensure_ascii=False))
+
+def correct_text_stream(request):
+    """
+    流式纠错文本：模型边生成边推送（Server-Sent Events），每条 delta 消息是已经稳定、标记好的更正文本片段，
+    流结束后保存纠错记录并推送 done 消息。
+    RAG 检索、读取模型输出和保存记录都在单独的线程中完成，响应只从队列中取出消息；
+    ASGI 部署（website.asgi）在线程池中迭代流式响应，不阻塞事件循环。
+    """
+    text = request.POST.get('text')
+    owner = request.session.get('username', 'admin')
+
+    def produce(emit):
+        highlighter = IncrementalHighlighter(text)
+        status = None
+        try:
+            # RAG增强
+            enhanced_text = get_enhancer().enhance_prompt(text, owner=owner)
+            for delta in ChatCompletion().stream_response(enhanced_text):
+                highlighted_text = highlighter.feed(delta)
+                if highlighted_text:
+                    emit(sse_event('delta', {'result': highlighted_text}))
+            highlighted_text = highlighter.finish()
+        except LLMUnavailable as e:
+            # 模型服务熔断或繁忙（在开始生成之前抛出）：快速失败，或降级为原文、状态为未检测
+            if not fallback_enabled():
+                emit(sse_event('error', {'error': 1, 'message': str(e)}))
+                return
+            highlighter.corrected_text = text
+            highlighted_text = text
+            status = '未检测'
+        except Exception as e:
+            emit(sse_event('error', {'error': 1, 'message': str(e)}))
+            return
+        if highlighted_text:
+            emit(sse_event('delta', {'result': highlighted_text}))
+
+        result = highlighter.corrected_text
+        # 降级时状态已经是未检测
+        if status is None:
+            status = correction_status(text, result)
+        try:
+            Text.objects.create(
+                src=text,
+                dest=result,
+                status=status,
+                # 流式输出是分段比对的，保存时对全文比对一次
+                ops=TextHighlighter(text, result).ops(),
+                owner=owner,
+            )
+        except Exception as e:
+            emit(sse_event('error', {'error': 1, 'message': str(e)}))
+            return
+        emit(sse_event('done', {'status': status, 'error': 0}))
+
+    return event_stream_response(thread_stream(produce))
+
+def llm_metrics(request):
+    """
+    模型服务的自适应并发限制、熔断器和各副本的负载状态
+    """
+    return JsonResponse({**get_guard().stats(), **get_endpoint_pool().stats()})
+
+def rag_status(request):
+    """
+    RAG 向量库加载状态
+    """
+    return JsonResponse(get_registry().status())
+
+def llm_status(request):
+    """
+    大模型客户端的请求统计和连接池状态
+    """
+    cache = get_correction_cache()
+    detector = get_detector()
+    batcher = get_batcher()
+    return JsonResponse({
+        'sync': get_client().stats(),
+        'async': get_async_client().stats(),
+        'correction_cache': cache.stats() if cache is not None else None,
+        'detector': detector.stats() if detector is not None else None,
+        'singleflight': {'sync': get_singleflight().stats(), 'async': get_async_singleflight().stats()},
+        'batching': batcher.stats() if batcher is not None else None,
+        'jobs': queue_stats(),
+    })
+
+async def correct_doc_stream(request):
+    """
+    分段推送的文档纠错：文档拆块纠错后，原文和更正文本按段落对齐、逐段比对，标记好的片段以 Server-Sent Events 推送。
+    纠错在请求的事件循环中完成；比对和保存记录在单独的线程中进行，每比对完一批段落就推送，
+    浏览器收到第一批段落时后面的段落还在比对，比对的内存取决于最长的段落而不是整篇文档。
+    """
+    doc = None
+    if request.method == 'POST':
+        post, files = await parse_body(request)
+        doc = files.get('document')
+    if doc is None:
+        return JsonResponse({'error': 1, 'message': '请使用 POST 上传 document 文件'}, status=400)
+    doc_content = await sync_to_async(docx.Document, thread_sensitive=False)(doc)
+
+    text = ""
+    for paragraph in doc_content.paragraphs:
+        text += paragraph.text + "\n"
+
+    try:
+        # 相同的文档同时只计算一次
+        result, status = await correct_or_fallback_async(
+            text, lambda: get_async_singleflight().do(flight_key('correct_doc', text),
+                                                      lambda: DocumentCorrector().correct(text)))
+    except LLMUnavailable as e:
+        # 模型服务熔断或繁忙且不降级：快速失败
+        return unavailable_response(e)
+    owner = await sync_to_async(request.session.get)('username', 'admin')
+
+    def produce(emit):
+        highlighter = ParagraphHighlighter(text, result)
+        # 小段落合并后再推送，减少消息数
+        buffer = []
+        size = 0
+        for fragment in highlighter.fragments():
+            buffer.append(fragment)
+            size += len(fragment)
+            if size >= 4096:
+                emit(sse_event('delta', {'result': ''.join(buffer)}))
+                buffer = []
+                size = 0
+        if buffer:
+            emit(sse_event('delta', {'result': ''.join(buffer)}))
+        try:
+            Document.objects.create(name=doc.name,
+                                    src=text,
+                                    dest=result,
+                                    status=status,
+                                    ops=highlighter.ops(),
+                                    owner=owner,
+                                    )
+        except Exception as e:
+            emit(sse_event('error', {'error': 1, 'message': str(e)}))
+            return
+        emit(sse_event('done', {'status': status, 'error': 0}))
+
+    return event_stream_response(thread_stream(produce))
+
+def record_highlight(record):
+    """
+    按纠错记录保存的编辑操作渲染标记文本；旧记录没有编辑操作时 render_ops 现场比对，只读不写，
+    旧记录的编辑操作由 backfill_ops 命令一次性补存
+    """
+    if record.status == '知识库' or record.status in UNFINISHED_STATUSES:
+        return ''
+    return render_ops(record.ops, record.src, record.dest)
+
 def getdoccorrectresult(request,doc_id):
     doc = Document.objects.filter(id=doc_id).first()
+    if doc is None:
+        return JsonResponse({'error': 1, 'message': '找不到id为%s的文档' % doc_id}, status=404)
+    # 后台任务未完成时返回进度和已纠错部分的结果
+    job = CorrectionJob.objects.filter(document_id=doc.id).first()
+    if job is not None and job.status != DONE:
+        return JsonResponse(job_progress(job, doc))
     result = doc.dest
-    return JsonResponse({"result":result})
+    response_data = {"result":result, "highlighted": record_highlight(doc), "status": doc.status, 'progress': 1.0}
+    if job is not None:
+        # 复用之前纠错结果的段落数和重新纠错的段落数
+        response_data['reused'] = job.reused
+        response_data['recomputed'] = job.recomputed
+    return JsonResponse(response_data)
+
+def gettextcorrectresult(request, text_id):
+    text = Text.objects.filter(id=text_id).first()
+    if text is None:
+        return JsonResponse({'error': 1, 'message': '找不到id为%s的文本' % text_id}, status=404)
+    return JsonResponse({"result": text.dest, "highlighted": record_highlight(text), "status": text.status})
 
 def get_knowledge(request):
     username = request.session['username']
@@ -429,11 +737,15 @@ def upload_knowledge(request):
     if request.method == 'POST':
         doc = request.FILES.get('document')
     doc_content = docx.Document(doc)
+    text = "\n".join(paragraph.text for paragraph in doc_content.paragraphs)
     status = '知识库'
-    Document.objects.create(name=doc.name,
-                       src=doc_content,
+    owner = request.session.get('username', 'admin')
+    knowledge = Document.objects.create(name=doc.name,
+                       src=text,
                        dest="",
                        status=status,
-                       owner=request.session.get('username', 'admin'),
+                       owner=owner,
                        )
+    # 后台拆分、嵌入并追加到向量库，无需重建整个知识库
+    submit_knowledge_document(owner, knowledge.id, text, {'owner': owner, 'name': doc.name})
     return JsonResponse({'msg': '上传成功'})
\ No newline at end of file
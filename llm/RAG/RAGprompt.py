@@ -1,43 +1,412 @@
-from langchain_community.document_loaders import PyPDFLoader
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+
+import faiss
+import numpy as np
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
 from langchain_core.prompts import ChatPromptTemplate
 
+from llm.RAG.batching import BatchingEmbeddings
+from llm.RAG.cache import RetrievalCache
+from llm.RAG.chunkstore import ChunkStore
+from llm.RAG.indexes import build_faiss_index, set_nprobe
+from llm.RAG.ingest import IngestionPipeline, expand_sources
+from llm.RAG.knowledge import KnowledgePool
+from llm.RAG.lexical import BM25Index, reciprocal_rank_fusion
+
+logger = logging.getLogger(__name__)
+
+# 索引文件格式版本，格式变化时修改以使旧索引失效
+INDEX_FORMAT_VERSION = 2
+
+
 class RAGPromptEnhancer:
-    def __init__(self, pdf_path, model_path):
+    def __init__(self, pdf_path, model_path, index_dir=None, chunk_size=40, chunk_overlap=5,
+                 embed_batch_window_ms=10, embed_max_batch_size=32, cache_size=1024, cache_ttl=600,
+                 knowledge_memory_budget_mb=256, index_type='flat', index_nlist=100, index_pq_m=16,
+                 index_nprobe=8, retrieval_mode='dense', lexical_candidates=50, top_k=1,
+                 ingest_workers=None, ingest_batch_size=64, progress=None):
         """
         初始化方法，加载 PDF 文件并初始化嵌入模型和向量库。
-        :param pdf_path: PDF 文件路径
+        :param pdf_path: PDF 文件路径，也可以是包含 PDF/DOCX 文件的目录
         :param model_path: 嵌入模型路径
+        :param index_dir: 向量库持久化目录，为 None 时不落盘
+        :param chunk_size: 每个块的最大字符数
+        :param chunk_overlap: 块之间的重叠字符数
+        :param embed_batch_window_ms: 并发查询合并嵌入的时间窗口（毫秒），0 表示不合并
+        :param embed_max_batch_size: 合并嵌入的最大批次
+        :param cache_size: 检索结果缓存和查询向量缓存的条数
+        :param cache_ttl: 检索结果缓存和查询向量缓存的有效期（秒）
+        :param knowledge_memory_budget_mb: 已加载的用户知识库分区的内存预算（MB）
+        :param index_type: 向量索引类型：flat / ivf_flat / ivf_pq / sq8
+        :param index_nlist: 倒排索引的聚类中心数量
+        :param index_pq_m: 乘积量化的子空间数量
+        :param index_nprobe: 倒排索引检索时访问的聚类数量
+        :param retrieval_mode: 检索方式：dense（向量）/ hybrid（BM25 预筛 + 向量，融合排序）/ lexical（仅 BM25）
+        :param lexical_candidates: hybrid 模式下 BM25 预筛的候选块数量
+        :param top_k: 返回的上下文块数量
+        :param ingest_workers: 构建向量库时解析文档的进程数，默认 CPU 核数
+        :param ingest_batch_size: 构建向量库时每个嵌入批次的块数量
+        :param progress: 构建向量库时的进度回调，参数为 IngestionStats
         """
-        # 加载 PDF 文件
-        loader = PyPDFLoader(pdf_path)
-        self.pages = loader.load()  # 加载 PDF 文档，不拆分
+        self.pdf_path = pdf_path
+        self.source_paths = expand_sources(pdf_path)
+        self.model_path = model_path
+        self.index_dir = index_dir
+        self.index_type = index_type
+        self.index_nlist = index_nlist
+        self.index_pq_m = index_pq_m
+        self.index_nprobe = index_nprobe
+        self.retrieval_mode = retrieval_mode
+        self.lexical_candidates = lexical_candidates
+        self.ingest_workers = ingest_workers
+        self.ingest_batch_size = ingest_batch_size
+        self.progress = progress
 
         # 定义按句号拆分的文本分割器
+        self.separators = ["。"]  # 按句号拆分
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
         self.text_splitter = RecursiveCharacterTextSplitter(
-            separators=["。"],  # 按句号拆分
-            chunk_size=40,      # 每个块的最大字符数
-            chunk_overlap=5     # 块之间的重叠字符数
+            separators=self.separators,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap
         )
 
-        # 按句号拆分文本
-        self.split_documents = self.text_splitter.split_documents(self.pages)
+        # 使用开源嵌入模型，并发查询在短时间窗口内合并为一次批量前向计算
+        self.embedding = BatchingEmbeddings(
+            HuggingFaceEmbeddings(model_name=model_path),
+            window_ms=embed_batch_window_ms,
+            max_batch_size=embed_max_batch_size,
+        )
+
+        # 向量库：优先从磁盘加载（内存映射），不存在时重新构建并保存
+        self.model_key = self._model_key()
+        self.index_key = self._index_key()
+        self.index_path = os.path.join(index_dir, self.index_key) if index_dir else None
+        self.index = None
+        self.chunks = None
+        if self.index_path and os.path.isdir(self.index_path):
+            try:
+                self.index, self.chunks = self._load_index(self.index_path)
+                logger.info('从 %s 加载向量库', self.index_path)
+            except Exception:
+                logger.exception('向量库加载失败，重新构建: %s', self.index_path)
+        if self.index is None:
+            self.index, self.chunks = self._build_index()
 
-        # 使用开源嵌入模型
-        self.embedding = HuggingFaceEmbeddings(model_name=model_path)
+        # 与向量库共用同一批块的 BM25 倒排索引
+        self.lexical = self._load_lexical_index()
 
-        # 向量库
-        self.vector_store = FAISS.from_documents(self.split_documents, self.embedding)
+        # 用户上传的知识文档，按用户分区，增量追加到各自的向量库中
+        self.knowledge = KnowledgePool(
+            self.embedding,
+            self.text_splitter,
+            index_dir=os.path.join(index_dir, 'knowledge') if index_dir else None,
+            model_key=self.model_key,
+            memory_budget=knowledge_memory_budget_mb * 1024 * 1024,
+        )
 
-        # 定义检索器，限制返回的文档数量
-        self.retriever = self.vector_store.as_retriever(search_kwargs={"k": 1})  # 返回最相关的1个文档
+        # 限制返回的文档数量
+        self.k = top_k  # 默认返回最相关的1个文档
 
-    def enhance_prompt(self, user_question):
+        # 检索结果缓存，知识库变化时自动失效；重建向量库会创建新的实例和缓存
+        self.cache = RetrievalCache(max_size=cache_size, ttl=cache_ttl)
+        # 查询向量只取决于输入文本和嵌入模型，知识库变化后检索结果失效时仍可复用，不必重新嵌入
+        self.query_vectors = RetrievalCache(max_size=cache_size, ttl=cache_ttl)
+
+    def _model_key(self):
         """
-        根据用户问题生成增强后的 prompt。
+        嵌入模型标识：配置文件内容 + 权重文件大小（避免每次启动都哈希大文件）。
+        """
+        sha = hashlib.sha256()
+        sha.update(os.path.basename(os.path.normpath(self.model_path)).encode())
+        if os.path.isdir(self.model_path):
+            for root, dirs, files in os.walk(self.model_path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    rel_path = os.path.relpath(file_path, self.model_path)
+                    sha.update(rel_path.encode())
+                    if name.endswith('.json'):
+                        with open(file_path, 'rb') as f:
+                            sha.update(f.read())
+                    else:
+                        sha.update(str(os.path.getsize(file_path)).encode())
+        return sha.hexdigest()[:32]
+
+    def _index_key(self):
+        """
+        根据源文档内容、分割参数和嵌入模型计算索引的哈希键，任一变化都会生成新的索引。
+        """
+        sha = hashlib.sha256()
+        sha.update(str(INDEX_FORMAT_VERSION).encode())
+        # 源文档内容
+        for source_path in self.source_paths:
+            sha.update(os.path.basename(source_path).encode())
+            with open(source_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+        # 分割参数和索引类型
+        sha.update(json.dumps({
+            'separators': self.separators,
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+            'index_type': self.index_type,
+            'index_nlist': self.index_nlist,
+            'index_pq_m': self.index_pq_m,
+        }, sort_keys=True).encode())
+        # 嵌入模型
+        sha.update(self.model_key.encode())
+        return sha.hexdigest()[:32]
+
+    def _build_index(self):
+        """
+        加载知识源、拆分并嵌入，构建向量库；配置了持久化目录时保存到磁盘。
+        解析和拆分在进程池中并行进行，嵌入按批次进行。
+        :return: (faiss 索引, 块文档库)
+        """
+        pipeline = IngestionPipeline(
+            self.embedding,
+            self.separators,
+            self.chunk_size,
+            self.chunk_overlap,
+            workers=self.ingest_workers,
+            batch_size=self.ingest_batch_size,
+            progress=self.progress,
+        )
+        texts, metadatas, vectors = pipeline.run(self.source_paths)
+
+        # 按配置的类型训练、构建索引
+        index = build_faiss_index(vectors, self.index_type, nlist=self.index_nlist, pq_m=self.index_pq_m,
+                                  nprobe=self.index_nprobe)
+        chunks = ChunkStore.from_texts(texts, metadatas)
+
+        if self.index_path:
+            self._save_index(index, chunks, vectors)
+            # 重新以内存映射方式打开，与之后启动的工作进程共享同一份页缓存
+            try:
+                return self._load_index(self.index_path)
+            except Exception:
+                logger.exception('向量库加载失败，使用内存中的向量库: %s', self.index_path)
+        return index, chunks
+
+    def _save_index(self, index, chunks, vectors):
+        """
+        将向量库写入临时目录后原子重命名，避免多个进程同时构建时读到不完整的文件。
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=self.index_key + '.tmp-', dir=self.index_dir)
+        try:
+            faiss.write_index(index, os.path.join(tmp_path, 'index.faiss'))
+            np.save(os.path.join(tmp_path, 'vectors.npy'), vectors)
+            chunks.save(tmp_path)
+            os.rename(tmp_path, self.index_path)
+            logger.info('向量库已保存到 %s', self.index_path)
+        except OSError:
+            # 其他进程已经保存了相同的索引
+            if not os.path.isdir(self.index_path):
+                logger.exception('向量库保存失败: %s', self.index_path)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _load_index(self, index_path):
+        """
+        以内存映射方式加载向量库，多个工作进程共享同一份页缓存。
+        IO_FLAG_MMAP 仍会把 flat 索引的向量复制到每个进程的匿名内存中，
+        IO_FLAG_MMAP_IFC 直接在映射的文件上检索（flat、倒排和标量量化索引都适用）。
+        :return: (faiss 索引, 块文档库)
+        """
+        index_file = os.path.join(index_path, 'index.faiss')
+        try:
+            index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # 部分索引类型不支持内存映射
+            logger.warning('索引不支持内存映射，读入内存: %s', index_file)
+            index = faiss.read_index(index_file)
+        set_nprobe(index, self.index_nprobe)
+        return index, ChunkStore.load(index_path)
+
+    def _load_lexical_index(self):
+        """
+        加载 BM25 倒排索引，不存在时根据向量库中的块构建并保存。
+        """
+        lexical_file = os.path.join(self.index_path, 'bm25.pkl') if self.index_path else None
+        if lexical_file and os.path.exists(lexical_file):
+            try:
+                with open(lexical_file, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                logger.exception('BM25 索引加载失败，重新构建: %s', lexical_file)
+
+        texts = [self._doc(position).page_content for position in range(self.index.ntotal)]
+        lexical = BM25Index(texts)
+        if lexical_file:
+            tmp_file = '%s.tmp-%d' % (lexical_file, os.getpid())
+            try:
+                with open(tmp_file, 'wb') as f:
+                    pickle.dump(lexical, f)
+                os.replace(tmp_file, lexical_file)
+            except OSError:
+                logger.exception('BM25 索引保存失败: %s', lexical_file)
+        return lexical
+
+    def _doc(self, position):
+        """
+        :param position: 块在向量库中的位置
+        :return: 对应的文档
+        """
+        return self.chunks[position]
+
+    def _dense_search(self, query_vector, k, candidates=None):
+        """
+        在 PDF 向量库中检索，指定候选块时只在候选块中检索。
+        :return: [(块位置, L2 距离)]
+        """
+        index = self.index
+        params = None
+        if candidates is not None:
+            selector = faiss.IDSelectorBatch(np.asarray(candidates, dtype=np.int64))
+            try:
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(index).nprobe)
+            except RuntimeError:
+                params = faiss.SearchParameters(sel=selector)
+        query = np.asarray([query_vector], dtype=np.float32)
+        distances, positions = index.search(query, k, params=params)
+        return [(int(position), float(distance))
+                for position, distance in zip(positions[0], distances[0]) if position >= 0]
+
+    def load_vectors(self):
+        """
+        以内存映射方式读取保存的块向量，未持久化时返回 None。
+        """
+        if not self.index_path:
+            return None
+        vectors_file = os.path.join(self.index_path, 'vectors.npy')
+        if not os.path.exists(vectors_file):
+            return None
+        return np.load(vectors_file, mmap_mode='r')
+
+    def retrieve(self, user_question, owner=None):
+        """
+        同时检索 PDF 向量库和该用户的知识库，按距离合并取最相关的 k 个文档。
+        :param user_question: 用户输入的问题
+        :param owner: 用户名，为 None 时只检索 PDF 向量库
+        :return: 检索到的文档列表
+        """
+        if owner is not None:
+            self.knowledge.refresh(owner)
+        # 只有 PDF 向量库（重建后是新的实例）或该用户自己的知识库变化时缓存才失效
+        version = (self.index_key, self.knowledge.version(owner))
+        cached = self.cache.get(user_question, version, namespace=owner)
+        if cached is not None:
+            return cached
+
+        query_vector = None
+        docs = None
+        if self.retrieval_mode == 'lexical':
+            # 仅 BM25：PDF 和该用户知识库的结果按倒数排名融合，不需要嵌入查询，都没有命中时退回向量检索
+            docs = self._lexical_search(user_question, owner) or None
+        if docs is None:
+            query_vector = self._embed_query(user_question)
+            if self.retrieval_mode == 'hybrid':
+                docs = self._hybrid_search(user_question, query_vector, owner)
+            else:
+                results = [(self._doc(position), distance)
+                           for position, distance in self._dense_search(query_vector, self.k)]
+                results.extend(self.knowledge.search(owner, query_vector, k=self.k))
+                results.sort(key=lambda item: item[1])
+                docs = [doc for doc, score in results[:self.k]]
+        self.cache.put(user_question, version, docs, namespace=owner)
+        return docs
+
+    def _embed_query(self, user_question):
+        """
+        嵌入查询文本，优先复用缓存的查询向量（与用户和知识库版本无关）。
+        """
+        query_vector = self.query_vectors.get(user_question, 0)
+        if query_vector is None:
+            query_vector = self.embedding.embed_query(user_question)
+            self.query_vectors.put(user_question, 0, query_vector)
+        return query_vector
+
+    def _lexical_search(self, user_question, owner):
+        """
+        分别在 PDF 向量库和该用户的知识库中按 BM25 检索（两者分数的量纲不同），按倒数排名融合。
+        :return: 最相关的 k 个文档，都没有命中时为空列表
+        """
+        pdf = self.lexical.search(user_question, k=self.k)
+        knowledge = self.knowledge.lexical_search(owner, user_question, k=self.k)
+        docs = {('pdf', position): self._doc(position) for position, score in pdf}
+        docs.update((('knowledge', doc.metadata.get('chunk_id')), doc) for doc, score in knowledge)
+        fused = reciprocal_rank_fusion([
+            [('pdf', position) for position, score in pdf],
+            [('knowledge', doc.metadata.get('chunk_id')) for doc, score in knowledge],
+        ])
+        return [docs[key] for key, score in fused[:self.k]]
+
+    def _hybrid_search(self, user_question, query_vector, owner):
+        """
+        BM25 先筛出候选块，向量检索只在候选块中进行，再与知识库的向量、BM25 结果按倒数排名融合。
+        BM25 没有命中时在整个向量库中检索。
+        """
+        lexical = self.lexical.search(user_question, k=self.lexical_candidates)
+        candidates = [position for position, score in lexical]
+        if candidates:
+            dense = self._dense_search(query_vector, len(candidates), candidates=candidates)
+        else:
+            dense = self._dense_search(query_vector, self.k)
+
+        docs = {}
+        dense_results = []
+        for position, distance in dense:
+            docs[('pdf', position)] = self._doc(position)
+            dense_results.append((('pdf', position), distance))
+        for doc, distance in self.knowledge.search(owner, query_vector, k=self.k):
+            key = ('knowledge', doc.metadata.get('chunk_id'))
+            docs[key] = doc
+            dense_results.append((key, distance))
+        dense_results.sort(key=lambda item: item[1])
+        knowledge_lexical = []
+        for doc, score in self.knowledge.lexical_search(owner, user_question, k=self.lexical_candidates):
+            key = ('knowledge', doc.metadata.get('chunk_id'))
+            docs[key] = doc
+            knowledge_lexical.append(key)
+
+        fused = reciprocal_rank_fusion([
+            [key for key, distance in dense_results],
+            [('pdf', position) for position in candidates],
+            knowledge_lexical,
+        ])
+        return [docs[key] if key in docs else self._doc(key[1]) for key, score in fused[:self.k]]
+
+    def build_context(self, user_question, owner=None):
+        """
+        检索与问题相关的文档，拼接为上下文。
         :param user_question: 用户输入的问题
+        :param owner: 用户名，用于检索该用户的知识库
+        :return: 上下文文本
+        """
+        # 检索与问题相关的文档
+        retrieved_docs = self.retrieve(user_question, owner=owner)
+
+        # 将检索到的文档内容拼接为上下文
+        if retrieved_docs:
+            return "\n".join([doc.page_content for doc in retrieved_docs])
+        return "未找到相关上下文。"
+
+    @staticmethod
+    def format_prompt(context, user_question):
+        """
+        将上下文与原始 prompt 结合。
+        :param context: build_context 返回的上下文
+        :param user_question: 待纠错的文本
         :return: 增强后的 prompt
         """
         # 定义原始 prompt 模板
@@ -48,20 +417,17 @@ class RAGPromptEnhancer:
         ## 请修改以下内容：{input}
         """
         prompt = ChatPromptTemplate.from_template(template)
+        return prompt.format(context=context, input=user_question)
 
-        # 检索与问题相关的文档
-        retrieved_docs = self.retriever.invoke(user_question)
-
-        # 将检索到的文档内容拼接为上下文
-        if retrieved_docs:
-            context = "\n".join([doc.page_content for doc in retrieved_docs])
-        else:
-            context = "未找到相关上下文。"
-
-        # 将上下文与原始 prompt 结合
-        new_prompt = prompt.format(context=context, input=user_question)
-
-        return new_prompt
+    def enhance_prompt(self, user_question, owner=None):
+        """
+        根据用户问题生成增强后的 prompt。
+        :param user_question: 用户输入的问题
+        :param owner: 用户名，用于检索该用户的知识库
+        :return: 增强后的 prompt
+        """
+        context = self.build_context(user_question, owner=owner)
+        return self.format_prompt(context, user_question)
 
 
 # 示例用法
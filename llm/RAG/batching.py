@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    微批量嵌入执行器。
+    并发请求的查询向量在一个很短的时间窗口内收集起来，合并为一次批量前向计算，再分别返回给各个调用方。
+    """
+
+    def __init__(self, embedding, window_ms=10, max_batch_size=32):
+        """
+        :param embedding: 实际执行嵌入的模型
+        :param window_ms: 收集批次的时间窗口（毫秒）
+        :param max_batch_size: 单个批次的最大查询数量，达到后立即执行
+        """
+        self.embedding = embedding
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        # 统计信息
+        self.batches = 0
+        self.queries = 0
+        self.max_batch_seen = 0
+
+    def embed_documents(self, texts):
+        """
+        文档嵌入本身就是批量的，直接交给模型。
+        """
+        return self.embedding.embed_documents(texts)
+
+    def embed_query(self, text):
+        """
+        提交查询并等待所在批次完成。
+        :param text: 查询文本
+        :return: 查询向量
+        """
+        if self.window <= 0:
+            return self.embedding.embed_query(text)
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        """
+        阻塞等待第一个查询，然后在时间窗口内继续收集，直到窗口结束或达到批次上限。
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for text, future in batch]
+            try:
+                vectors = self.embedding.embed_documents(texts)
+            except Exception as e:
+                for text, future in batch:
+                    future.set_exception(e)
+                continue
+            for (text, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+            self.batches += 1
+            self.queries += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+    def stats(self):
+        """
+        :return: 批次统计信息
+        """
+        return {
+            'batches': self.batches,
+            'queries': self.queries,
+            'avg_batch_size': self.queries / self.batches if self.batches else 0.0,
+            'max_batch_size': self.max_batch_seen,
+            'window_ms': self.window * 1000,
+        }
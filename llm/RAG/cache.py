@@ -0,0 +1,109 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """
+    规范化输入文本：全半角统一、去除首尾空白、合并连续空白。
+    :param text: 输入文本
+    :return: 规范化后的文本
+    """
+    text = unicodedata.normalize('NFKC', text or '')
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class RetrievalCache:
+    """
+    检索缓存，键为命名空间（如用户）和规范化后的输入文本，值为检索到的文档或查询向量，同时记录计算时的索引版本。
+    读取时版本与当前版本不一致视为未命中并删除，只有该命名空间自己的索引变化才使其缓存失效。
+    按容量做 LRU 淘汰，并按 TTL 过期。
+    """
+
+    def __init__(self, max_size=1024, ttl=600):
+        """
+        :param max_size: 最大缓存条数，0 表示不缓存
+        :param ttl: 缓存有效期（秒），0 表示不过期
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, text, version, namespace=None):
+        """
+        :param text: 输入文本
+        :param version: 当前索引版本，可以是任意可比较相等的值（如 (PDF 索引键, 用户分区版本)）
+        :param namespace: 命名空间
+        :return: 缓存的值，未命中时返回 None
+        """
+        if self.max_size <= 0:
+            return None
+        key = (namespace, normalize_text(text))
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, item_version, value = item
+            if item_version != version:
+                del self._data[key]
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, text, version, value, namespace=None):
+        """
+        :param text: 输入文本
+        :param version: 计算该值时的索引版本
+        :param value: 缓存的值
+        :param namespace: 命名空间
+        """
+        if self.max_size <= 0:
+            return
+        key = (namespace, normalize_text(text))
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, version, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        :return: 缓存统计信息
+        """
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,69 @@
+import json
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+
+# 块内容文件和偏移量文件
+DATA_FILE = 'chunks.bin'
+OFFSETS_FILE = 'chunks.npy'
+
+
+class ChunkStore:
+    """
+    按位置读取向量库中的块文档。每个块编码为一条 UTF-8 JSON 记录，依次拼接，另存每条记录的起始偏移量。
+    从磁盘加载时两个文件都以内存映射方式打开，多个工作进程共享同一份页缓存，
+    检索时只解码命中的块，不必在每个进程中反序列化整个文档库。
+    """
+
+    def __init__(self, data, offsets):
+        """
+        :param data: 拼接后的记录，uint8 数组（可以是内存映射）
+        :param offsets: 每条记录的起始偏移量，int64 数组，末尾为总长度
+        """
+        self._data = data
+        self._offsets = offsets
+
+    @classmethod
+    def from_texts(cls, texts, metadatas):
+        """
+        :param texts: 块文本列表
+        :param metadatas: 与 texts 对应的元数据列表
+        :return: 内存中的块文档库
+        """
+        records = [json.dumps({'text': text, 'metadata': metadata}, ensure_ascii=False).encode('utf-8')
+                   for text, metadata in zip(texts, metadatas)]
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        np.cumsum([len(record) for record in records], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(records), dtype=np.uint8), offsets)
+
+    @classmethod
+    def load(cls, path):
+        """
+        以内存映射方式打开 save 保存的块文档库。
+        :param path: 向量库目录
+        """
+        offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode='r')
+        if offsets[-1] == 0:
+            # 空文件不能内存映射
+            return cls(np.zeros(0, dtype=np.uint8), offsets)
+        return cls(np.memmap(os.path.join(path, DATA_FILE), dtype=np.uint8, mode='r'), offsets)
+
+    def save(self, path):
+        """
+        :param path: 向量库目录
+        """
+        with open(os.path.join(path, DATA_FILE), 'wb') as f:
+            f.write(self._data.tobytes())
+        np.save(os.path.join(path, OFFSETS_FILE), np.asarray(self._offsets))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, position):
+        """
+        :param position: 块在向量库中的位置
+        :return: 对应的文档
+        """
+        record = json.loads(bytes(self._data[self._offsets[position]:self._offsets[position + 1]]).decode('utf-8'))
+        return Document(page_content=record['text'], metadata=record['metadata'])
@@ -0,0 +1,135 @@
+import logging
+import time
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 支持的索引类型：精确检索、倒排 + 原始向量、倒排 + 乘积量化、8 位标量量化
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'sq8')
+
+# 各索引类型对应的 faiss 索引类，用于判断 build_faiss_index 是否因样本不足退化为 flat
+INDEX_CLASSES = {
+    'flat': 'IndexFlatL2',
+    'ivf_flat': 'IndexIVFFlat',
+    'ivf_pq': 'IndexIVFPQ',
+    'sq8': 'IndexScalarQuantizer',
+}
+
+# 每个聚类中心至少需要的训练样本数（faiss 的建议值）
+MIN_POINTS_PER_CENTROID = 39
+
+
+def build_faiss_index(vectors, index_type='flat', nlist=100, pq_m=16, pq_nbits=8, nprobe=8):
+    """
+    按指定类型训练并构建 faiss 索引。样本过少无法训练时退化为精确索引。
+    :param vectors: 向量矩阵，float32，形状 (n, d)
+    :param index_type: 索引类型，见 INDEX_TYPES
+    :param nlist: 倒排索引的聚类中心数量，样本不足时自动减少
+    :param pq_m: 乘积量化的子空间数量，需要整除向量维度
+    :param pq_nbits: 乘积量化每个子空间的编码位数
+    :param nprobe: 检索时访问的聚类数量
+    :return: faiss 索引
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError('不支持的索引类型: %s，可选 %s' % (index_type, ', '.join(INDEX_TYPES)))
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+
+    if index_type.startswith('ivf'):
+        nlist = min(nlist, n // MIN_POINTS_PER_CENTROID)
+        if nlist < 1 or (index_type == 'ivf_pq' and n < MIN_POINTS_PER_CENTROID * (1 << pq_nbits)):
+            logger.warning('样本数 %d 不足以训练 %s 索引，使用 flat 索引', n, index_type)
+            index_type = 'flat'
+
+    if index_type == 'flat':
+        index = faiss.IndexFlatL2(d)
+    elif index_type == 'sq8':
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit)
+    else:
+        quantizer = faiss.IndexFlatL2(d)
+        if index_type == 'ivf_flat':
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, pq_nbits)
+
+    if not index.is_trained:
+        start = time.monotonic()
+        index.train(vectors)
+        logger.info('%s 索引训练完成，样本数 %d，耗时 %.2fs', index_type, n, time.monotonic() - start)
+    index.add(vectors)
+    set_nprobe(index, nprobe)
+    return index
+
+
+def set_nprobe(index, nprobe):
+    """
+    设置倒排索引检索时访问的聚类数量，非倒排索引忽略。
+    """
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return
+    ivf.nprobe = max(1, min(nprobe, ivf.nlist))
+
+
+def index_memory_bytes(index):
+    """
+    :return: 索引序列化后的大小（字节），近似其常驻内存
+    """
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def evaluate_index(index, vectors, queries, k=10, nprobe_values=(1, 4, 8, 16, 32)):
+    """
+    以精确检索为基准，评估索引的内存占用、recall@k 和单次查询耗时。
+    :param index: 待评估的索引
+    :param vectors: 索引中的原始向量
+    :param queries: 查询向量
+    :param k: 返回数量
+    :param nprobe_values: 倒排索引需要评估的 nprobe 取值
+    :return: 评估报告
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    k = min(k, vectors.shape[0])
+
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    _, truth = flat.search(queries, k)
+
+    try:
+        original_nprobe = faiss.extract_index_ivf(index).nprobe
+        probes = nprobe_values
+    except RuntimeError:
+        original_nprobe = None
+        probes = (None,)
+
+    results = []
+    for nprobe in probes:
+        if nprobe is not None:
+            set_nprobe(index, nprobe)
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        elapsed = time.perf_counter() - start
+        hits = sum(len(set(row_found) & set(row_truth)) for row_found, row_truth in zip(found, truth))
+        results.append({
+            'nprobe': nprobe,
+            'recall': hits / float(k * len(queries)),
+            'ms_per_query': elapsed * 1000 / len(queries),
+        })
+    if original_nprobe is not None:
+        set_nprobe(index, original_nprobe)
+
+    memory = index_memory_bytes(index)
+    flat_memory = index_memory_bytes(flat)
+    return {
+        'index_class': type(index).__name__,
+        'ntotal': index.ntotal,
+        'k': k,
+        'memory_bytes': memory,
+        'flat_memory_bytes': flat_memory,
+        'compression': flat_memory / float(memory) if memory else 0.0,
+        'results': results,
+    }
@@ -0,0 +1,238 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 支持的知识源文件类型
+SOURCE_EXTENSIONS = ('.pdf', '.docx')
+
+# 每个解析任务处理的 PDF 页数
+PAGES_PER_TASK = 16
+
+
+def expand_sources(path):
+    """
+    展开知识源路径：文件直接返回，目录则递归查找其中的 PDF/DOCX 文件。
+    :param path: 文件或目录路径
+    :return: 排序后的文件路径列表
+    """
+    if not os.path.isdir(path):
+        return [path]
+    sources = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(SOURCE_EXTENSIONS):
+                sources.append(os.path.join(root, name))
+    return sources
+
+
+def _make_tasks(path):
+    """
+    将一个文件拆成若干解析任务：PDF 按页段拆分，DOCX 整个文件一个任务。
+    """
+    if path.lower().endswith('.pdf'):
+        from pypdf import PdfReader
+        page_count = len(PdfReader(path).pages)
+        return [(path, start, min(start + PAGES_PER_TASK, page_count))
+                for start in range(0, page_count, PAGES_PER_TASK)]
+    return [(path, None, None)]
+
+
+def parse_and_split(task, separators, chunk_size, chunk_overlap):
+    """
+    在子进程中解析文件的一段并拆分成块。
+    :param task: (文件路径, 起始页, 结束页)，DOCX 的页码为 None
+    :return: (处理的页数或段落数, [(块文本, 元数据)])
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    path, start, end = task
+    splitter = RecursiveCharacterTextSplitter(
+        separators=separators,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    )
+    chunks = []
+    if start is not None:
+        from pypdf import PdfReader
+        reader = PdfReader(path)
+        for page_number in range(start, end):
+            text = reader.pages[page_number].extract_text() or ''
+            metadata = {'source': path, 'page': page_number}
+            chunks.extend((chunk, metadata) for chunk in splitter.split_text(text))
+        return end - start, chunks
+
+    import docx
+    paragraphs = [paragraph.text for paragraph in docx.Document(path).paragraphs]
+    for number, text in enumerate(paragraphs):
+        if text.strip():
+            metadata = {'source': path, 'paragraph': number}
+            chunks.extend((chunk, metadata) for chunk in splitter.split_text(text))
+    return len(paragraphs), chunks
+
+
+class IngestionStats:
+    """
+    导入进度和吞吐量统计。
+    """
+
+    def __init__(self, total_tasks):
+        self.total_tasks = total_tasks
+        self.finished_tasks = 0
+        self.pages = 0
+        self.chunks = 0
+        self.embedded = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def as_dict(self):
+        elapsed = max(self.elapsed, 1e-6)
+        return {
+            'tasks': '%d/%d' % (self.finished_tasks, self.total_tasks),
+            'pages': self.pages,
+            'chunks': self.chunks,
+            'embedded': self.embedded,
+            'elapsed': elapsed,
+            'pages_per_second': self.pages / elapsed,
+            'chunks_per_second': self.embedded / elapsed,
+        }
+
+
+class IngestionPipeline:
+    """
+    分阶段的知识源导入流水线：
+    进程池并行解析、拆分页面或段落；嵌入阶段按固定大小的批次处理；
+    两个阶段之间使用有界队列，嵌入跟不上时解析阶段自动等待（背压）。
+    """
+
+    def __init__(self, embedding, separators, chunk_size, chunk_overlap, workers=None, batch_size=64,
+                 max_pending_batches=4, progress=None):
+        """
+        :param embedding: 嵌入模型
+        :param separators: 分割符
+        :param chunk_size: 每个块的最大字符数
+        :param chunk_overlap: 块之间的重叠字符数
+        :param workers: 解析进程数，默认 CPU 核数；1 表示在当前进程中解析
+        :param batch_size: 每个嵌入批次的块数量
+        :param max_pending_batches: 等待嵌入的最大批次数
+        :param progress: 进度回调，参数为 IngestionStats
+        """
+        self.embedding = embedding
+        self.separators = separators
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_pending_batches = max_pending_batches
+        self.progress = progress
+
+    def _report(self, stats):
+        if self.progress:
+            self.progress(stats)
+
+    def _parse(self, tasks):
+        """
+        解析阶段：按完成顺序产出每个任务的结果，同时在途任务数不超过进程数的两倍。
+        """
+        args = (self.separators, self.chunk_size, self.chunk_overlap)
+        if self.workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield task, parse_and_split(task, *args)
+            return
+
+        # 嵌入模型可能已经启动了多线程，使用 spawn 避免 fork 带来的死锁
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+            pending = {}
+            remaining = iter(tasks)
+            while True:
+                while len(pending) < self.workers * 2:
+                    task = next(remaining, None)
+                    if task is None:
+                        break
+                    pending[executor.submit(parse_and_split, task, *args)] = task
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+
+    def run(self, paths):
+        """
+        :param paths: 知识源文件列表
+        :return: (块文本列表, 元数据列表, 向量矩阵)
+        """
+        tasks = [task for path in paths for task in _make_tasks(path)]
+        stats = IngestionStats(len(tasks))
+        batches = queue.Queue(maxsize=self.max_pending_batches)
+        results = []
+        errors = []
+
+        def embed_worker():
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if errors:
+                    continue
+                try:
+                    vectors = self.embedding.embed_documents([text for text, metadata in batch])
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                results.append((batch, vectors))
+                stats.embedded += len(batch)
+                self._report(stats)
+
+        worker = threading.Thread(target=embed_worker, name='ingest-embedding', daemon=True)
+        worker.start()
+        try:
+            # 按任务顺序重排解析结果，保证块顺序稳定
+            order = {task: number for number, task in enumerate(tasks)}
+            parsed = {}
+            next_task = 0
+            buffer = []
+            for task, (units, chunks) in self._parse(tasks):
+                stats.finished_tasks += 1
+                stats.pages += units
+                stats.chunks += len(chunks)
+                parsed[order[task]] = chunks
+                while next_task in parsed:
+                    buffer.extend(parsed.pop(next_task))
+                    next_task += 1
+                    while len(buffer) >= self.batch_size:
+                        # 队列已满时阻塞，解析阶段随之等待
+                        batches.put(buffer[:self.batch_size])
+                        buffer = buffer[self.batch_size:]
+                self._report(stats)
+                if errors:
+                    break
+            if buffer and not errors:
+                batches.put(buffer)
+        finally:
+            batches.put(None)
+            worker.join()
+        if errors:
+            raise errors[0]
+
+        if not results:
+            raise ValueError('知识源中没有可用的文本: %s' % ', '.join(paths))
+        texts, metadatas, vectors = [], [], []
+        for batch, batch_vectors in results:
+            texts.extend(text for text, metadata in batch)
+            metadatas.extend(metadata for text, metadata in batch)
+            vectors.extend(batch_vectors)
+        logger.info('导入完成：%d 页，%d 块，%.1f 页/秒，%.1f 块/秒', stats.pages, stats.embedded,
+                    stats.as_dict()['pages_per_second'], stats.as_dict()['chunks_per_second'])
+        return texts, metadatas, np.asarray(vectors, dtype=np.float32)
@@ -0,0 +1,417 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+from filelock import FileLock
+from langchain_community.vectorstores import FAISS
+
+from llm.RAG.lexical import BM25Index
+
+logger = logging.getLogger(__name__)
+
+
+class KnowledgeIndex:
+    """
+    用户上传知识文档的增量向量库。
+    新文档的向量直接追加到索引中，删除文档时只记录墓碑，墓碑比例超过阈值时再压缩索引。
+    索引保存在单个文件中，多个工作进程通过文件锁串行写入，并在文件变化后重新加载。
+    """
+
+    def __init__(self, embedding, text_splitter, index_file=None, model_key='', compact_ratio=0.2):
+        """
+        :param embedding: 嵌入模型
+        :param text_splitter: 文本分割器
+        :param index_file: 持久化文件路径，为 None 时只保存在内存中
+        :param model_key: 嵌入模型标识，与保存时不一致则重新嵌入
+        :param compact_ratio: 墓碑占比超过该值时压缩索引
+        """
+        self.embedding = embedding
+        self.text_splitter = text_splitter
+        self.index_file = index_file
+        self.model_key = model_key
+        self.compact_ratio = compact_ratio
+
+        self.vector_store = None
+        # 文档 ID -> 块 ID 列表
+        self.doc_chunks = {}
+        # 已删除但尚未压缩的块 ID
+        self.tombstones = set()
+        # 每次索引内容变化时递增
+        self.version = 0
+
+        self._lock = threading.RLock()
+        self._loaded_mtime = None
+        # (版本, BM25 倒排索引, 块列表)，内容变化后首次按词检索时重建
+        self._lexical = None
+        if index_file:
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            # 多个工作进程之间串行写入
+            self._write_lock = FileLock(index_file + '.lock')
+            with self._write_lock:
+                self._reload()
+        else:
+            self._write_lock = threading.Lock()
+
+    def __len__(self):
+        """
+        :return: 有效块数量
+        """
+        if self.vector_store is None:
+            return 0
+        return self.vector_store.index.ntotal - len(self.tombstones)
+
+    def memory_bytes(self):
+        """
+        估算占用的内存：向量本身加上每块的文档存储开销。
+        """
+        if self.vector_store is None:
+            return 0
+        index = self.vector_store.index
+        return index.ntotal * (index.d * 4 + 256)
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.index_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload(self):
+        """
+        从磁盘重新加载索引，调用方需持有文件锁。
+        """
+        mtime = self._file_mtime()
+        if mtime is None or mtime == self._loaded_mtime:
+            return
+        with open(self.index_file, 'rb') as f:
+            state = pickle.load(f)
+        with self._lock:
+            self.doc_chunks = state['doc_chunks']
+            self.tombstones = state['tombstones']
+            if state['model_key'] != self.model_key:
+                # 嵌入模型发生变化，旧向量不可用，使用保存的块文本重新嵌入
+                logger.info('嵌入模型发生变化，重新嵌入知识库')
+                self.vector_store = self._reembed(state['docstore'], state['index_to_docstore_id'])
+            elif state['index'] is None:
+                self.vector_store = None
+            else:
+                self.vector_store = FAISS(
+                    embedding_function=self.embedding,
+                    index=faiss.deserialize_index(state['index']),
+                    docstore=state['docstore'],
+                    index_to_docstore_id=state['index_to_docstore_id'],
+                )
+            self._loaded_mtime = mtime
+            self.version += 1
+
+    def _reembed(self, docstore, index_to_docstore_id):
+        ids = [chunk_id for chunk_id in index_to_docstore_id.values() if chunk_id not in self.tombstones]
+        if not ids:
+            self.tombstones = set()
+            return None
+        docs = [docstore.search(chunk_id) for chunk_id in ids]
+        texts = [doc.page_content for doc in docs]
+        vectors = self.embedding.embed_documents(texts)
+        self.tombstones = set()
+        return FAISS.from_embeddings(
+            list(zip(texts, vectors)), self.embedding, metadatas=[doc.metadata for doc in docs], ids=ids
+        )
+
+    def _save(self):
+        """
+        写入磁盘（先写临时文件再替换），调用方需持有文件锁。
+        """
+        if not self.index_file:
+            return
+        with self._lock:
+            state = {
+                'model_key': self.model_key,
+                'index': faiss.serialize_index(self.vector_store.index) if self.vector_store else None,
+                'docstore': self.vector_store.docstore if self.vector_store else None,
+                'index_to_docstore_id': self.vector_store.index_to_docstore_id if self.vector_store else {},
+                'doc_chunks': self.doc_chunks,
+                'tombstones': self.tombstones,
+            }
+            tmp_file = '%s.tmp-%d' % (self.index_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(state, f)
+            os.replace(tmp_file, self.index_file)
+            self._loaded_mtime = self._file_mtime()
+
+    def refresh(self):
+        """
+        其他进程更新了索引文件时重新加载。
+        """
+        if self.index_file and self._file_mtime() != self._loaded_mtime:
+            with self._write_lock:
+                self._reload()
+
+    def add_document(self, doc_id, text, metadata=None):
+        """
+        拆分并嵌入一个文档，将向量追加到索引中，不重建已有向量。
+        :param doc_id: 文档 ID
+        :param text: 文档文本
+        :param metadata: 附加到每个块上的元数据
+        :return: 新增的块数量
+        """
+        chunks = [chunk for chunk in self.text_splitter.split_text(text) if chunk.strip()]
+        # 嵌入耗时较长，不持有锁
+        vectors = self.embedding.embed_documents(chunks) if chunks else []
+        ids = [uuid.uuid4().hex for _ in chunks]
+        metadatas = [dict(metadata or {}, doc_id=doc_id, chunk_id=chunk_id) for chunk_id in ids]
+
+        with self._write_lock:
+            if self.index_file:
+                self._reload()
+            with self._lock:
+                # 重复上传同一文档时先删除旧的块
+                self.tombstones.update(self.doc_chunks.pop(doc_id, []))
+                if chunks:
+                    if self.vector_store is None:
+                        self.vector_store = FAISS.from_embeddings(
+                            list(zip(chunks, vectors)), self.embedding, metadatas=metadatas, ids=ids
+                        )
+                    else:
+                        self.vector_store.add_embeddings(list(zip(chunks, vectors)), metadatas=metadatas, ids=ids)
+                    self.doc_chunks[doc_id] = ids
+                self.version += 1
+                self._maybe_compact()
+            self._save()
+        logger.info('知识文档 %s 已加入向量库，共 %d 块', doc_id, len(chunks))
+        return len(chunks)
+
+    def remove_document(self, doc_id):
+        """
+        删除文档：只记录墓碑，检索时过滤，墓碑比例超过阈值时压缩。
+        :param doc_id: 文档 ID
+        :return: 删除的块数量
+        """
+        with self._write_lock:
+            if self.index_file:
+                self._reload()
+            with self._lock:
+                ids = self.doc_chunks.pop(doc_id, [])
+                if not ids:
+                    return 0
+                self.tombstones.update(ids)
+                self.version += 1
+                self._maybe_compact()
+            self._save()
+        return len(ids)
+
+    def _maybe_compact(self):
+        if self.vector_store is None or not self.tombstones:
+            return
+        if len(self.tombstones) >= self.compact_ratio * self.vector_store.index.ntotal:
+            self._compact()
+
+    def compact(self):
+        """
+        从索引中真正删除墓碑对应的向量并保存。
+        """
+        with self._write_lock:
+            if self.index_file:
+                self._reload()
+            self._compact()
+            self._save()
+
+    def _compact(self):
+        with self._lock:
+            if self.vector_store is None or not self.tombstones:
+                return
+            existing = set(self.vector_store.index_to_docstore_id.values())
+            dead = [chunk_id for chunk_id in self.tombstones if chunk_id in existing]
+            if len(dead) == len(existing):
+                self.vector_store = None
+            elif dead:
+                self.vector_store.delete(dead)
+            self.tombstones = set()
+            logger.info('知识库压缩完成，删除 %d 块', len(dead))
+
+    def search(self, query_vector, k=1):
+        """
+        按向量检索，过滤已删除的块。
+        :param query_vector: 查询向量
+        :param k: 返回数量
+        :return: [(Document, score)]，score 为 L2 距离，越小越相关
+        """
+        self.refresh()
+        with self._lock:
+            if self.vector_store is None:
+                return []
+            fetch_k = min(k + len(self.tombstones), self.vector_store.index.ntotal)
+            results = self.vector_store.similarity_search_with_score_by_vector(
+                np.asarray(query_vector, dtype=np.float32).tolist(), k=fetch_k
+            )
+            return [(doc, score) for doc, score in results
+                    if doc.metadata.get('chunk_id') not in self.tombstones][:k]
+
+    def lexical_search(self, query, k=50):
+        """
+        按 BM25 检索，过滤已删除的块。分区通常很小，倒排索引只保存在内存中，内容变化后首次检索时重建。
+        :param query: 查询文本
+        :param k: 返回数量
+        :return: [(Document, score)]，score 为 BM25 分数，越大越相关
+        """
+        self.refresh()
+        with self._lock:
+            if self.vector_store is None:
+                return []
+            if self._lexical is None or self._lexical[0] != self.version:
+                docs = [self.vector_store.docstore.search(chunk_id)
+                        for chunk_id in self.vector_store.index_to_docstore_id.values()
+                        if chunk_id not in self.tombstones]
+                self._lexical = (self.version, BM25Index([doc.page_content for doc in docs]), docs)
+            version, lexical, docs = self._lexical
+            return [(docs[position], score) for position, score in lexical.search(query, k=k)]
+
+
+class KnowledgePool:
+    """
+    按用户划分的知识库分区。
+    每个用户的知识文档保存在独立的向量库中，首次使用时从磁盘加载，
+    已加载的分区按 LRU 保存在内存中，总内存超过预算时淘汰最久未使用的分区（数据已落盘，淘汰只释放内存）。
+    """
+
+    def __init__(self, embedding, text_splitter, index_dir=None, model_key='', memory_budget=256 * 1024 * 1024):
+        """
+        :param embedding: 嵌入模型
+        :param text_splitter: 文本分割器
+        :param index_dir: 分区文件目录，为 None 时只保存在内存中且不淘汰
+        :param model_key: 嵌入模型标识
+        :param memory_budget: 已加载分区的内存预算（字节）
+        """
+        self.embedding = embedding
+        self.text_splitter = text_splitter
+        self.index_dir = index_dir
+        self.model_key = model_key
+        self.memory_budget = memory_budget
+
+        self._partitions = OrderedDict()
+        self._lock = threading.Lock()
+        # 已淘汰分区淘汰时的版本号，重新加载后从该值继续递增，保证每个用户的版本号单调递增
+        self._evicted_versions = {}
+
+        # 统计信息
+        self.loads = 0
+        self.evictions = 0
+
+    def _partition_file(self, owner):
+        if not self.index_dir:
+            return None
+        name = hashlib.sha1(str(owner).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.index_dir, name + '.pkl')
+
+    def _get(self, owner, create):
+        """
+        获取分区，未加载时从磁盘加载；create 为 False 且分区不存在时返回 None。
+        """
+        with self._lock:
+            partition = self._partitions.get(owner)
+            if partition is not None:
+                self._partitions.move_to_end(owner)
+                return partition
+            index_file = self._partition_file(owner)
+            if not create and (index_file is None or not os.path.exists(index_file)):
+                return None
+            partition = KnowledgeIndex(self.embedding, self.text_splitter, index_file=index_file,
+                                       model_key=self.model_key)
+            partition.version += self._evicted_versions.get(owner, 0)
+            self._partitions[owner] = partition
+            self.loads += 1
+            self._evict(keep=owner)
+            return partition
+
+    def _evict(self, keep=None):
+        """
+        超出内存预算时淘汰最久未使用的分区，调用方需持有锁。
+        """
+        if not self.index_dir:
+            return
+        total = sum(partition.memory_bytes() for partition in self._partitions.values())
+        for owner in list(self._partitions):
+            if total <= self.memory_budget:
+                break
+            if owner == keep:
+                continue
+            partition = self._partitions.pop(owner)
+            total -= partition.memory_bytes()
+            self._evicted_versions[owner] = partition.version
+            self.evictions += 1
+            logger.info('知识库分区 %s 已从内存中淘汰', owner)
+
+    def version(self, owner):
+        """
+        该用户分区内容的版本号，只在该分区变化时升高，其他用户上传或删除文档不影响。
+        """
+        if owner is None:
+            return 0
+        with self._lock:
+            partition = self._partitions.get(owner)
+            return partition.version if partition is not None else self._evicted_versions.get(owner, 0)
+
+    def refresh(self, owner):
+        """
+        其他进程更新了该用户的分区时重新加载。
+        """
+        partition = self._get(owner, create=False)
+        if partition is not None:
+            partition.refresh()
+
+    def add_document(self, owner, doc_id, text, metadata=None):
+        """
+        将文档追加到所属用户的分区中。
+        """
+        count = self._get(owner, create=True).add_document(doc_id, text, metadata)
+        with self._lock:
+            self._evict(keep=owner)
+        return count
+
+    def remove_document(self, owner, doc_id):
+        """
+        从所属用户的分区中删除文档。
+        """
+        partition = self._get(owner, create=False)
+        if partition is None:
+            return 0
+        return partition.remove_document(doc_id)
+
+    def search(self, owner, query_vector, k=1):
+        """
+        只在该用户的分区中检索，检索开销只与该用户的知识库大小有关。
+        """
+        if owner is None:
+            return []
+        partition = self._get(owner, create=False)
+        if partition is None:
+            return []
+        return partition.search(query_vector, k=k)
+
+    def lexical_search(self, owner, query, k=50):
+        """
+        只在该用户的分区中按 BM25 检索。
+        """
+        if owner is None:
+            return []
+        partition = self._get(owner, create=False)
+        if partition is None:
+            return []
+        return partition.lexical_search(query, k=k)
+
+    def stats(self):
+        """
+        :return: 分区统计信息
+        """
+        with self._lock:
+            return {
+                'loaded_partitions': len(self._partitions),
+                'memory_bytes': sum(partition.memory_bytes() for partition in self._partitions.values()),
+                'memory_budget': self.memory_budget,
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,87 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+import jieba
+import numpy as np
+
+# 纯标点、空白的词不进入索引
+_SKIP_TOKEN = re.compile(r'^[\W_]+$')
+
+
+def tokenize(text):
+    """
+    使用 jieba 搜索引擎模式分词，过滤标点和空白。
+    :param text: 文本
+    :return: 词列表
+    """
+    return [token for token in jieba.lcut_for_search(text) if token.strip() and not _SKIP_TOKEN.match(token)]
+
+
+class BM25Index:
+    """
+    基于 jieba 分词的 BM25 倒排索引，与向量库共用同一批块，文档编号即块在向量库中的位置。
+    """
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        """
+        :param texts: 块文本列表，下标即块在向量库中的位置
+        :param k1: 词频饱和参数
+        :param b: 文档长度归一化参数
+        """
+        self.k1 = k1
+        self.b = b
+        self.size = len(texts)
+
+        postings = defaultdict(lambda: ([], []))
+        lengths = np.zeros(self.size, dtype=np.float32)
+        for position, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths[position] = sum(counts.values())
+            for token, tf in counts.items():
+                docs, tfs = postings[token]
+                docs.append(position)
+                tfs.append(tf)
+
+        avg_length = float(lengths.mean()) if self.size and lengths.sum() else 1.0
+        # 预先计算每个块的长度归一化项
+        self.norms = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+        # 词 -> (块位置数组, 词频数组, idf)
+        self.postings = {}
+        for token, (docs, tfs) in postings.items():
+            df = len(docs)
+            idf = math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+            self.postings[token] = (np.asarray(docs, dtype=np.int64), np.asarray(tfs, dtype=np.float32), idf)
+
+    def search(self, query, k=50):
+        """
+        :param query: 查询文本
+        :param k: 返回数量
+        :return: [(块位置, BM25 分数)]，按分数从高到低排列
+        """
+        scores = {}
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            docs, tfs, idf = posting
+            weights = idf * tfs * (self.k1 + 1) / (tfs + self.norms[docs])
+            for position, weight in zip(docs.tolist(), weights.tolist()):
+                scores[position] = scores.get(position, 0.0) + weight
+        if not scores:
+            return []
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    倒数排名融合：多个排序结果中排名越靠前得分越高，不依赖各路分数的量纲。
+    :param rankings: 多个排序后的键列表
+    :param k: 平滑常数
+    :return: [(键, 融合分数)]，按分数从高到低排列
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,241 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from llm.RAG.RAGprompt import RAGPromptEnhancer
+from llm.RAG.ingest import expand_sources
+from llm.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class EnhancerRegistry:
+    """
+    进程级的 RAGPromptEnhancer 注册表。
+    每个工作进程只加载一次 PDF、嵌入模型和向量库，源文件发生变化时才重建。
+    """
+
+    def __init__(self, pdf_path, model_path, index_dir=None, check_interval=5.0, **enhancer_options):
+        """
+        :param pdf_path: PDF 文件路径
+        :param model_path: 嵌入模型路径
+        :param index_dir: 向量库持久化目录
+        :param check_interval: 检查源文件是否变化的最小间隔（秒）
+        :param enhancer_options: 传给 RAGPromptEnhancer 的其他参数
+        """
+        self.pdf_path = pdf_path
+        self.model_path = model_path
+        self.index_dir = index_dir
+        self.check_interval = check_interval
+        self.enhancer_options = enhancer_options
+
+        self._enhancer = None
+        self._signature = None
+        self._last_check = 0.0
+        self._state = 'cold'  # cold / loading / ready / failed
+        self._error = None
+        self._loaded_at = None
+        self._load_seconds = None
+
+        # 保护状态字段
+        self._lock = threading.Lock()
+        # 保证同一时间只有一个线程在构建
+        self._build_lock = threading.Lock()
+
+    def _source_signature(self):
+        """
+        计算源文件签名（路径、修改时间、大小），用于判断是否需要重建。
+        """
+        signature = []
+        for path in expand_sources(self.pdf_path) + [self.model_path]:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def _build(self, signature):
+        """
+        构建新的 enhancer 并替换当前实例，调用方需持有 _build_lock。
+        """
+        with self._lock:
+            if self._enhancer is None:
+                self._state = 'loading'
+        start = time.monotonic()
+        try:
+            enhancer = RAGPromptEnhancer(self.pdf_path, self.model_path, index_dir=self.index_dir,
+                                         **self.enhancer_options)
+        except Exception as e:
+            logger.exception('RAGPromptEnhancer 加载失败')
+            with self._lock:
+                self._error = str(e)
+                if self._enhancer is None:
+                    self._state = 'failed'
+            raise
+        with self._lock:
+            self._enhancer = enhancer
+            self._signature = signature
+            self._state = 'ready'
+            self._error = None
+            self._loaded_at = time.time()
+            self._load_seconds = time.monotonic() - start
+            self._last_check = time.monotonic()
+        logger.info('RAGPromptEnhancer 加载完成，耗时 %.2fs', self._load_seconds)
+        return enhancer
+
+    def get(self):
+        """
+        获取可用的 enhancer。首次调用时阻塞加载；
+        源文件变化时由一个线程负责重建，其余线程继续使用旧实例。
+        :return: RAGPromptEnhancer 实例
+        """
+        enhancer = self._enhancer
+        if enhancer is not None and time.monotonic() - self._last_check < self.check_interval:
+            return enhancer
+
+        signature = self._source_signature()
+        if enhancer is not None:
+            if signature == self._signature:
+                self._last_check = time.monotonic()
+                return enhancer
+            # 已有可用实例时不阻塞，其他线程正在重建则继续使用旧实例
+            if not self._build_lock.acquire(blocking=False):
+                return enhancer
+            try:
+                if signature != self._signature:
+                    logger.info('RAG 源文件发生变化，重新构建向量库')
+                    return self._build(signature)
+                return self._enhancer
+            finally:
+                self._build_lock.release()
+
+        with self._build_lock:
+            if self._enhancer is not None:
+                return self._enhancer
+            return self._build(signature)
+
+    def warm_up(self, background=True):
+        """
+        预热：提前加载 enhancer，避免第一个请求承担加载开销。
+        :param background: 是否在后台线程中加载
+        """
+        if not background:
+            return self.get()
+        thread = threading.Thread(target=self._warm_up_quietly, name='rag-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_up_quietly(self):
+        try:
+            self.get()
+        except Exception:
+            # 错误已记录在状态中，请求到来时会再次尝试加载
+            pass
+
+    def is_ready(self):
+        """
+        :return: enhancer 是否已经加载完成
+        """
+        return self._enhancer is not None
+
+    def status(self):
+        """
+        :return: 注册表状态信息
+        """
+        with self._lock:
+            return {
+                'state': self._state,
+                'ready': self._enhancer is not None,
+                'pdf_path': self.pdf_path,
+                'model_path': self.model_path,
+                'index_key': self._enhancer.index_key if self._enhancer else None,
+                'loaded_at': self._loaded_at,
+                'load_seconds': self._load_seconds,
+                'error': self._error,
+                'embedding': self._enhancer.embedding.stats() if self._enhancer else None,
+                'cache': self._enhancer.cache.stats() if self._enhancer else None,
+                'query_vector_cache': self._enhancer.query_vectors.stats() if self._enhancer else None,
+                'knowledge': self._enhancer.knowledge.stats() if self._enhancer else None,
+            }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    获取当前进程的注册表实例，路径从 Django 配置中读取。
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = EnhancerRegistry(
+                    get_setting('RAG_PDF_PATH'),
+                    get_setting('RAG_MODEL_PATH'),
+                    index_dir=get_setting('RAG_INDEX_DIR'),
+                    check_interval=get_setting('RAG_RELOAD_CHECK_INTERVAL', 5.0),
+                    embed_batch_window_ms=get_setting('RAG_EMBED_BATCH_WINDOW_MS', 10),
+                    embed_max_batch_size=get_setting('RAG_EMBED_MAX_BATCH_SIZE', 32),
+                    cache_size=get_setting('RAG_CACHE_SIZE', 1024),
+                    cache_ttl=get_setting('RAG_CACHE_TTL', 600),
+                    knowledge_memory_budget_mb=get_setting('RAG_KNOWLEDGE_MEMORY_BUDGET_MB', 256),
+                    index_type=get_setting('RAG_INDEX_TYPE', 'flat'),
+                    index_nlist=get_setting('RAG_INDEX_NLIST', 100),
+                    index_pq_m=get_setting('RAG_INDEX_PQ_M', 16),
+                    index_nprobe=get_setting('RAG_INDEX_NPROBE', 8),
+                    retrieval_mode=get_setting('RAG_RETRIEVAL_MODE', 'dense'),
+                    lexical_candidates=get_setting('RAG_LEXICAL_CANDIDATES', 50),
+                    top_k=get_setting('RAG_TOP_K', 1),
+                    ingest_workers=get_setting('RAG_INGEST_WORKERS'),
+                    ingest_batch_size=get_setting('RAG_INGEST_BATCH_SIZE', 64),
+                )
+    return _registry
+
+
+def get_enhancer():
+    """
+    获取当前进程共享的 RAGPromptEnhancer 实例。
+    """
+    return get_registry().get()
+
+
+# 知识文档后台索引；单线程执行，保证同一文档的新增和删除按提交顺序进行
+_indexing_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='knowledge-indexer')
+
+
+def _run_indexing(action, owner, doc_id, *args):
+    try:
+        knowledge = get_enhancer().knowledge
+        if action == 'add':
+            return knowledge.add_document(owner, doc_id, *args)
+        return knowledge.remove_document(owner, doc_id)
+    except Exception:
+        logger.exception('知识文档 %s 索引失败', doc_id)
+        raise
+
+
+def submit_knowledge_document(owner, doc_id, text, metadata=None):
+    """
+    在后台拆分、嵌入知识文档，并追加到所属用户的向量库中。
+    :param owner: 用户名
+    :param doc_id: 文档 ID
+    :param text: 文档文本
+    :param metadata: 附加到每个块上的元数据
+    :return: Future
+    """
+    return _indexing_executor.submit(_run_indexing, 'add', owner, doc_id, text, metadata)
+
+
+def submit_knowledge_removal(owner, doc_id):
+    """
+    在后台将知识文档的向量标记为删除。
+    :param owner: 用户名
+    :param doc_id: 文档 ID
+    :return: Future
+    """
+    return _indexing_executor.submit(_run_indexing, 'remove', owner, doc_id)
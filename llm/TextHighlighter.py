@@ -1,5 +1,7 @@
 from difflib import SequenceMatcher
 
+from llm.diff import decode_ops, diff_opcodes, encode_ops, matching_blocks
+
 class TextHighlighter:
     def __init__(self, original_text, corrected_text):
         """
@@ -9,21 +11,216 @@ class TextHighlighter:
         """
         self.original_text = original_text
         self.corrected_text = corrected_text
+        self._opcodes = None
 
     def highlight_differences(self):
         """
         比对原始文本和更正后的文本，标记出不同的部分。
         :return: 标记后的文本（HTML格式）
         """
-        matcher = SequenceMatcher(None, self.original_text, self.corrected_text)
-        highlighted_text = ""
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-            if tag == 'replace' or tag == 'delete' or tag == 'insert':
-                # 标记不同部分
-                highlighted_text += f'<span style="text-decoration: underline wavy red;">{self.corrected_text[j1:j2]}</span>'
-            else:
-                # 相同部分
-                highlighted_text += self.corrected_text[j1:j2]
+        return render_opcodes(self.opcodes(), self.corrected_text)
+
+    def opcodes(self):
+        """
+        :return: 字符级编辑操作 [(tag, i1, i2, j1, j2)]，见 llm.diff.diff_opcodes
+        """
+        if self._opcodes is None:
+            self._opcodes = diff_opcodes(self.original_text, self.corrected_text)
+        return self._opcodes
+
+    def ops(self):
+        """
+        :return: 序列化的编辑操作，随纠错记录保存，之后用 render_ops 渲染，不必重新比对
+        """
+        return encode_ops(self.opcodes())
+
+
+def render_opcodes(opcodes, corrected_text):
+    """
+    按比对结果渲染更正后的文本，不同的部分加上波浪线。
+    :param opcodes: diff_opcodes() 或 SequenceMatcher.get_opcodes() 的结果
+    :param corrected_text: 更正后的文本
+    :return: 标记后的文本（HTML格式）
+    """
+    # 先收集片段再一次拼接，避免长文本反复拼接字符串
+    parts = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'replace' or tag == 'delete' or tag == 'insert':
+            # 标记不同部分
+            parts.append(f'<span style="text-decoration: underline wavy red;">{corrected_text[j1:j2]}</span>')
+        else:
+            # 相同部分
+            parts.append(corrected_text[j1:j2])
+    return ''.join(parts)
+
+
+def render_ops(ops, original_text, corrected_text):
+    """
+    按保存的编辑操作渲染更正后的文本。
+    :param ops: TextHighlighter.ops() 的结果，为空（旧记录）时重新比对
+    :param original_text: 原始文本
+    :param corrected_text: 更正后的文本
+    :return: 标记后的文本（HTML格式）
+    """
+    if not ops:
+        return TextHighlighter(original_text, corrected_text).highlight_differences()
+    return render_opcodes(decode_ops(ops, len(original_text), len(corrected_text)), corrected_text)
+
+
+def _split(text, separator):
+    """
+    逐段产出 (段落起始位置, 段落)，不一次性拆分整篇文本。
+    """
+    start = 0
+    while True:
+        end = text.find(separator, start)
+        if end < 0:
+            yield start, text[start:]
+            return
+        yield start, text[start:end]
+        start = end + len(separator)
+
+
+class ParagraphHighlighter:
+    """
+    大文档的分段标记：原文和更正后的文本按段落对齐，逐对比对并逐段产出 HTML 片段，
+    耗时和峰值内存取决于最长的段落，而不是整篇文档。
+    段落数相同时按顺序一一对应；不同时（模型合并或拆分了段落）先按段落比对，
+    相同的段落直接对应，其余连续的不同段落合并为一组再比对。
+    """
+
+    def __init__(self, original_text, corrected_text, separator='\n'):
+        """
+        :param original_text: 原始文本
+        :param corrected_text: 更正后的文本
+        :param separator: 段落分隔符
+        """
+        self.original_text = original_text
+        self.corrected_text = corrected_text
+        self.separator = separator
+        # 全文坐标下的编辑操作，fragments() 产出完毕后可以用 ops() 保存
+        self.edits = []
+
+    def pairs(self):
+        """
+        :return: 对齐的段落 [(原文起始位置, 原文段落, 更正文本起始位置, 更正段落)]，按顺序产出；
+                 只在一侧出现的段落（被删除或新增）不产出，由 fragments() 作为段落之间的差异处理
+        """
+        separator = self.separator
+        if self.original_text.count(separator) == self.corrected_text.count(separator):
+            for (i, source), (j, target) in zip(_split(self.original_text, separator),
+                                                _split(self.corrected_text, separator)):
+                yield i, source, j, target
+            return
+
+        sources = list(_split(self.original_text, separator))
+        targets = list(_split(self.corrected_text, separator))
+        blocks = matching_blocks([source for i, source in sources], [target for j, target in targets])
+        a = b = 0
+        for block_a, block_b, size in blocks + [(len(sources), len(targets), 0)]:
+            if block_a - a == block_b - b:
+                yield from (sources[k] + targets[b + k - a] for k in range(a, block_a))
+            elif a < block_a and b < block_b:
+                # 段落数不同的一组合并比对
+                yield (sources[a][0], separator.join(source for i, source in sources[a:block_a]),
+                       targets[b][0], separator.join(target for j, target in targets[b:block_b]))
+            yield from (sources[block_a + k] + targets[block_b + k] for k in range(size))
+            a, b = block_a + size, block_b + size
+
+    def _render(self, opcodes, i, j, target):
+        """
+        渲染一段的比对结果，同时把编辑操作换算到全文坐标。
+        """
+        self.edits.extend((tag, i1 + i, i2 + i, j1 + j, j2 + j) for tag, i1, i2, j1, j2 in opcodes
+                          if tag != 'equal')
+        return render_opcodes(opcodes, target)
+
+    def _gap(self, i1, i2, j1, j2):
+        """
+        对齐的段落之间通常只有分隔符；有段落被删除或新增时整体视为一处差异。
+        """
+        source, target = self.original_text[i1:i2], self.corrected_text[j1:j2]
+        if source == target:
+            return target
+        tag = 'replace' if source and target else ('delete' if source else 'insert')
+        return self._render([(tag, 0, len(source), 0, len(target))], i1, j1, target)
+
+    def fragments(self):
+        """
+        :return: 标记后的 HTML 片段生成器，依次拼接即为整篇文档的标记结果
+        """
+        i_end = j_end = 0
+        for i, source, j, target in self.pairs():
+            gap = self._gap(i_end, i, j_end, j)
+            yield gap + self._render(diff_opcodes(source, target), i, j, target)
+            i_end, j_end = i + len(source), j + len(target)
+        gap = self._gap(i_end, len(self.original_text), j_end, len(self.corrected_text))
+        if gap:
+            yield gap
+
+    def ops(self):
+        """
+        :return: 序列化的编辑操作，格式同 TextHighlighter.ops()
+        """
+        return encode_ops(self.edits)
+
+
+class IncrementalHighlighter:
+    """
+    流式输出时的增量标记：更正后的文本逐段到达，只输出已经稳定的前缀。
+    尚未确定的尾部与原文剩余部分比对，找到足够长的相同片段作为锚点，锚点之前的部分不会再变化，
+    渲染后输出，并从原文和未确定文本中同时截掉。
+    """
+
+    def __init__(self, original_text, anchor=4, slack=64):
+        """
+        :param original_text: 原始文本
+        :param anchor: 作为锚点的相同片段的最小长度
+        :param slack: 比对时原文窗口比未确定文本多出的长度，容纳模型删除的内容
+        """
+        self.original_text = original_text
+        self.anchor = anchor
+        self.slack = slack
+        self.corrected_text = ""
+        self._source_pos = 0
+        self._pending = ""
+
+    def _opcodes(self, source):
+        # 窗口较小，用 SequenceMatcher 的最长相同片段优先对齐：原文窗口比未确定文本多出的尾部应整体视为删除，
+        # 最短编辑脚本在重复文本中可能把删除放在中间，锚点会错位
+        return SequenceMatcher(None, source, self._pending, autojunk=False).get_opcodes()
+
+    def feed(self, delta):
+        """
+        :param delta: 新到达的文本片段
+        :return: 新稳定部分的标记文本，没有时返回空字符串
+        """
+        self.corrected_text += delta
+        self._pending += delta
+        end = self._source_pos + len(self._pending) + self.slack
+        opcodes = self._opcodes(self.original_text[self._source_pos:end])
+        # 最后一个足够长的相同片段作为锚点
+        cut = None
+        for index, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+            if tag == 'equal' and j2 - j1 >= self.anchor:
+                cut = index
+        if cut is None:
+            return ""
+        tag, i1, i2, j1, j2 = opcodes[cut]
+        highlighted_text = render_opcodes(opcodes[:cut + 1], self._pending)
+        self._source_pos += i2
+        self._pending = self._pending[j2:]
+        return highlighted_text
+
+    def finish(self):
+        """
+        流结束时，比对剩余部分。
+        :return: 剩余部分的标记文本
+        """
+        opcodes = self._opcodes(self.original_text[self._source_pos:])
+        highlighted_text = render_opcodes(opcodes, self._pending)
+        self._source_pos = len(self.original_text)
+        self._pending = ""
         return highlighted_text
 
 
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import threading
+import weakref
+
+from llm.chunking import count_tokens
+from llm.config import get_setting
+from llm.qwen import AsyncChatCompletion
+
+logger = logging.getLogger(__name__)
+
+
+def plausible(sentence, result):
+    """
+    粗略检查合并请求中某个句子的结果是否与原句对应：纠错只做少量增删改，长度不应相差太多。
+    结果错位（模型漏掉或合并了句子）时长度通常对不上。
+    """
+    return abs(len(result) - len(sentence)) <= max(8, len(sentence) // 2)
+
+
+def render_key(render):
+    """
+    渲染函数的标识。每个请求各自创建的渲染函数（如视图中的 lambda）是不同的对象，
+    同一处代码创建、捕获的值（上下文、RAG 实例等）都相同时才视为同一个 prompt。
+    :param render: 渲染函数，None 表示原样发送
+    :return: 可哈希的标识
+    """
+    if render is None or not hasattr(render, '__code__'):
+        return render
+    captured = tuple(cell.cell_contents for cell in render.__closure__ or ())
+    try:
+        hash(captured)
+    except TypeError:
+        # 捕获了不可哈希的值，只与自身合并
+        return render
+    return render.__code__, captured
+
+
+class _LoopState:
+    def __init__(self, concurrency):
+        # 按 (上下文, 渲染函数标识) 划分的待发送批次
+        self.pending = {}
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # 持有发送任务的引用，避免任务被垃圾回收
+        self.tasks = set()
+
+
+class _Batch:
+    def __init__(self, key, context, render):
+        self.key = key
+        self.context = context
+        self.render = render
+        self.sentences = []
+        self.futures = []
+        self.tokens = 0
+        self.timer = None
+
+
+class SentenceBatcher:
+    """
+    多句合并请求：把同一请求或同时到达的多个请求中的句子合并为一次模型调用，共用纠错 prompt，
+    按 token 预算和句子数分批，模型以 JSON 数组返回各句结果。
+    RAG 上下文和渲染 prompt 的方式都相同的句子才会合并（单独重试时按批次的渲染函数发送）；
+    解析失败或与原句对不上的句子单独再请求一次。
+    """
+
+    def __init__(self, chat=None, max_tokens=None, max_sentences=None, window=None, concurrency=None):
+        """
+        :param chat: AsyncChatCompletion 实例
+        :param max_tokens: 每批句子的最大 token 数，默认读取 LLM_BATCH_MAX_TOKENS 配置
+        :param max_sentences: 每批的最大句子数，默认读取 LLM_BATCH_MAX_SENTENCES 配置
+        :param window: 第一个句子到达后最多等待多久（秒）再发送，默认读取 LLM_BATCH_WINDOW 配置
+        :param concurrency: 同时发送的最大批数，默认读取 LLM_CHUNK_CONCURRENCY 配置
+        """
+        self.chat = chat or AsyncChatCompletion()
+        self.max_tokens = max_tokens or get_setting('LLM_BATCH_MAX_TOKENS', 1024)
+        self.max_sentences = max_sentences or get_setting('LLM_BATCH_MAX_SENTENCES', 20)
+        self.window = get_setting('LLM_BATCH_WINDOW', 0.02) if window is None else window
+        self.concurrency = concurrency or get_setting('LLM_CHUNK_CONCURRENCY', 8)
+        # 每个事件循环各自的待发送批次和并发信号量
+        self._loops = weakref.WeakKeyDictionary()
+
+        # 统计信息
+        self.batches = 0
+        self.sentences = 0
+        self.singles = 0
+        self.parse_failures = 0
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = _LoopState(self.concurrency)
+        return state
+
+    async def correct(self, sentence, context=None, render=None):
+        """
+        :param sentence: 待纠错的句子
+        :param context: RAG 上下文，只有上下文相同的句子才会合并
+        :param render: 将句子渲染为单独请求时发送给模型的内容，默认原样发送；渲染方式不同的句子不会合并
+        :return: 纠错后的句子
+        """
+        pending = self._state().pending
+        tokens = count_tokens(sentence)
+        key = (context, render_key(render))
+        batch = pending.get(key)
+        if batch is not None and batch.tokens + tokens > self.max_tokens:
+            self._flush(batch)
+            batch = None
+        if batch is None:
+            batch = pending[key] = _Batch(key, context, render)
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, batch)
+        future = asyncio.get_running_loop().create_future()
+        batch.sentences.append(sentence)
+        batch.futures.append(future)
+        batch.tokens += tokens
+        if len(batch.sentences) >= self.max_sentences or batch.tokens >= self.max_tokens:
+            self._flush(batch)
+        return await future
+
+    def _flush(self, batch):
+        state = self._state()
+        if state.pending.get(batch.key) is batch:
+            del state.pending[batch.key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        task = asyncio.ensure_future(self._send(batch, state.semaphore))
+        state.tasks.add(task)
+        task.add_done_callback(state.tasks.discard)
+
+    async def _single(self, batch, sentence):
+        self.singles += 1
+        return await self.chat.get_response(batch.render(sentence) if batch.render else sentence)
+
+    async def _send(self, batch, semaphore):
+        # 所有等待者都已取消（如客户端断开）时不再请求
+        if all(future.done() for future in batch.futures):
+            return
+        try:
+            async with semaphore:
+                if len(batch.sentences) == 1:
+                    results = [await self._single(batch, batch.sentences[0])]
+                else:
+                    self.batches += 1
+                    self.sentences += len(batch.sentences)
+                    results = await self.chat.get_batch_response(batch.sentences, batch.context)
+            # 解析失败的句子单独重试
+            retry = [number for number, (sentence, result) in enumerate(zip(batch.sentences, results))
+                     if result is None or not plausible(sentence, result)]
+            if retry:
+                self.parse_failures += len(retry)
+                logger.info('合并请求中 %d/%d 个句子无法解析，单独重试', len(retry), len(batch.sentences))
+
+                async def single(number):
+                    async with semaphore:
+                        results[number] = await self._single(batch, batch.sentences[number])
+
+                await asyncio.gather(*(single(number) for number in retry))
+        except Exception as e:
+            # 整批失败（含熔断）时交给各调用方决定是否重试
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        for future, result in zip(batch.futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'batched_sentences': self.sentences,
+            'sentences_per_batch': self.sentences / self.batches if self.batches else 0.0,
+            'single_requests': self.singles,
+            'parse_failures': self.parse_failures,
+        }
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    """
+    获取当前进程共享的多句合并器，同一事件循环中并发请求的句子可以合并；未启用时返回 None。
+    """
+    global _batcher
+    if not get_setting('LLM_BATCH_ENABLED', False):
+        return None
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = SentenceBatcher()
+    return _batcher
@@ -0,0 +1,87 @@
+import functools
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# 句末标点（含其后紧跟的引号、括号），在其后断句
+_SENTENCE_END = re.compile(r'[^。！？；!?;…]*(?:[。！？；!?;]+|…+)[”’"』」）)]*|[^。！？；!?;…]+$')
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(name):
+    """
+    加载 tiktoken 编码；未安装 tiktoken 或离线无法下载编码文件时返回 None。
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning('tiktoken 编码 %s 不可用，按字符数估算 token 数: %s', name, e)
+        return None
+
+
+def count_tokens(text, encoding='cl100k_base'):
+    """
+    统计文本的 token 数，tiktoken 不可用时以字符数近似（中文一个字约一个 token）。
+    :param text: 文本
+    :param encoding: tiktoken 编码名称
+    :return: token 数
+    """
+    enc = _get_encoding(encoding)
+    if enc is None:
+        return len(text)
+    return len(enc.encode(text))
+
+
+def split_sentences(text):
+    """
+    按句末标点断句，保留标点和原有空白，拼接结果与原文完全一致。
+    :param text: 一个段落的文本
+    :return: 句子列表
+    """
+    return [sentence for sentence in _SENTENCE_END.findall(text) if sentence]
+
+
+def _split_long(sentence, max_tokens, count):
+    """
+    没有标点、超过预算的长句按字符数硬切分。
+    """
+    size = max(1, len(sentence) * max_tokens // max(count(sentence), 1))
+    return [sentence[start:start + size] for start in range(0, len(sentence), size)]
+
+
+def chunk_text(text, max_tokens=512, count=count_tokens, pack=True):
+    """
+    将文档拆成待纠错的块：块不跨段落，段落超过 token 预算时按句子拆开，再把相邻句子合并到预算以内。
+    :param text: 文档文本，段落之间以换行分隔
+    :param max_tokens: 每块的最大 token 数
+    :param count: token 计数函数
+    :param pack: 为 False 时每个句子单独成块（句子级缓存使用）
+    :return: [(块文本, 块后的分隔符)]，依次拼接 块文本 + 分隔符 即还原原文；空白块不需要纠错
+    """
+    chunks = []
+    paragraphs = text.split('\n')
+    for number, paragraph in enumerate(paragraphs):
+        separator = '\n' if number < len(paragraphs) - 1 else ''
+        if pack and count(paragraph) <= max_tokens:
+            chunks.append((paragraph, separator))
+            continue
+
+        pieces = []
+        for sentence in split_sentences(paragraph):
+            if count(sentence) > max_tokens:
+                pieces.extend(_split_long(sentence, max_tokens, count))
+            else:
+                pieces.append(sentence)
+
+        current, current_tokens = '', 0
+        for piece in pieces:
+            tokens = count(piece)
+            if current and (not pack or current_tokens + tokens > max_tokens):
+                chunks.append((current, ''))
+                current, current_tokens = '', 0
+            current += piece
+            current_tokens += tokens
+        chunks.append((current, separator))
+    return chunks
@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from llm.config import get_setting
+from llm.limiter import LLMResponseError
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt, base, maximum):
+    """
+    带抖动的指数退避（full jitter）：在 [0, min(maximum, base * 2^attempt)] 中随机取值，
+    避免大量请求在同一时刻重试。
+    :param attempt: 已重试次数，从 0 开始
+    :param base: 基础等待时间（秒）
+    :param maximum: 最大等待时间（秒）
+    :return: 等待时间（秒）
+    """
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+
+def is_retried(error):
+    """
+    HTTP 客户端是否已经对该错误按退避重试过：5xx 和连接错误。
+    上层再重试这类错误会使重试次数相乘，放大故障时对模型服务的压力。
+    """
+    if isinstance(error, LLMResponseError):
+        return error.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, httpx.ConnectError, httpx.ConnectTimeout,
+                              httpx.RemoteProtocolError))
+
+
+class LLMHttpClient:
+    """
+    进程内共享的 HTTP 客户端：复用 keep-alive 连接池，设置连接/读取超时，
+    对 5xx 和连接错误按带抖动的指数退避重试。
+    """
+
+    def __init__(self, pool_size=20, connect_timeout=3.05, read_timeout=120, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0):
+        """
+        :param pool_size: 每个主机的最大连接数
+        :param connect_timeout: 连接超时（秒）
+        :param read_timeout: 读取超时（秒）
+        :param max_retries: 最大重试次数
+        :param backoff_base: 退避基础时间（秒）
+        :param backoff_max: 退避最大时间（秒）
+        """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._adapter = None
+        self._pid = None
+
+        # 统计信息
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.status_counts = {}
+
+    def _get_session(self):
+        """
+        获取连接池；fork 出的子进程不能复用父进程的连接，需要重新创建。
+        """
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._adapter = adapter
+                    self._pid = os.getpid()
+        return self._session
+
+    def _count_status(self, status):
+        with self._lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def post(self, url, max_retries=None, **kwargs):
+        """
+        发送 POST 请求，5xx 和连接错误时重试。
+        :param url: 请求地址
+        :param max_retries: 本次请求的最大重试次数，默认使用客户端配置；在多个副本间重试的调用方传 0，自行换副本重试
+        :return: requests.Response
+        """
+        session = self._get_session()
+        kwargs.setdefault('timeout', self.timeout)
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                response = session.post(url, **kwargs)
+            except requests.ConnectionError as e:
+                # 包括连接超时；读取超时不重试，避免一个卡住的请求占用数倍的超时时间
+                self._count_status(type(e).__name__)
+                if attempt >= max_retries:
+                    self.failures += 1
+                    raise
+                logger.warning('请求 %s 连接失败，第 %d 次重试: %s', url, attempt + 1, e)
+            except requests.RequestException as e:
+                self._count_status(type(e).__name__)
+                self.failures += 1
+                raise
+            else:
+                self._count_status(response.status_code)
+                if response.status_code < 500 or attempt >= max_retries:
+                    if response.status_code >= 500:
+                        self.failures += 1
+                    return response
+                logger.warning('请求 %s 返回 %d，第 %d 次重试', url, response.status_code, attempt + 1)
+                response.close()
+            time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            attempt += 1
+            self.retries += 1
+
+    def get(self, url, **kwargs):
+        """
+        发送 GET 请求，不重试（用于健康检查）。
+        :param url: 请求地址
+        :return: requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self._get_session().get(url, **kwargs)
+
+    def pool_stats(self):
+        """
+        :return: 各主机连接池的连接数和空闲连接数
+        """
+        pools = {}
+        adapter = self._adapter
+        if adapter is None:
+            return pools
+        for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools['%s://%s:%s' % (pool.scheme, pool.host, pool.port)] = {
+                'connections_created': pool.num_connections,
+                'requests': pool.num_requests,
+                # 队列中的 None 是尚未创建连接的占位
+                'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+                'max_size': pool.pool.maxsize if pool.pool is not None else self.pool_size,
+            }
+        return pools
+
+    def stats(self):
+        """
+        :return: 请求统计和连接池信息
+        """
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'status_counts': {str(key): value for key, value in self.status_counts.items()},
+            'timeout': self.timeout,
+            'pools': self.pool_stats(),
+        }
+
+
+class AsyncLLMHttpClient:
+    """
+    异步 HTTP 客户端：基于 httpx.AsyncClient 的 keep-alive 连接池，超时和重试策略与 LLMHttpClient 相同。
+    httpx 的连接池绑定在事件循环上，每个事件循环各自持有一个连接池。
+    """
+
+    def __init__(self, pool_size=100, connect_timeout=3.05, read_timeout=120, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0):
+        """
+        :param pool_size: 最大连接数
+        :param connect_timeout: 连接超时（秒）
+        :param read_timeout: 读取超时（秒）
+        :param max_retries: 最大重试次数
+        :param backoff_base: 退避基础时间（秒）
+        :param backoff_max: 退避最大时间（秒）
+        """
+        self.pool_size = pool_size
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._clients = weakref.WeakKeyDictionary()
+
+        # 统计信息
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.status_counts = {}
+
+    def _get_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+            self._clients[loop] = client
+        return client
+
+    def _count_status(self, status):
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    async def post(self, url, max_retries=None, **kwargs):
+        """
+        发送 POST 请求，5xx 和连接错误时重试。
+        :param url: 请求地址
+        :param max_retries: 本次请求的最大重试次数，默认使用客户端配置
+        :return: httpx.Response
+        """
+        client = self._get_client()
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                response = await client.post(url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                self._count_status(type(e).__name__)
+                if attempt >= max_retries:
+                    self.failures += 1
+                    raise
+                logger.warning('请求 %s 连接失败，第 %d 次重试: %s', url, attempt + 1, e)
+            except httpx.HTTPError as e:
+                self._count_status(type(e).__name__)
+                self.failures += 1
+                raise
+            else:
+                self._count_status(response.status_code)
+                if response.status_code < 500 or attempt >= max_retries:
+                    if response.status_code >= 500:
+                        self.failures += 1
+                    return response
+                logger.warning('请求 %s 返回 %d，第 %d 次重试', url, response.status_code, attempt + 1)
+            await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            attempt += 1
+            self.retries += 1
+
+    async def aclose(self):
+        """
+        关闭当前事件循环的连接池，事件循环关闭之前调用。
+        """
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    def stats(self):
+        """
+        :return: 请求统计
+        """
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'status_counts': {str(key): value for key, value in self.status_counts.items()},
+            'event_loops': len(self._clients),
+        }
+
+
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    获取当前进程共享的 HTTP 客户端，参数从 Django 配置中读取。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LLMHttpClient(
+                    pool_size=get_setting('LLM_POOL_SIZE', 20),
+                    connect_timeout=get_setting('LLM_CONNECT_TIMEOUT', 3.05),
+                    read_timeout=get_setting('LLM_READ_TIMEOUT', 120),
+                    max_retries=get_setting('LLM_MAX_RETRIES', 3),
+                    backoff_base=get_setting('LLM_BACKOFF_BASE', 0.5),
+                    backoff_max=get_setting('LLM_BACKOFF_MAX', 8.0),
+                )
+    return _client
+
+
+def get_async_client():
+    """
+    获取当前进程共享的异步 HTTP 客户端，参数从 Django 配置中读取。
+    """
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncLLMHttpClient(
+                    pool_size=get_setting('LLM_ASYNC_POOL_SIZE', 100),
+                    connect_timeout=get_setting('LLM_CONNECT_TIMEOUT', 3.05),
+                    read_timeout=get_setting('LLM_READ_TIMEOUT', 120),
+                    max_retries=get_setting('LLM_MAX_RETRIES', 3),
+                    backoff_base=get_setting('LLM_BACKOFF_BASE', 0.5),
+                    backoff_max=get_setting('LLM_BACKOFF_MAX', 8.0),
+                )
+    return _async_client
@@ -0,0 +1,15 @@
+from django.core.exceptions import ImproperlyConfigured
+
+
+def get_setting(name, default=None):
+    """
+    读取 Django 配置项，未配置 Django（例如直接运行脚本）时返回默认值。
+    :param name: 配置项名称
+    :param default: 默认值
+    :return: 配置值
+    """
+    from django.conf import settings
+    try:
+        return getattr(settings, name, default)
+    except ImproperlyConfigured:
+        return default
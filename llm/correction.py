@@ -0,0 +1,220 @@
+import asyncio
+import logging
+
+from llm.batching import get_batcher, plausible
+from llm.chunking import chunk_text, count_tokens, split_sentences
+from llm.client import backoff_delay, is_retried
+from llm.config import get_setting
+from llm.correction_cache import get_correction_cache
+from llm.detector import get_detector
+from llm.limiter import LLMUnavailable
+from llm.qwen import PROMPT_VERSION, AsyncChatCompletion
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentCorrector:
+    """
+    长文档纠错：按段落和句子拆成 token 预算以内的块，有限并发地分别纠错，再按原顺序拼接。
+    单个块失败时只重试该块，整体耗时取决于最慢的块而不是所有块之和。
+    启用纠错缓存时按句子拆块，已缓存的句子直接复用结果；本地检测判定无错误的块原样返回，
+    剩下的句子按段落和 token 预算重新合并后请求模型。启用多句合并时按句子拆块，多个句子合并为一次请求。
+    """
+
+    def __init__(self, chat=None, max_tokens=None, concurrency=None, max_retries=None,
+                 backoff_base=None, backoff_max=None, cache=None, detector=None, batcher=None):
+        """
+        :param chat: AsyncChatCompletion 实例
+        :param max_tokens: 每块的最大 token 数，默认读取 LLM_CHUNK_MAX_TOKENS 配置
+        :param concurrency: 同时纠错的最大块数，默认读取 LLM_CHUNK_CONCURRENCY 配置
+        :param max_retries: 单个块的最大重试次数，默认读取 LLM_CHUNK_MAX_RETRIES 配置
+        :param backoff_base: 退避基础时间（秒）
+        :param backoff_max: 退避最大时间（秒）
+        :param cache: CorrectionCache 实例，默认使用 get_correction_cache()
+        :param detector: LocalDetector 实例，默认使用 get_detector()
+        :param batcher: SentenceBatcher 实例，默认使用 get_batcher()
+        """
+        self.chat = chat or AsyncChatCompletion()
+        self.cache = cache or get_correction_cache()
+        self.detector = detector or get_detector()
+        self.batcher = batcher or get_batcher()
+        self.max_tokens = max_tokens or get_setting('LLM_CHUNK_MAX_TOKENS', 512)
+        self.concurrency = concurrency or get_setting('LLM_CHUNK_CONCURRENCY', 8)
+        self.max_retries = get_setting('LLM_CHUNK_MAX_RETRIES', 2) if max_retries is None else max_retries
+        self.backoff_base = backoff_base or get_setting('LLM_BACKOFF_BASE', 0.5)
+        self.backoff_max = backoff_max or get_setting('LLM_BACKOFF_MAX', 8.0)
+
+    async def correct_chunk(self, chunk, semaphore=None, request=None):
+        """
+        纠错单个块，失败时按带抖动的指数退避重试；退避等待期间不占用并发名额。
+        HTTP 客户端已经重试过的错误不再重试，避免两层重试次数相乘。
+        :param chunk: 块文本
+        :param semaphore: 限制并发的信号量
+        :param request: 发送请求的函数，默认 chat.get_response
+        :return: 纠错后的文本
+        """
+        attempt = 0
+        while True:
+            try:
+                if request is not None:
+                    return await request(chunk)
+                if semaphore is None:
+                    return await self.chat.get_response(chunk)
+                async with semaphore:
+                    return await self.chat.get_response(chunk)
+            except LLMUnavailable:
+                # 熔断或排队超时，重试只会加重拥塞
+                raise
+            except Exception as e:
+                # 5xx 和连接错误已由 HTTP 客户端重试过，这里只重试读取超时、响应解析失败等其他错误
+                if attempt >= self.max_retries or is_retried(e):
+                    raise
+                logger.warning('块纠错失败，第 %d 次重试: %s', attempt + 1, e)
+            await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            attempt += 1
+
+    def _pack(self, units, misses):
+        """
+        把同一段落中相邻的未命中句子合并到 token 预算以内，作为一次请求发送，
+        避免启用句子级缓存后每个句子单独携带完整的纠错 prompt。
+        :param units: [块文本, 分隔符, 结果]，结果为 None 的块需要请求模型
+        :param misses: 需要请求模型的块序号（升序）
+        :return: 块序号分组列表
+        """
+        groups = []
+        tokens = 0
+        for number in misses:
+            count = count_tokens(units[number][0])
+            last = groups[-1] if groups else None
+            # 只合并紧邻、且前一块与本块之间没有段落分隔符的块
+            if last is not None and last[-1] == number - 1 and units[last[-1]][1] == '' \
+                    and tokens + count <= self.max_tokens:
+                last.append(number)
+                tokens += count
+            else:
+                groups.append([number])
+                tokens = count
+        return groups
+
+    def _store(self, sentences, result, context):
+        """
+        保存纠错结果：合并请求的结果能按句子对应时逐句保存，否则按整组保存。
+        :param sentences: 组内各句（已去掉首尾空白）
+        :param result: 整组的纠错结果
+        """
+        key = lambda sentence: self.cache.key(sentence, self.chat.model, PROMPT_VERSION, context)
+        if len(sentences) > 1:
+            parts = [part.strip() for part in split_sentences(result)]
+            if len(parts) == len(sentences) and all(plausible(sentence, part)
+                                                    for sentence, part in zip(sentences, parts)):
+                for sentence, part in zip(sentences, parts):
+                    self.cache.set(key(sentence), part)
+                return
+        self.cache.set(key(''.join(sentences)), result)
+
+    async def correct(self, text, context=None, render=None):
+        """
+        :param text: 文档文本，段落之间以换行分隔
+        :param context: RAG 上下文，参与缓存键
+        :param render: 将块文本渲染为发送给模型的内容（如拼接 RAG 上下文），默认原样发送
+        :return: 纠错后的文档文本
+        """
+        # 启用缓存或多句合并时按句子拆块；启用缓存时查询缓存后再把未命中的句子按预算合并
+        sentence_level = self.cache is not None or self.batcher is not None
+        chunks = chunk_text(text, self.max_tokens, pack=not sentence_level)
+        units = [[chunk, separator, None] for chunk, separator in chunks]
+        loop = asyncio.get_running_loop()
+        # 空白块不需要纠错
+        candidates = [number for number, (chunk, separator, result) in enumerate(units) if chunk.strip()]
+        hits = 0
+
+        # 缓存读写是 SQLite 磁盘 I/O，放到线程池中执行，不阻塞事件循环
+        if self.cache is not None:
+            key = lambda stripped: self.cache.key(stripped, self.chat.model, PROMPT_VERSION, context)
+            cached = await loop.run_in_executor(
+                None, lambda: [self.cache.get(key(units[number][0].strip())) for number in candidates])
+            for number, value in zip(candidates, cached):
+                if value is not None:
+                    hits += 1
+                    units[number][2] = value
+            candidates = [number for number in candidates if units[number][2] is None]
+
+        # 本地检测是 CPU 计算，同样放到线程池中执行
+        clean = 0
+        if self.detector is not None:
+            misses = list({units[number][0].strip() for number in candidates})
+            verdicts = await loop.run_in_executor(
+                None, lambda: dict(zip(misses, [self.detector.is_clean(stripped) for stripped in misses])))
+            for number in candidates:
+                if verdicts[units[number][0].strip()]:
+                    clean += 1
+                    units[number][2] = units[number][0].strip()
+            candidates = [number for number in candidates if units[number][2] is None]
+
+        if self.batcher is not None:
+            # 合并请求由合并器完成，并发也由合并器控制
+            groups = [[number] for number in candidates]
+        elif self.cache is not None:
+            groups = self._pack(units, candidates)
+        else:
+            groups = [[number] for number in candidates]
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(group):
+            sentences = [units[number][0].strip() for number in group]
+            request_text = ''.join(units[number][0] for number in group).strip()
+            if self.cache is not None and len(group) > 1:
+                # 同样的一组句子之前按整组保存过
+                cached = await loop.run_in_executor(None, self.cache.get, key(''.join(sentences)))
+                if cached is not None:
+                    return cached
+            if self.batcher is not None:
+                result = await self.correct_chunk(
+                    request_text, request=lambda sentence: self.batcher.correct(sentence, context, render))
+            else:
+                result = await self.correct_chunk(render(request_text) if render else request_text, semaphore)
+            # 块内不含换行，去掉模型在首尾多输出的换行，避免拼接后段落错位
+            result = result.strip('\r\n')
+            if self.cache is not None:
+                await loop.run_in_executor(None, self._store, sentences, result, context)
+            return result
+
+        # 同一文档中重复的句子（组）只请求一次
+        pending = {}
+        assigned = []
+        for group in groups:
+            request_text = ''.join(units[number][0] for number in group).strip()
+            if request_text not in pending:
+                pending[request_text] = asyncio.ensure_future(run(group))
+            assigned.append((group, pending[request_text]))
+
+        tasks = list(pending.values())
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # 某个块重试后仍失败时取消其余块，不再继续占用模型服务
+            for task in tasks:
+                task.cancel()
+            raise
+        logger.info('文档拆分为 %d 块，缓存命中 %d，本地检测跳过 %d，请求模型 %d 次，并发 %d',
+                    len(chunks), hits, clean, len(tasks), self.concurrency)
+
+        def strip_parts(chunk):
+            # 结果不含首尾空白，拼接时补回原有空白
+            return chunk[:len(chunk) - len(chunk.lstrip())], chunk[len(chunk.rstrip()):]
+
+        parts = []
+        for chunk, separator, result in units:
+            if result is None:
+                parts.append(chunk + separator)
+            else:
+                prefix, suffix = strip_parts(chunk)
+                parts.append(prefix + result + suffix + separator)
+        for group, task in assigned:
+            # 整组结果替换组内第一块到最后一块，首尾空白取自首尾两块
+            prefix, suffix = strip_parts(units[group[0]][0])[0], strip_parts(units[group[-1]][0])[1]
+            parts[group[0]] = prefix + task.result() + suffix + units[group[-1]][1]
+            for number in group[1:]:
+                parts[number] = ''
+        return ''.join(parts)
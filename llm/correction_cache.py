@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import threading
+import unicodedata
+
+import diskcache
+
+from llm.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_sentence(sentence):
+    """
+    规范化句子作为缓存键：只做 Unicode 标准等价（NFC）和去除首尾空白。
+    不做全半角转换，标点本身可能就是需要纠正的错误。
+    :param sentence: 句子
+    :return: 规范化后的句子
+    """
+    return unicodedata.normalize('NFC', sentence).strip()
+
+
+class CorrectionCache:
+    """
+    句子级纠错结果缓存，保存在磁盘上（SQLite + 文件），重启后仍然有效，
+    同一台机器上的多个工作进程共享同一个目录即可共享缓存。
+    键为 规范化句子、模型名称、prompt 版本、RAG 上下文 的哈希，超过容量时按最近最少使用淘汰。
+    """
+
+    def __init__(self, directory, size_limit_mb=512):
+        """
+        :param directory: 缓存目录
+        :param size_limit_mb: 缓存容量上限（MB）
+        """
+        self.directory = directory
+        self.size_limit = int(size_limit_mb * 1024 * 1024)
+        self._cache = diskcache.Cache(
+            directory,
+            size_limit=self.size_limit,
+            eviction_policy='least-recently-used',
+        )
+        # 命中统计保存在缓存数据库中，所有进程共享
+        self._cache.stats(enable=True)
+
+    @staticmethod
+    def key(sentence, model, prompt_version, context=None):
+        """
+        :param sentence: 待纠错的句子
+        :param model: 模型名称
+        :param prompt_version: prompt 模板版本
+        :param context: RAG 上下文
+        :return: 缓存键
+        """
+        raw = json.dumps([normalize_sentence(sentence), model, prompt_version, context or ''], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: 缓存的纠错结果，未命中时返回 None
+        """
+        try:
+            return self._cache.get(key)
+        except Exception as e:
+            # 缓存故障不影响纠错，按未命中处理
+            logger.warning('读取纠错缓存失败: %s', e)
+            return None
+
+    def set(self, key, value):
+        try:
+            self._cache.set(key, value)
+        except Exception as e:
+            logger.warning('写入纠错缓存失败: %s', e)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """
+        :return: 缓存统计信息（所有进程合计）
+        """
+        hits, misses = self._cache.stats()
+        total = hits + misses
+        return {
+            'directory': str(self.directory),
+            'size': len(self._cache),
+            'volume_bytes': self._cache.volume(),
+            'size_limit_bytes': self.size_limit,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_correction_cache():
+    """
+    获取当前进程的纠错缓存，参数从 Django 配置中读取；LLM_CACHE_ENABLED 为 False 时返回 None。
+    """
+    global _cache
+    if not get_setting('LLM_CACHE_ENABLED', True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                directory = get_setting('LLM_CACHE_DIR', None)
+                if directory is None:
+                    return None
+                _cache = CorrectionCache(directory, size_limit_mb=get_setting('LLM_CACHE_SIZE_LIMIT_MB', 512))
+    return _cache
@@ -0,0 +1,346 @@
+import functools
+import importlib.util
+import logging
+import math
+import os
+import pickle
+import threading
+from collections import Counter, defaultdict
+
+import ahocorasick
+from pypinyin import Style, lazy_pinyin
+
+from llm.chunking import split_sentences
+from llm.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# 句首、句尾标记
+_BOS = '\x02'
+_EOS = '\x03'
+
+
+def is_chinese(char):
+    return '一' <= char <= '鿿'
+
+
+@functools.lru_cache(maxsize=32768)
+def char_pinyin(char):
+    """
+    :return: 汉字不含声调的拼音
+    """
+    return lazy_pinyin(char, style=Style.NORMAL)[0]
+
+
+def read_corpus(path):
+    """
+    读取语料文件：txt 按行读取，pdf 按页、docx 按段落读取。
+    :param path: 文件路径
+    :return: 文本生成器
+    """
+    lower = path.lower()
+    if lower.endswith('.pdf'):
+        from pypdf import PdfReader
+        for page in PdfReader(path).pages:
+            yield page.extract_text() or ''
+    elif lower.endswith('.docx'):
+        import docx
+        for paragraph in docx.Document(path).paragraphs:
+            yield paragraph.text
+    else:
+        with open(path, encoding='utf-8') as f:
+            yield from f
+
+
+class CharNgramLM:
+    """
+    字符级 n-gram 语言模型，使用线性插值平滑（各阶条件概率按权重相加）。
+    """
+
+    def __init__(self, order=3, weights=(0.6, 0.3, 0.1)):
+        """
+        :param order: 阶数
+        :param weights: 从高阶到一阶的插值权重
+        """
+        self.order = order
+        self.weights = weights
+        # 各阶 n-gram 计数，键为字符串
+        self.counts = [Counter() for _ in range(order + 1)]  # 下标为阶数，0 不使用
+        self.total = 0
+
+    def train(self, texts):
+        """
+        :param texts: 文本列表，按句子统计
+        """
+        for text in texts:
+            for sentence in split_sentences(text.replace('\n', ' ')):
+                sentence = sentence.strip()
+                if not sentence:
+                    continue
+                padded = _BOS * (self.order - 1) + sentence + _EOS
+                for n in range(1, self.order + 1):
+                    for start in range(len(padded) - n + 1):
+                        self.counts[n][padded[start:start + n]] += 1
+                self.total += len(sentence) + 1
+        return self
+
+    def count(self, char):
+        return self.counts[1].get(char, 0)
+
+    def vocabulary(self):
+        return [key for key in self.counts[1] if key not in (_BOS, _EOS)]
+
+    def char_logprob(self, history, char):
+        """
+        :param history: 前文（最多取 order - 1 个字符）
+        :param char: 当前字符
+        :return: log P(char | history)
+        """
+        vocab_size = len(self.counts[1]) + 1
+        probability = self.weights[-1] * (self.counts[1].get(char, 0) + 1) / (self.total + vocab_size)
+        for n in range(2, self.order + 1):
+            context = history[len(history) - n + 1:]
+            if len(context) < n - 1:
+                break
+            denominator = self.counts[n - 1].get(context, 0)
+            if denominator:
+                probability += self.weights[self.order - n] * self.counts[n].get(context + char, 0) / denominator
+        return math.log(probability)
+
+    def score(self, text, start, end):
+        """
+        计算 text[start:end] 中每个字符的对数概率之和，前文取自 text 本身。
+        :param text: 已加上句首、句尾标记的文本
+        """
+        return sum(self.char_logprob(text[max(0, i - self.order + 1):i], text[i]) for i in range(start, end))
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump({'order': self.order, 'weights': self.weights, 'counts': self.counts, 'total': self.total}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        lm = cls(data['order'], data['weights'])
+        lm.counts = data['counts']
+        lm.total = data['total']
+        return lm
+
+
+def load_confusions(path=None):
+    """
+    加载混淆集：pycorrector 自带的同音字、形近字表，加上自定义混淆集。
+    自定义混淆集每行为 “错误写法 正确写法”，可以是词。
+    :param path: 自定义混淆集文件路径
+    :return: {错误写法: 候选正确写法集合}
+    """
+    confusions = defaultdict(set)
+    spec = importlib.util.find_spec('pycorrector')
+    if spec is not None and spec.origin:
+        # 只读取数据文件，不导入 pycorrector（导入会加载大模型依赖）
+        data_dir = os.path.join(os.path.dirname(spec.origin), 'data')
+        same_pinyin = os.path.join(data_dir, 'same_pinyin.txt')
+        if os.path.exists(same_pinyin):
+            with open(same_pinyin, encoding='utf-8') as f:
+                for line in f:
+                    if line.startswith('#'):
+                        continue
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) >= 2:
+                        confusions[parts[0]].update(''.join(parts[1:]))
+        same_stroke = os.path.join(data_dir, 'same_stroke.txt')
+        if os.path.exists(same_stroke):
+            with open(same_stroke, encoding='utf-8') as f:
+                for line in f:
+                    chars = [char for char in line.strip().split('\t') if char]
+                    for char in chars:
+                        confusions[char].update(other for other in chars if other != char)
+    if path:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and not line.startswith('#'):
+                    confusions[parts[0]].add(parts[1])
+    return confusions
+
+
+class LocalDetector:
+    """
+    本地错误检测：混淆集（Aho-Corasick 多模匹配）和同音字替换、重复字删除产生候选，
+    用字符 n-gram 语言模型比较候选与原句的局部得分。没有任何候选明显优于原句的句子判定为无错误，
+    置信度超过阈值时跳过大模型。
+    """
+
+    def __init__(self, lm, confusions=None, threshold=0.95, homophones=10):
+        """
+        :param lm: CharNgramLM 实例
+        :param confusions: 混淆集 {错误写法: 候选正确写法集合}
+        :param threshold: 判定无错误的置信度阈值
+        :param homophones: 每个拼音保留的高频同音字数量
+        """
+        self.lm = lm
+        self.threshold = threshold
+        self._lock = threading.Lock()
+
+        confusions = confusions or {}
+        self.automaton = ahocorasick.Automaton()
+        for wrong, candidates in confusions.items():
+            self.automaton.add_word(wrong, (wrong, tuple(candidates)))
+        if confusions:
+            self.automaton.make_automaton()
+
+        # 语言模型词表中的汉字按拼音（不含声调）分组，保留高频字
+        groups = defaultdict(list)
+        for char in self.lm.vocabulary():
+            if len(char) == 1 and is_chinese(char):
+                groups[char_pinyin(char)].append(char)
+        self.homophones = {}
+        for pinyin, chars in groups.items():
+            chars.sort(key=self.lm.count, reverse=True)
+            self.homophones[pinyin] = chars[:homophones]
+
+        # 统计信息
+        self.checked = 0
+        self.skipped = 0
+
+    def _candidates(self, sentence):
+        """
+        :return: [(起始位置, 原文长度, 替换文本)]
+        """
+        candidates = set()
+        if len(self.automaton):
+            for end, (wrong, replacements) in self.automaton.iter(sentence):
+                start = end - len(wrong) + 1
+                for replacement in replacements:
+                    if all(self.lm.count(char) for char in replacement):
+                        candidates.add((start, len(wrong), replacement))
+        for position, char in enumerate(sentence):
+            if not is_chinese(char):
+                continue
+            for other in self.homophones.get(char_pinyin(char), ()):
+                if other != char:
+                    candidates.add((position, 1, other))
+            # 重复字
+            if position and sentence[position - 1] == char:
+                candidates.add((position, 1, ''))
+        return candidates
+
+    def _gain(self, padded, start, length, replacement):
+        """
+        替换后相对原句的局部对数概率增益，只比较受影响的 n-gram。
+        """
+        order = self.lm.order
+        end = min(len(padded), start + length + order - 1)
+        variant = padded[:start] + replacement + padded[start + length:]
+        variant_end = end - length + len(replacement)
+        return self.lm.score(variant, start, variant_end) - self.lm.score(padded, start, end)
+
+    def sentence_confidence(self, sentence):
+        """
+        :param sentence: 句子
+        :return: 句子无错误的置信度，0 ~ 1
+        """
+        sentence = sentence.strip()
+        chars = [char for char in sentence if is_chinese(char)]
+        if not chars:
+            return 1.0
+        offset = self.lm.order - 1
+        padded = _BOS * offset + sentence + _EOS
+        best_gain = -math.inf
+        for start, length, replacement in self._candidates(sentence):
+            best_gain = max(best_gain, self._gain(padded, start + offset, length, replacement))
+        if best_gain == -math.inf:
+            confidence = 1.0
+        else:
+            confidence = 1.0 / (1.0 + math.exp(min(best_gain, 50.0)))
+        # 语言模型没见过的字越多越不可信
+        coverage = sum(1 for char in chars if self.lm.count(char)) / len(chars)
+        return confidence * coverage
+
+    def confidence(self, text):
+        """
+        :param text: 文本，可以包含多个句子
+        :return: 所有句子中最低的无错误置信度
+        """
+        sentences = [sentence for sentence in split_sentences(text) if sentence.strip()]
+        return min((self.sentence_confidence(sentence) for sentence in sentences), default=1.0)
+
+    def is_clean(self, text):
+        """
+        :param text: 文本
+        :return: 是否可以跳过大模型
+        """
+        clean = self.confidence(text) >= self.threshold
+        with self._lock:
+            self.checked += 1
+            if clean:
+                self.skipped += 1
+        return clean
+
+    def evaluate(self, samples, thresholds=None):
+        """
+        在标注样本上评估：各阈值下节省的大模型调用比例，以及漏检率（有错误却判定为无错误的比例）。
+        :param samples: [(原句, 正确句)]，两者相同表示无错误
+        :param thresholds: 需要评估的阈值列表，默认当前阈值
+        :return: 每个阈值的评估结果
+        """
+        scored = [(self.confidence(source), source != target) for source, target in samples]
+        errors = sum(1 for confidence, has_error in scored if has_error)
+        results = []
+        for threshold in thresholds or [self.threshold]:
+            skipped = [has_error for confidence, has_error in scored if confidence >= threshold]
+            missed = sum(1 for has_error in skipped if has_error)
+            results.append({
+                'threshold': threshold,
+                'samples': len(scored),
+                'with_errors': errors,
+                'skipped': len(skipped),
+                'saved_rate': len(skipped) / len(scored) if scored else 0.0,
+                'false_negatives': missed,
+                'false_negative_rate': missed / errors if errors else 0.0,
+            })
+        return results
+
+    def stats(self):
+        """
+        :return: 检测统计信息
+        """
+        return {
+            'threshold': self.threshold,
+            'checked': self.checked,
+            'skipped': self.skipped,
+            'sent_to_llm': self.checked - self.skipped,
+            'saved_rate': self.skipped / self.checked if self.checked else 0.0,
+        }
+
+
+_detector = None
+_detector_loaded = False
+_detector_lock = threading.Lock()
+
+
+def get_detector():
+    """
+    获取当前进程的本地检测器，参数从 Django 配置中读取；未启用或语言模型文件不存在时返回 None。
+    """
+    global _detector, _detector_loaded
+    if not get_setting('LLM_DETECTOR_ENABLED', False):
+        return None
+    if not _detector_loaded:
+        with _detector_lock:
+            if not _detector_loaded:
+                lm_path = get_setting('LLM_DETECTOR_LM_PATH', None)
+                if lm_path and os.path.exists(lm_path):
+                    _detector = LocalDetector(
+                        CharNgramLM.load(lm_path),
+                        confusions=load_confusions(get_setting('LLM_DETECTOR_CONFUSION_PATH', None)),
+                        threshold=get_setting('LLM_DETECTOR_THRESHOLD', 0.95),
+                    )
+                else:
+                    logger.info('本地检测的语言模型 %s 不存在，所有文本都交给大模型', lm_path)
+                _detector_loaded = True
+    return _detector
@@ -0,0 +1,237 @@
+import json
+
+
+def _common_prefix(a, b, a0, a1, b0, b1):
+    """
+    a[a0:a1] 与 b[b0:b1] 的公共前缀长度。先按二分比较切片，长相同片段不必逐字比较。
+    """
+    low, high = 0, min(a1 - a0, b1 - b0)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[a0 + low:a0 + middle] == b[b0 + low:b0 + middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix(a, b, a0, a1, b0, b1):
+    """
+    a[a0:a1] 与 b[b0:b1] 的公共后缀长度。
+    """
+    low, high = 0, min(a1 - a0, b1 - b0)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[a1 - middle:a1 - low] == b[b1 - middle:b1 - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _middle_snake(a, b, a0, a1, b0, b1, max_cost):
+    """
+    Myers 算法的双向搜索：从两端同时按编辑距离逐步扩展，路径相遇处把问题分成前后两半，只占用线性空间。
+    :param max_cost: 最多搜索的编辑距离，超过时放弃
+    :return: (相遇点, 正向最远点, 反向最远点)。相遇点 (x, y) 为相对 a0、b0 的偏移；
+             超过 max_cost 仍未相遇时相遇点为 None，同时返回两个方向走得最远的点（反向为相对 a1、b1 的偏移）
+    """
+    n, m = a1 - a0, b1 - b0
+    limit = (n + m + 1) // 2
+    offset = limit
+    size = 2 * limit + 2
+    forward = [-1] * size
+    backward = [-1] * size
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    delta = n - m
+    # 总长度为奇数时在正向搜索中检查相遇，否则在反向搜索中检查
+    front = delta % 2 == 1
+    # 超出边界的对角线不再搜索
+    k1_start = k1_end = k2_start = k2_end = 0
+    for d in range(min(limit, max_cost) + 1):
+        for k1 in range(-d + k1_start, d + 1 - k1_end, 2):
+            index = offset + k1
+            if k1 == -d or (k1 != d and forward[index - 1] < forward[index + 1]):
+                x1 = forward[index + 1]
+            else:
+                x1 = forward[index - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[a0 + x1] == b[b0 + y1]:
+                x1 += 1
+                y1 += 1
+            forward[index] = x1
+            if x1 > n:
+                k1_end += 2
+            elif y1 > m:
+                k1_start += 2
+            elif front:
+                other = offset + delta - k1
+                if 0 <= other < size and backward[other] != -1 and x1 >= n - backward[other]:
+                    return (x1, y1), None, None
+
+        for k2 in range(-d + k2_start, d + 1 - k2_end, 2):
+            index = offset + k2
+            if k2 == -d or (k2 != d and backward[index - 1] < backward[index + 1]):
+                x2 = backward[index + 1]
+            else:
+                x2 = backward[index - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[a1 - x2 - 1] == b[b1 - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            backward[index] = x2
+            if x2 > n:
+                k2_end += 2
+            elif y2 > m:
+                k2_start += 2
+            elif not front:
+                other = offset + delta - k2
+                if 0 <= other < size and forward[other] != -1:
+                    x1 = forward[other]
+                    y1 = x1 - (other - offset)
+                    if x1 >= n - x2:
+                        return (x1, y1), None, None
+    return None, _furthest(forward, offset, n, m), _furthest(backward, offset, n, m)
+
+
+def _furthest(v, offset, n, m):
+    """
+    :return: 搜索过的对角线上 x + y 最大的点
+    """
+    best = (0, 0)
+    for index, x in enumerate(v):
+        y = x - (index - offset)
+        if x >= 0 and x <= n and 0 <= y <= m and x + y > best[0] + best[1]:
+            best = (x, y)
+    return best
+
+
+def matching_blocks(a, b, max_cost=None):
+    """
+    Myers O(ND) 差分（线性空间版本），先去掉公共前后缀再对中间部分做双向搜索并递归。
+    :param a: 原始文本
+    :param b: 更正后的文本
+    :param max_cost: 每次双向搜索的最大编辑距离，默认 1000。超过时如果两端已经走过的部分相同字符较多（编辑稀疏），
+                     在最远点处分段继续比对；否则把该部分整体视为替换，避免完全不同的长文本耗时过长
+    :return: 相同片段列表 [(i, j, size)]，按位置排序
+    """
+    if max_cost is None:
+        max_cost = 1000
+    blocks = []
+    # 用栈代替递归，后半部分先入栈，保证按位置顺序输出
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        a0, a1, b0, b1 = stack.pop()
+        prefix = _common_prefix(a, b, a0, a1, b0, b1)
+        if prefix:
+            blocks.append((a0, b0, prefix))
+            a0 += prefix
+            b0 += prefix
+        suffix = _common_suffix(a, b, a0, a1, b0, b1)
+        if suffix:
+            # 后缀最后输出，先入栈
+            stack.append((a1 - suffix, a1, b1 - suffix, b1))
+            a1 -= suffix
+            b1 -= suffix
+        if a0 == a1 or b0 == b1:
+            continue
+        snake, forward, backward = _middle_snake(a, b, a0, a1, b0, b1, max_cost)
+        if snake is not None:
+            x, y = snake
+            stack.append((a0 + x, a1, b0 + y, b1))
+            stack.append((a0, a0 + x, b0, b0 + y))
+            continue
+        # 平均每处编辑前进不到 10 个字符时视为不相关的文本，整体替换
+        if sum(forward) + sum(backward) < 20 * max_cost:
+            continue
+        fx, fy = forward
+        bx, by = backward
+        if a0 + fx <= a1 - bx and b0 + fy <= b1 - by:
+            # 两端走过的部分都在 max_cost 以内，可以精确比对，只有中间部分需要再次搜索
+            stack.append((a1 - bx, a1, b1 - by, b1))
+            stack.append((a0 + fx, a1 - bx, b0 + fy, b1 - by))
+        else:
+            stack.append((a0 + fx, a1, b0 + fy, b1))
+        stack.append((a0, a0 + fx, b0, b0 + fy))
+    return _merge(blocks)
+
+
+def _merge(blocks):
+    """
+    合并首尾相接的相同片段，并去掉空片段。
+    """
+    merged = []
+    for i, j, size in blocks:
+        if not size:
+            continue
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+            last_i, last_j, last_size = merged[-1]
+            merged[-1] = (last_i, last_j, last_size + size)
+        else:
+            merged.append((i, j, size))
+    return merged
+
+
+def diff_opcodes(a, b, max_cost=None):
+    """
+    字符级差分，返回与 difflib.SequenceMatcher.get_opcodes() 相同格式的编辑操作，
+    但不使用 autojunk 启发式（该启发式会把中文长文本中的高频字当作噪声，比对结果错乱）。
+    :param a: 原始文本
+    :param b: 更正后的文本
+    :param max_cost: 见 matching_blocks
+    :return: [(tag, i1, i2, j1, j2)]，tag 为 equal、replace、delete、insert
+    """
+    opcodes = []
+    i = j = 0
+    for block_i, block_j, size in matching_blocks(a, b, max_cost) + [(len(a), len(b), 0)]:
+        if i < block_i and j < block_j:
+            opcodes.append(('replace', i, block_i, j, block_j))
+        elif i < block_i:
+            opcodes.append(('delete', i, block_i, j, j))
+        elif j < block_j:
+            opcodes.append(('insert', i, i, j, block_j))
+        if size:
+            opcodes.append(('equal', block_i, block_i + size, block_j, block_j + size))
+        i, j = block_i + size, block_j + size
+    return opcodes
+
+
+def edit_operations(opcodes):
+    """
+    :param opcodes: diff_opcodes 的结果
+    :return: 只保留不同部分的编辑操作，相同部分可由相邻操作推出
+    """
+    return [opcode for opcode in opcodes if opcode[0] != 'equal']
+
+
+def encode_ops(opcodes):
+    """
+    把编辑操作序列化为紧凑的 JSON，只保存不同部分的位置 [i1, i2, j1, j2]，随纠错记录一起存储。
+    :param opcodes: diff_opcodes 的结果
+    :return: JSON 字符串
+    """
+    return json.dumps([list(opcode[1:]) for opcode in edit_operations(opcodes)], separators=(',', ':'))
+
+
+def decode_ops(data, original_length, corrected_length):
+    """
+    由 encode_ops 的结果还原完整的编辑操作，相同部分由相邻操作之间的空隙推出。
+    :param data: encode_ops 返回的 JSON 字符串
+    :param original_length: 原始文本长度
+    :param corrected_length: 更正后的文本长度
+    :return: [(tag, i1, i2, j1, j2)]
+    """
+    opcodes = []
+    i = j = 0
+    for i1, i2, j1, j2 in json.loads(data) + [[original_length, original_length, corrected_length, corrected_length]]:
+        if i < i1:
+            opcodes.append(('equal', i, i1, j, j1))
+        if i1 < i2 and j1 < j2:
+            opcodes.append(('replace', i1, i2, j1, j2))
+        elif i1 < i2:
+            opcodes.append(('delete', i1, i2, j1, j2))
+        elif j1 < j2:
+            opcodes.append(('insert', i1, i2, j1, j2))
+        i, j = i2, j2
+    return opcodes
@@ -0,0 +1,254 @@
+import contextlib
+import logging
+import random
+import threading
+import time
+
+from llm.config import get_setting
+from llm.limiter import is_backend_failure
+
+logger = logging.getLogger(__name__)
+
+
+def health_url(url):
+    """
+    由对话接口地址推导健康检查地址：OpenAI 兼容服务的 /v1/models。
+    """
+    if url.endswith('/chat/completions'):
+        return url[:-len('/chat/completions')] + '/models'
+    return url.rstrip('/') + '/models'
+
+
+class Endpoint:
+    """
+    一个模型服务副本的状态：在途请求数、延迟的指数加权平均、连续失败次数和摘除状态。
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.latency_ewma = None
+        self.failures = 0
+        self.ejected_until = 0.0
+
+        # 统计信息
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+    @property
+    def ejected(self):
+        return self.ejected_until > 0
+
+    def score(self):
+        """
+        负载得分，越小越好：延迟 × (在途请求数 + 1)。没有延迟样本的新副本得分最低，优先获得流量。
+        """
+        return (self.latency_ewma or 0.0) * (self.outstanding + 1)
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'ejected': self.ejected,
+            'outstanding': self.outstanding,
+            'latency_ewma': self.latency_ewma,
+            'consecutive_failures': self.failures,
+            'requests': self.requests,
+            'errors': self.errors,
+            'ejections': self.ejections,
+        }
+
+
+class _Route:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.url = endpoint.url
+        self.started = time.monotonic()
+        self.latency = None
+
+    def first_byte(self):
+        """
+        流式请求收到第一段数据时调用，以首字节耗时作为延迟样本。
+        """
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started
+
+
+class EndpointPool:
+    """
+    多个 OpenAI 兼容模型服务副本的负载均衡：在未摘除的副本中随机取两个，选负载得分较小的一个（power of two choices）。
+    连续失败的副本被摘除，摘除时间过后由健康检查（GET /v1/models）确认恢复再重新加入；
+    健康检查失败的副本同样会被摘除。所有副本都被摘除时退化为选择最早到期的副本，由熔断器决定是否快速失败。
+    """
+
+    def __init__(self, urls, alpha=0.3, failure_threshold=3, ejection_time=30.0, health_check_interval=10.0,
+                 health_check_timeout=2.0, client=None):
+        """
+        :param urls: 对话接口地址列表
+        :param alpha: 延迟指数加权平均的系数
+        :param failure_threshold: 摘除副本的连续失败次数
+        :param ejection_time: 摘除后至少经过多久（秒）才尝试恢复
+        :param health_check_interval: 健康检查间隔（秒），0 表示不做主动检查，摘除到期后直接恢复
+        :param health_check_timeout: 健康检查超时（秒）
+        :param client: 发送健康检查的 LLMHttpClient
+        """
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.ejection_time = ejection_time
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.client = client
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def _eject(self, endpoint, reason):
+        """
+        摘除副本，调用方需持有锁。
+        """
+        if not endpoint.ejected:
+            endpoint.ejections += 1
+            logger.warning('摘除模型服务 %s: %s', endpoint.url, reason)
+        endpoint.ejected_until = time.monotonic() + self.ejection_time
+
+    def _admit(self, endpoint):
+        """
+        恢复副本，调用方需持有锁。
+        """
+        if endpoint.ejected:
+            logger.info('模型服务 %s 恢复', endpoint.url)
+        endpoint.ejected_until = 0.0
+        endpoint.failures = 0
+
+    def choose(self):
+        """
+        :return: 选中的副本
+        """
+        self._start_checker()
+        with self._lock:
+            now = time.monotonic()
+            if not self.health_check_interval:
+                # 没有主动健康检查，摘除到期后直接恢复
+                for endpoint in self.endpoints:
+                    if endpoint.ejected and endpoint.ejected_until <= now:
+                        self._admit(endpoint)
+            candidates = [endpoint for endpoint in self.endpoints if not endpoint.ejected]
+            if not candidates:
+                return min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+            if len(candidates) == 1:
+                return candidates[0]
+            first, second = random.sample(candidates, 2)
+            return first if first.score() <= second.score() else second
+
+    def begin(self, endpoint):
+        with self._lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+
+    def finish(self, endpoint, latency=None, failed=False):
+        """
+        :param latency: 请求耗时（秒），None 表示不更新延迟（如请求被取消）
+        :param failed: 请求是否失败
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                if endpoint.failures >= self.failure_threshold:
+                    self._eject(endpoint, '连续失败 %d 次' % endpoint.failures)
+                return
+            if latency is not None:
+                # 摘除期间（所有副本都被摘除时）仍然成功的请求说明副本已恢复
+                self._admit(endpoint)
+                if endpoint.latency_ewma is None:
+                    endpoint.latency_ewma = latency
+                else:
+                    endpoint.latency_ewma = self.alpha * latency + (1 - self.alpha) * endpoint.latency_ewma
+
+    @contextlib.contextmanager
+    def route(self):
+        """
+        选择副本并记录本次请求的耗时和成败。
+        :return: 本次路由，url 为选中副本的地址
+        """
+        endpoint = self.choose()
+        self.begin(endpoint)
+        route = _Route(endpoint)
+        try:
+            yield route
+        except BaseException as e:
+            # 调用方取消（非 Exception）和 4xx、解析错误等与副本无关的错误不计为失败
+            self.finish(endpoint, failed=isinstance(e, Exception) and is_backend_failure(e))
+            raise
+        latency = route.latency if route.latency is not None else time.monotonic() - route.started
+        self.finish(endpoint, latency=latency)
+
+    def check(self):
+        """
+        对所有副本做一次健康检查：失败的摘除，摘除到期且检查通过的恢复。
+        """
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if endpoint.ejected and endpoint.ejected_until > now:
+                continue
+            try:
+                response = self.client.get(health_url(endpoint.url), timeout=self.health_check_timeout)
+                healthy = response.status_code < 500
+                response.close()
+            except Exception as e:
+                logger.debug('健康检查 %s 失败: %s', endpoint.url, e)
+                healthy = False
+            with self._lock:
+                if healthy and endpoint.ejected:
+                    self._admit(endpoint)
+                elif not healthy:
+                    self._eject(endpoint, '健康检查失败')
+
+    def _start_checker(self):
+        # 只有一个副本时摘除与否都只能选它，不需要主动检查
+        if self._checker is not None or not self.health_check_interval or self.client is None \
+                or len(self.endpoints) < 2:
+            return
+        with self._lock:
+            if self._checker is not None:
+                return
+
+            def run():
+                while True:
+                    time.sleep(self.health_check_interval)
+                    try:
+                        self.check()
+                    except Exception:
+                        logger.exception('模型服务健康检查出错')
+
+            self._checker = threading.Thread(target=run, name='llm-health-check', daemon=True)
+            self._checker.start()
+
+    def stats(self):
+        return {'endpoints': [endpoint.stats() for endpoint in self.endpoints]}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_endpoint_pool():
+    """
+    获取当前进程共享的副本池：LLM_ENDPOINTS 为空时只包含 LLM_URL。
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from llm.client import get_client
+                urls = get_setting('LLM_ENDPOINTS', None) or [
+                    get_setting('LLM_URL', "http://10.129.2.71:8000/v1/chat/completions")]
+                _pool = EndpointPool(
+                    urls,
+                    failure_threshold=get_setting('LLM_ENDPOINT_FAILURE_THRESHOLD', 3),
+                    ejection_time=get_setting('LLM_ENDPOINT_EJECTION_TIME', 30.0),
+                    health_check_interval=get_setting('LLM_HEALTH_CHECK_INTERVAL', 10.0),
+                    client=get_client(),
+                )
+    return _pool
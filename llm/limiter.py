@@ -0,0 +1,371 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+
+import httpx
+import requests
+
+from llm.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class LLMUnavailable(Exception):
+    """
+    模型服务暂不可用（熔断或排队超时），调用方可以快速失败或降级。
+    """
+
+
+class CircuitOpenError(LLMUnavailable):
+    pass
+
+
+class LLMOverloaded(LLMUnavailable):
+    pass
+
+
+class LLMResponseError(Exception):
+    """
+    模型服务返回了非 200 的响应。
+    """
+
+    def __init__(self, status_code, text):
+        super().__init__(f"请求失败: {status_code}, {text}")
+        self.status_code = status_code
+
+
+def is_backend_failure(error):
+    """
+    是否是模型服务本身的故障：5xx、连接错误和超时。4xx（如输入过长）和响应解析错误只与单个请求有关，
+    不减小并发上限，也不计入熔断，避免一个用户的异常输入影响所有人。
+    """
+    if isinstance(error, LLMResponseError):
+        return error.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError,
+                              ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD 自适应并发限制：请求成功且耗时低于阈值时并发上限加性增长（每轮约加 1），
+    超时、出错或耗时超过阈值时乘性减小。达到上限的请求排队等待，等待超时抛出 LLMOverloaded。
+    同时支持线程和协程调用方。
+    """
+
+    def __init__(self, initial=8, min_limit=1, max_limit=64, latency_threshold=30.0, backoff_ratio=0.7,
+                 queue_timeout=30.0):
+        """
+        :param initial: 初始并发上限
+        :param min_limit: 最小并发上限
+        :param max_limit: 最大并发上限
+        :param latency_threshold: 耗时阈值（秒），超过视为拥塞
+        :param backoff_ratio: 拥塞时并发上限的缩小比例
+        :param queue_timeout: 排队等待超时（秒）
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_threshold = latency_threshold
+        self.backoff_ratio = backoff_ratio
+        self.queue_timeout = queue_timeout
+
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        # 上次缩小的时间，同一批并发请求的拥塞只缩小一次
+        self._last_decrease = 0.0
+
+        # 统计信息
+        self.accepted = 0
+        self.rejected = 0
+        self.decreases = 0
+        self.latency_ewma = None
+
+    def _acquire_or_wait(self, wake):
+        """
+        有空闲名额时占用并返回 True，否则登记唤醒函数并返回 False；检查和登记在同一把锁内完成，不会错过唤醒。
+        """
+        with self._lock:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                self.accepted += 1
+                return True
+            self._waiters.append(wake)
+            return False
+
+    def _leave(self, wake):
+        """
+        放弃排队（超时或取消）。已经被唤醒、但还没来得及争抢名额就超时的调用方占用了一次唤醒，
+        转给下一个排队的调用方，否则空闲的名额要等到下一次释放才会被用上。
+        """
+        with self._lock:
+            if wake in self._waiters:
+                self._waiters.remove(wake)
+            else:
+                self._wake()
+
+    def _give_up(self, wake):
+        self._leave(wake)
+        with self._lock:
+            self.rejected += 1
+        raise LLMOverloaded('模型服务并发已达上限 %d，排队超时' % int(self.limit))
+
+    def _wake(self):
+        """
+        唤醒排队的调用方，调用方需持有锁。被唤醒的调用方会重新争抢名额。
+        """
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            self._waiters.popleft()()
+            free -= 1
+
+    def acquire(self):
+        """
+        同步获取一个并发名额。
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            event = threading.Event()
+            if self._acquire_or_wait(event.set):
+                return
+            if not event.wait(max(0.0, deadline - time.monotonic())):
+                self._give_up(event.set)
+
+    async def acquire_async(self):
+        """
+        异步获取一个并发名额。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        while True:
+            future = loop.create_future()
+
+            def wake(future=future):
+                try:
+                    loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+                except RuntimeError:
+                    # 事件循环已关闭
+                    pass
+
+            if self._acquire_or_wait(wake):
+                return
+            try:
+                await asyncio.wait_for(future, max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                self._give_up(wake)
+            except BaseException:
+                # 调用方被取消
+                self._leave(wake)
+                raise
+
+    def release(self, latency=None, failed=False):
+        """
+        :param latency: 请求耗时（秒），None 表示不参与调整（如请求被取消）
+        :param failed: 请求是否失败
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if latency is not None:
+                self.latency_ewma = latency if self.latency_ewma is None else 0.9 * self.latency_ewma + 0.1 * latency
+            if failed or (latency is not None and latency > self.latency_threshold):
+                now = time.monotonic()
+                if now - self._last_decrease > (self.latency_ewma or 0.0):
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self._last_decrease = now
+                    self.decreases += 1
+            elif latency is not None:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._wake()
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'queued': len(self._waiters),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'decreases': self.decreases,
+            'latency_ewma': self.latency_ewma,
+        }
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败达到阈值后打开，打开期间调用直接失败；
+    冷却时间过后进入半开状态，放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        :param failure_threshold: 打开熔断的连续失败次数
+        :param reset_timeout: 打开后进入半开状态的冷却时间（秒）
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.opens = 0
+        self.short_circuited = 0
+
+    def allow(self):
+        """
+        :raise CircuitOpenError: 熔断打开时
+        """
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.short_circuited += 1
+        raise CircuitOpenError('模型服务熔断中，%.0f 秒后重试' % max(
+            0.0, self.reset_timeout - (time.monotonic() - self.opened_at)))
+
+    def cancel_probe(self):
+        """
+        放行的探测请求没有真正发出（如排队超时、被取消）时调用，让下一个请求继续探测。
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                logger.info('模型服务恢复，熔断关闭')
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                logger.warning('模型服务连续失败 %d 次，熔断打开', self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.opens += 1
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'opens': self.opens,
+            'short_circuited': self.short_circuited,
+        }
+
+
+class _Call:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latency = None
+
+    def first_byte(self):
+        """
+        流式请求收到第一段数据时调用，以首字节耗时作为延迟样本。
+        """
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started
+
+
+class BackendGuard:
+    """
+    模型服务调用的保护：先检查熔断，再获取并发名额，结束时按耗时和成败调整并发上限和熔断状态。
+    """
+
+    def __init__(self, limiter, breaker):
+        self.limiter = limiter
+        self.breaker = breaker
+
+    def _finish(self, call, error):
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            # 调用方取消，不代表服务状态
+            self.limiter.release()
+            self.breaker.cancel_probe()
+            return
+        latency = call.latency if call.latency is not None else time.monotonic() - call.started
+        # 4xx 和解析错误说明服务能正常响应，按成功处理
+        failed = error is not None and is_backend_failure(error)
+        self.limiter.release(latency, failed=failed)
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    @contextlib.contextmanager
+    def call(self):
+        self.breaker.allow()
+        try:
+            self.limiter.acquire()
+        except BaseException:
+            self.breaker.cancel_probe()
+            raise
+        call = _Call()
+        try:
+            yield call
+        except BaseException as e:
+            self._finish(call, e)
+            raise
+        self._finish(call, None)
+
+    @contextlib.asynccontextmanager
+    async def call_async(self):
+        self.breaker.allow()
+        try:
+            await self.limiter.acquire_async()
+        except BaseException:
+            self.breaker.cancel_probe()
+            raise
+        call = _Call()
+        try:
+            yield call
+        except BaseException as e:
+            self._finish(call, e)
+            raise
+        self._finish(call, None)
+
+    def stats(self):
+        return {'limiter': self.limiter.stats(), 'breaker': self.breaker.stats()}
+
+
+_guard = None
+_guard_lock = threading.Lock()
+
+
+def get_guard():
+    """
+    获取当前进程共享的模型服务保护，参数从 Django 配置中读取。
+    """
+    global _guard
+    if _guard is None:
+        with _guard_lock:
+            if _guard is None:
+                _guard = BackendGuard(
+                    AdaptiveLimiter(
+                        initial=get_setting('LLM_LIMIT_INITIAL', 8),
+                        min_limit=get_setting('LLM_LIMIT_MIN', 1),
+                        max_limit=get_setting('LLM_LIMIT_MAX', 64),
+                        latency_threshold=get_setting('LLM_LIMIT_LATENCY_THRESHOLD', 30.0),
+                        queue_timeout=get_setting('LLM_LIMIT_QUEUE_TIMEOUT', 30.0),
+                    ),
+                    CircuitBreaker(
+                        failure_threshold=get_setting('LLM_BREAKER_FAILURE_THRESHOLD', 5),
+                        reset_timeout=get_setting('LLM_BREAKER_RESET_TIMEOUT', 30.0),
+                    ),
+                )
+    return _guard
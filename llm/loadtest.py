@@ -0,0 +1,208 @@
+import asyncio
+import io
+import json
+import math
+import random
+import time
+from collections import Counter
+
+import httpx
+
+# 默认的压测文本，含常见的错别字、重复字
+SAMPLE_SENTENCES = [
+    '今天的天气真不错，我想出去万。',
+    '今天是周六，我想去吃火火锅。',
+    '当前，航空航天领正经历一场技树革命。',
+    '许多新兴技术正在推动动飞行器和航天器的性能提升。',
+    '下一代发动机技术正在改变航空运输方式，使其更加环保和高效。',
+    '卫星导航系统为民用航空提供了高精度的定位服务。',
+    '复合材料的广泛应用显著减轻了飞机的结构重量。',
+    '试验结果表明，新型推进剂的比冲提高了百分之五。',
+]
+
+
+def percentile(values, q):
+    """
+    :param values: 已排序的数值列表
+    :param q: 百分位，0 ~ 100
+    :return: 最近秩法计算的百分位数，列表为空时返回 None
+    """
+    if not values:
+        return None
+    rank = max(1, min(len(values), math.ceil(q / 100 * len(values))))
+    return values[rank - 1]
+
+
+def build_docx(text):
+    """
+    :param text: 文档文本，每行一个段落
+    :return: docx 文件内容
+    """
+    import docx
+    document = docx.Document()
+    for line in text.split('\n'):
+        document.add_paragraph(line)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+class LoadTester:
+    """
+    开环压测：按目标 RPS 发送请求（不等待前一个请求完成），统计延迟分位数、吞吐量和错误分类。
+    在途请求数达到上限时新的请求直接记为 dropped，避免压测端自身成为瓶颈。
+    """
+
+    ENDPOINTS = ('correct_text', 'correct_doc', 'correct_text_stream')
+
+    def __init__(self, base_url, endpoint='correct_text', rps=5.0, duration=30.0, sentences=None,
+                 sentences_per_request=3, max_in_flight=256, timeout=120.0, poisson=False, seed=None):
+        """
+        :param base_url: Django 服务地址，如 http://127.0.0.1:8000
+        :param endpoint: 压测的接口
+        :param rps: 目标每秒请求数
+        :param duration: 压测时长（秒）
+        :param sentences: 用于拼接请求文本的句子，默认 SAMPLE_SENTENCES
+        :param sentences_per_request: 每个请求的句子数
+        :param max_in_flight: 最大在途请求数
+        :param timeout: 单个请求的超时（秒）
+        :param poisson: 为 True 时请求间隔服从指数分布（泊松到达），否则等间隔
+        :param seed: 随机种子
+        """
+        if endpoint not in self.ENDPOINTS:
+            raise ValueError('不支持的接口 %s，可选 %s' % (endpoint, ', '.join(self.ENDPOINTS)))
+        self.base_url = base_url.rstrip('/')
+        self.endpoint = endpoint
+        self.rps = rps
+        self.duration = duration
+        self.sentences = sentences or SAMPLE_SENTENCES
+        self.sentences_per_request = sentences_per_request
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.poisson = poisson
+        self._random = random.Random(seed)
+
+        self.latencies = []
+        self.first_bytes = []
+        self.outcomes = Counter()
+        self.in_flight = 0
+        self.elapsed = 0.0
+
+    def make_text(self):
+        count = min(self.sentences_per_request, len(self.sentences))
+        return ''.join(self._random.sample(self.sentences, count))
+
+    async def send(self, client):
+        """
+        发送一个请求，返回结果分类：ok、degraded（降级为未检测）、queued（已提交后台任务）、http_<状态码>、app_error 或异常类名。
+        """
+        url = '%s/%s' % (self.base_url, self.endpoint)
+        text = self.make_text()
+        if self.endpoint == 'correct_doc':
+            files = {'document': ('loadtest.docx', build_docx(text),
+                                  'application/vnd.openxmlformats-officedocument.wordprocessingml.document')}
+            response = await client.post(url, files=files)
+            return self.classify(response.status_code, response.content)
+
+        if self.endpoint == 'correct_text':
+            response = await client.post(url, data={'text': text})
+            return self.classify(response.status_code, response.content)
+
+        started = time.monotonic()
+        first_byte = False
+        async with client.stream('POST', url, data={'text': text}) as response:
+            if response.status_code != 200:
+                return 'http_%d' % response.status_code
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    if event == 'delta' and not first_byte:
+                        # 流式接口另外统计首个片段的到达时间
+                        self.first_bytes.append(time.monotonic() - started)
+                        first_byte = True
+                    elif event == 'done':
+                        data = json.loads(line[len('data:'):])
+                        return 'degraded' if data.get('status') == '未检测' else 'ok'
+                    elif event == 'error':
+                        return 'app_error'
+        return 'incomplete_stream'
+
+    @staticmethod
+    def classify(status_code, content):
+        if status_code != 200:
+            return 'http_%d' % status_code
+        try:
+            data = json.loads(content)
+        except ValueError:
+            return 'invalid_json'
+        if data.get('error'):
+            return 'app_error'
+        if data.get('status') == '排队中':
+            # correct_doc 提交后台任务后立即返回，只统计提交耗时
+            return 'queued'
+        return 'degraded' if data.get('status') == '未检测' else 'ok'
+
+    async def _run_one(self, client):
+        started = time.monotonic()
+        try:
+            outcome = await self.send(client)
+        except Exception as e:
+            outcome = type(e).__name__
+        finally:
+            self.in_flight -= 1
+        self.outcomes[outcome] += 1
+        if outcome in ('ok', 'degraded', 'queued'):
+            self.latencies.append(time.monotonic() - started)
+
+    async def run(self):
+        """
+        :return: 压测报告，见 report()
+        """
+        limits = httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            next_at = started
+            tasks = []
+            while next_at - started < self.duration:
+                await asyncio.sleep(max(0.0, next_at - loop.time()))
+                if self.in_flight >= self.max_in_flight:
+                    self.outcomes['dropped'] += 1
+                else:
+                    self.in_flight += 1
+                    tasks.append(asyncio.ensure_future(self._run_one(client)))
+                next_at += self._random.expovariate(self.rps) if self.poisson else 1.0 / self.rps
+            if tasks:
+                await asyncio.gather(*tasks)
+            self.elapsed = loop.time() - started
+        return self.report()
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        first_bytes = sorted(self.first_bytes)
+        total = sum(self.outcomes.values())
+        completed = len(latencies)
+        return {
+            'endpoint': self.endpoint,
+            'target_rps': self.rps,
+            'duration': self.elapsed,
+            'requests': total,
+            'completed': completed,
+            'throughput': completed / self.elapsed if self.elapsed else 0.0,
+            'success_rate': (self.outcomes['ok'] + self.outcomes['queued']) / total if total else 0.0,
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+                'mean': sum(latencies) / completed if completed else None,
+            },
+            'first_byte': {
+                'p50': percentile(first_bytes, 50),
+                'p95': percentile(first_bytes, 95),
+                'p99': percentile(first_bytes, 99),
+            } if first_bytes else None,
+            'outcomes': dict(self.outcomes.most_common()),
+        }
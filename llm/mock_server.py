@@ -0,0 +1,250 @@
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# build_request 拼接的纠错 prompt 以此结尾，之后是待纠错的文本
+_PROMPT_END = '如果没有帮助请忽略。'
+# RAG 模板中待纠错文本的前缀
+_RAG_INPUT = '## 请修改以下内容：'
+
+
+class LatencyModel:
+    """
+    模拟模型服务的耗时分布：固定、均匀、正态、对数正态、指数。耗时与输出字数无关的部分为首字节耗时，
+    另外每输出一个字增加 token_delay 秒。
+    """
+
+    DISTRIBUTIONS = ('fixed', 'uniform', 'normal', 'lognormal', 'exponential')
+
+    def __init__(self, distribution='lognormal', mean=0.5, stddev=0.2, token_delay=0.0, seed=None):
+        """
+        :param distribution: 分布名称
+        :param mean: 首字节耗时均值（秒）
+        :param stddev: 首字节耗时标准差（秒），均匀分布时为半宽
+        :param token_delay: 每输出一个字的耗时（秒）
+        :param seed: 随机种子
+        """
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError('不支持的耗时分布 %s，可选 %s' % (distribution, ', '.join(self.DISTRIBUTIONS)))
+        self.distribution = distribution
+        self.mean = mean
+        self.stddev = stddev
+        self.token_delay = token_delay
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def first_byte(self):
+        """
+        :return: 一次请求的首字节耗时（秒）
+        """
+        with self._lock:
+            if self.distribution == 'fixed':
+                value = self.mean
+            elif self.distribution == 'uniform':
+                value = self._random.uniform(self.mean - self.stddev, self.mean + self.stddev)
+            elif self.distribution == 'normal':
+                value = self._random.gauss(self.mean, self.stddev)
+            elif self.distribution == 'lognormal':
+                # 按目标均值和标准差换算对数正态分布的参数
+                if self.mean <= 0:
+                    return 0.0
+                sigma2 = math.log(1 + (self.stddev / self.mean) ** 2)
+                mu = math.log(self.mean) - sigma2 / 2
+                value = self._random.lognormvariate(mu, sigma2 ** 0.5)
+            else:
+                value = self._random.expovariate(1 / self.mean) if self.mean > 0 else 0.0
+        return max(0.0, value)
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def choice(self, values):
+        with self._lock:
+            return self._random.choice(values)
+
+
+def extract_input(content):
+    """
+    从发送给模型的内容中取出待纠错的文本（去掉纠错 prompt 和 RAG 上下文）。
+    """
+    if _RAG_INPUT in content:
+        return content[content.rindex(_RAG_INPUT) + len(_RAG_INPUT):].strip()
+    if _PROMPT_END in content:
+        content = content[content.rindex(_PROMPT_END) + len(_PROMPT_END):]
+    return content.strip()
+
+
+class MockCorrector:
+    """
+    模拟纠错：按替换规则修改文本，其余原样返回。多句合并请求（JSON 数组）按数组返回。
+    """
+
+    def __init__(self, replacements=None):
+        """
+        :param replacements: {错误写法: 正确写法}
+        """
+        self.replacements = replacements or {}
+
+    def correct(self, text):
+        for wrong, right in self.replacements.items():
+            text = text.replace(wrong, right)
+        return text
+
+    def reply(self, content):
+        text = extract_input(content)
+        # 多句合并请求以 JSON 数组结尾
+        match = re.search(r'\[.*\]\s*$', text, re.S)
+        if match:
+            try:
+                sentences = json.loads(match.group(0))
+            except ValueError:
+                sentences = None
+            if isinstance(sentences, list):
+                return json.dumps([self.correct(str(sentence)) for sentence in sentences], ensure_ascii=False)
+        return self.correct(text)
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    OpenAI 兼容的模拟模型服务，用于本地压测和测试：支持 /v1/chat/completions（含 stream=True）
+    和 /v1/models，可配置耗时分布、错误率和错误状态码。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=None, corrector=None, error_rate=0.0, error_codes=(500,),
+                 timeout_rate=0.0, timeout=30.0, model='mock'):
+        """
+        :param address: (主机, 端口)
+        :param latency: LatencyModel 实例
+        :param corrector: MockCorrector 实例
+        :param error_rate: 返回错误状态码的比例
+        :param error_codes: 随机选用的错误状态码
+        :param timeout_rate: 长时间不响应的比例（模拟卡住的请求）
+        :param timeout: 不响应的时长（秒）
+        :param model: /v1/models 返回的模型名称
+        """
+        super().__init__(address, MockLLMHandler)
+        self.latency = latency or LatencyModel()
+        self.corrector = corrector or MockCorrector()
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.model = model
+
+        self._lock = threading.Lock()
+        # 统计信息
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.in_flight = 0
+
+    def count(self, field, delta=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + delta)
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors, 'timeouts': self.timeouts,
+                'in_flight': self.in_flight}
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    # keep-alive，与真实服务一致，客户端可以复用连接
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {'object': 'list', 'data': [{'id': self.server.model, 'object': 'model'}]})
+        else:
+            self.send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+            content = body['messages'][-1]['content']
+        except (ValueError, KeyError, IndexError, TypeError):
+            self.send_json(400, {'error': {'message': 'invalid request'}})
+            return
+
+        server.count('requests')
+        server.count('in_flight')
+        try:
+            roll = server.latency.random()
+            if roll < server.timeout_rate:
+                server.count('timeouts')
+                time.sleep(server.timeout)
+                self.close_connection = True
+                return
+            time.sleep(server.latency.first_byte())
+            if roll < server.timeout_rate + server.error_rate:
+                server.count('errors')
+                status = server.latency.choice(server.error_codes)
+                self.send_json(status, {'error': {'message': 'mock error', 'code': status}})
+                return
+
+            reply = server.corrector.reply(content)
+            if body.get('stream'):
+                self.stream(reply)
+            else:
+                time.sleep(server.latency.token_delay * len(reply))
+                self.send_json(200, {
+                    'id': 'mock-%d' % server.requests,
+                    'object': 'chat.completion',
+                    'model': body.get('model', server.model),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply},
+                                 'finish_reason': 'stop'}],
+                })
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开
+            self.close_connection = True
+        finally:
+            server.count('in_flight', -1)
+
+    def stream(self, reply):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(reply), 2):
+            delta = {'choices': [{'index': 0, 'delta': {'content': reply[start:start + 2]}}]}
+            self.send_chunk(('data: %s\n\n' % json.dumps(delta, ensure_ascii=False)).encode('utf-8'))
+            time.sleep(self.server.latency.token_delay * 2)
+        self.send_chunk(b'data: [DONE]\n\n')
+        self.send_chunk(b'')
+
+
+def start_mock_server(host='127.0.0.1', port=0, **kwargs):
+    """
+    在后台线程中启动模拟模型服务。
+    :param port: 端口，0 表示随机分配
+    :return: MockLLMServer 实例，server_address 为实际监听地址，shutdown() 停止
+    """
+    server = MockLLMServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, name='mock-llm', daemon=True).start()
+    return server
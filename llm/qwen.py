@@ -1,21 +1,99 @@
-import requests
+import asyncio
+import json
+import logging
+import re
+import time
+
+from llm.client import backoff_delay, get_async_client, get_client, is_retried
+from llm.config import get_setting
+from llm.endpoints import EndpointPool, get_endpoint_pool
+from llm.limiter import LLMResponseError, get_guard
+
+logger = logging.getLogger(__name__)
+
+# prompt 模板版本，修改 build_request 或 RAG 模板中的 prompt 后需要递增，使旧的纠错缓存失效
+PROMPT_VERSION = 1
+
+# 多句合并请求时附加的要求，句子以 JSON 数组给出
+BATCH_PROMPT = """
+                    ## 以下是多个相互独立的句子，以 JSON 数组给出，请对每个句子分别纠错。
+                    只返回一个 JSON 数组，元素依次为每个句子纠错后的结果，数量和顺序与输入一致，不要输出其他内容：
+                    """
+
+# 编号列表的一行，如 “1. 句子”、“2、句子”
+_NUMBERED_LINE = re.compile(r'^\s*(\d+)\s*[.、:：)）]\s*(.*?)\s*$')
+
+
+def parse_stream_line(line):
+    """
+    解析流式响应中的一行 SSE 数据。
+    :param line: 一行文本
+    :return: 本行携带的文本片段，非数据行返回空字符串，流结束（[DONE]）返回 None
+    """
+    if not line or not line.startswith("data:"):
+        return ""
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return None
+    choices = json.loads(data).get("choices") or [{}]
+    return (choices[0].get("delta") or {}).get("content") or ""
+
+
+def parse_batch_content(content, count):
+    """
+    解析多句合并请求的模型输出：优先按 JSON 数组解析，失败时按编号列表解析。
+    :param content: 模型返回的文本
+    :param count: 输入的句子数
+    :return: 长度为 count 的列表，无法解析的句子为 None
+    """
+    text = content.strip()
+    start, end = text.find('['), text.rfind(']')
+    if 0 <= start < end:
+        # 模型可能在数组前后输出代码块标记或说明文字
+        try:
+            items = json.loads(text[start:end + 1])
+        except ValueError:
+            items = None
+        if isinstance(items, list) and len(items) == count:
+            return [item if isinstance(item, str) and item.strip() else None for item in items]
+
+    numbered = {}
+    for line in text.splitlines():
+        match = _NUMBERED_LINE.match(line)
+        if match:
+            item = match.group(2)
+            if len(item) >= 2 and item[0] == item[-1] == '"':
+                item = item[1:-1]
+            numbered.setdefault(int(match.group(1)), item)
+    if set(numbered) == set(range(1, count + 1)):
+        return [numbered[number] or None for number in range(1, count + 1)]
+    return [None] * count
+
+
 class ChatCompletion:
-    def __init__(self, url="http://10.129.2.71:8000/v1/chat/completions", model="gpt-3.5-turbo"):
-        self.url = url
-        self.model = model
-    def get_response(self, user_message):
+    def __init__(self, url=None, model=None):
+        """
+        :param url: 模型服务地址，默认在 LLM_ENDPOINTS 配置的副本之间负载均衡（未配置时使用 LLM_URL）
+        :param model: 模型名称，默认读取 LLM_MODEL 配置
+        """
+        self.url = url or get_setting('LLM_URL', "http://10.129.2.71:8000/v1/chat/completions")
+        # 指定地址时只使用该地址，否则使用进程内共享的副本池
+        self.pool = EndpointPool([url]) if url else get_endpoint_pool()
+        self.model = model or get_setting('LLM_MODEL', "gpt-3.5-turbo")
+        # 进程内共享的连接池客户端
+        self.client = get_client()
+        # 进程内共享的自适应并发限制和熔断器
+        self.guard = get_guard()
+
+    def build_request(self, user_message):
+        """
+        拼接纠错 prompt，构造请求头和请求体。
+        :param user_message: 待纠错的文本
+        :return: (headers, payload)
+        """
         headers = {
             "Content-Type": "application/json"
         }
-        payload = {
-            "model": self.model,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": user_message
-                }
-            ]
-        }
         prompt = ("""#你是一个智能的文本纠错助手，能够帮我纠正句子中的错别字、重复字。
                     ##例子1，关于错别字的纠错：我向你输入一段话：“今天的天气真不错，我想出去万。”
                       在这个句子当中，有一个错别字“玩”，所以你需要将其修改为“玩”，并且将正确的句子返回给我：“今天的天气真不错，我想出去玩。”
@@ -34,16 +112,154 @@ class ChatCompletion:
         # 错误：当前，航航空航天领域正经历一场技术革命，许多新兴技术正在推动飞行器和航天器的性能提升。下一代发动机技树（如电动推进和混合动力发动机）正在改变航空运输方式，使其更加环保和高效。
         # 正确：当前，航空航天领域正经历一场技术革命，许多新兴技术正在推动飞行器和航天器的性能提升。下一代发动机技术（如电动推进和混合动力发动机）正在改变航空运输方式，使其更加环保和高效。
         user_message = prompt + user_message
+        payload = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": user_message
+                }
+            ]
+        }
 
+        return headers, payload
 
-        # 发送 POST 请求并获取响应
-        response = requests.post(self.url, json=payload, headers=headers)
+    def build_batch_request(self, sentences, context=None):
+        """
+        把多个句子合并为一次请求，共用纠错 prompt。
+        :param sentences: 待纠错的句子列表
+        :param context: RAG 上下文，所有句子共用
+        :return: (headers, payload)
+        """
+        message = BATCH_PROMPT + json.dumps(sentences, ensure_ascii=False)
+        if context is not None:
+            message = "\n<context>\n%s\n</context>\n%s" % (context, message)
+        return self.build_request(message)
 
+    def parse_response(self, response):
+        """
+        解析模型服务的响应。
+        :param response: requests 或 httpx 的响应对象
+        :return: 模型返回的文本
+        """
         # 检查响应状态
         if response.status_code == 200:
             return response.json()["choices"][0]["message"]["content"]  # 返回响应的 JSON 数据
         else:
-            raise Exception(f"请求失败: {response.status_code}, {response.text}")
+            raise LLMResponseError(response.status_code, response.text)
+
+    def _should_retry(self, error, attempt):
+        """
+        5xx 和连接错误换一个副本重试，重试次数和退避参数沿用 HTTP 客户端的配置。
+        """
+        if attempt >= self.client.max_retries or not is_retried(error):
+            return False
+        self.client.retries += 1
+        logger.warning('模型服务请求失败，第 %d 次重试（重新选择副本）: %s', attempt + 1, error)
+        return True
+
+    def complete(self, headers, payload):
+        attempt = 0
+        while True:
+            try:
+                # 熔断时抛出 CircuitOpenError，并发达到上限时排队，排队超时抛出 LLMOverloaded；
+                # 每次尝试单独占用并发名额，退避等待期间归还
+                with self.guard.call():
+                    # 每次尝试重新选择副本，客户端不在同一个副本上重试
+                    with self.pool.route() as route:
+                        response = self.client.post(route.url, max_retries=0, json=payload, headers=headers)
+                        return self.parse_response(response)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+            time.sleep(backoff_delay(attempt, self.client.backoff_base, self.client.backoff_max))
+            attempt += 1
+
+    def get_response(self, user_message):
+        return self.complete(*self.build_request(user_message))
+
+    def get_batch_response(self, sentences, context=None):
+        """
+        :param sentences: 待纠错的句子列表
+        :param context: RAG 上下文
+        :return: 与 sentences 等长的纠错结果列表，无法解析的句子为 None
+        """
+        content = self.complete(*self.build_batch_request(sentences, context))
+        return parse_batch_content(content, len(sentences))
+
+    def stream_response(self, user_message):
+        """
+        以流式方式请求模型服务（OpenAI 兼容的 SSE 响应），逐段产出模型生成的文本。
+        只在收到第一段数据之前重试（每次重新选择副本），开始产出后出错直接抛出。
+        :param user_message: 待纠错的文本
+        :return: 文本片段的生成器
+        """
+        headers, payload = self.build_request(user_message)
+        payload["stream"] = True
+        attempt = 0
+        started = False
+        while True:
+            try:
+                # 整个流占用一个并发名额，以首字节耗时作为延迟样本；重试前的退避等待期间归还名额
+                with self.guard.call() as call:
+                    with self.pool.route() as route:
+                        response = self.client.post(route.url, max_retries=0, json=payload, headers=headers,
+                                                    stream=True)
+                        try:
+                            if response.status_code != 200:
+                                raise LLMResponseError(response.status_code, response.text)
+                            # text/event-stream 通常不带 charset，requests 会按 ISO-8859-1 解码
+                            response.encoding = "utf-8"
+                            for line in response.iter_lines(decode_unicode=True):
+                                content = parse_stream_line(line)
+                                if content is None:
+                                    break
+                                if content:
+                                    started = True
+                                    call.first_byte()
+                                    route.first_byte()
+                                    yield content
+                        finally:
+                            # 提前结束时关闭响应，连接不再放回连接池
+                            response.close()
+                return
+            except Exception as e:
+                if started or not self._should_retry(e, attempt):
+                    raise
+            time.sleep(backoff_delay(attempt, self.client.backoff_base, self.client.backoff_max))
+            attempt += 1
+
+
+class AsyncChatCompletion(ChatCompletion):
+    """
+    ChatCompletion 的异步版本，等待模型响应时不占用工作线程。
+    """
+
+    def __init__(self, url=None, model=None):
+        super().__init__(url, model)
+        self.client = get_async_client()
+
+    async def complete(self, headers, payload):
+        attempt = 0
+        while True:
+            try:
+                # 每次尝试单独占用并发名额，退避等待期间归还
+                async with self.guard.call_async():
+                    with self.pool.route() as route:
+                        response = await self.client.post(route.url, max_retries=0, json=payload, headers=headers)
+                        return self.parse_response(response)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+            await asyncio.sleep(backoff_delay(attempt, self.client.backoff_base, self.client.backoff_max))
+            attempt += 1
+
+    async def get_response(self, user_message):
+        return await self.complete(*self.build_request(user_message))
+
+    async def get_batch_response(self, sentences, context=None):
+        content = await self.complete(*self.build_batch_request(sentences, context))
+        return parse_batch_content(content, len(sentences))
 
 
 
@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import unicodedata
+import weakref
+
+import diskcache
+from filelock import FileLock, Timeout
+
+from llm.config import get_setting
+
+logger = logging.getLogger(__name__)
+
+# 共享存储中没有结果的标记
+_MISSING = object()
+
+
+def flight_key(*parts):
+    """
+    由输入文本和选项生成请求键，文本做 Unicode 标准等价（NFC）规范化。
+    :param parts: 参与计算的文本和选项
+    :return: 请求键
+    """
+    normalized = [unicodedata.normalize('NFC', part) if isinstance(part, str) else part for part in parts]
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class SharedFlightStore:
+    """
+    跨进程合并：同一台机器上的进程按请求键争用文件锁，持锁的进程计算并把结果短暂写入共享存储，
+    等锁的进程拿到锁后直接读取结果。
+    """
+
+    def __init__(self, directory, result_ttl=10, lock_timeout=120):
+        """
+        :param directory: 锁文件和结果存储目录
+        :param result_ttl: 结果在共享存储中的保留时间（秒），只需覆盖等锁进程读取的时间
+        :param lock_timeout: 等锁超时（秒），超时后自行计算
+        """
+        self.directory = directory
+        self.result_ttl = result_ttl
+        self.lock_timeout = lock_timeout
+        os.makedirs(os.path.join(directory, 'locks'), exist_ok=True)
+        self._results = diskcache.Cache(os.path.join(directory, 'results'))
+
+    def lock(self, key):
+        # 加锁和解锁可能在不同线程中进行（异步模式下在线程池中加锁）
+        return FileLock(os.path.join(self.directory, 'locks', key + '.lock'), thread_local=False)
+
+    def get(self, key):
+        return self._results.get(key, _MISSING)
+
+    def set(self, key, value):
+        self._results.set(key, value, expire=self.result_ttl)
+
+    def run(self, key, func):
+        """
+        :return: (结果, 是否来自其他进程)
+        """
+        lock = self.lock(key)
+        try:
+            lock.acquire(timeout=self.lock_timeout)
+        except Timeout:
+            logger.warning('等待其他进程计算 %s 超时，自行计算', key)
+            return func(), False
+        try:
+            result = self.get(key)
+            if result is not _MISSING:
+                return result, True
+            result = func()
+            self.set(key, result)
+            return result, False
+        finally:
+            lock.release()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    合并同一进程内多个线程的相同请求：同一个键同时只有一个线程计算，其余线程等待并共享结果（或异常）。
+    """
+
+    def __init__(self, store=None):
+        """
+        :param store: SharedFlightStore 实例，提供时同时合并其他进程的相同请求
+        """
+        self.store = store
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.leaders = 0
+        self.shared = 0
+        self.shared_across_processes = 0
+
+    def do(self, key, func):
+        """
+        :param key: 请求键
+        :param func: 无参数的计算函数
+        :return: 计算结果
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.store is None:
+                call.result = func()
+            else:
+                call.result, shared = self.store.run(key, func)
+                if shared:
+                    self.shared_across_processes += 1
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'shared': self.shared,
+            'shared_across_processes': self.shared_across_processes,
+            'cross_process': self.store is not None,
+        }
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight 的异步版本：同一个事件循环中相同的请求共享一个计算任务。
+    计算任务独立于发起请求的协程运行，第一个请求被取消（如客户端断开）不影响其他等待者。
+    """
+
+    def __init__(self, store=None):
+        """
+        :param store: SharedFlightStore 实例，提供时同时合并其他进程的相同请求
+        """
+        self.store = store
+        self._calls = weakref.WeakKeyDictionary()
+
+        # 统计信息
+        self.leaders = 0
+        self.shared = 0
+        self.shared_across_processes = 0
+
+    async def _run_shared(self, key, func):
+        loop = asyncio.get_running_loop()
+        lock = self.store.lock(key)
+        try:
+            # 等锁会阻塞，放到线程池中
+            await loop.run_in_executor(None, lambda: lock.acquire(timeout=self.store.lock_timeout))
+        except Timeout:
+            logger.warning('等待其他进程计算 %s 超时，自行计算', key)
+            return await func()
+        try:
+            result = self.store.get(key)
+            if result is not _MISSING:
+                self.shared_across_processes += 1
+                return result
+            result = await func()
+            self.store.set(key, result)
+            return result
+        finally:
+            lock.release()
+
+    async def do(self, key, func):
+        """
+        :param key: 请求键
+        :param func: 无参数、返回协程的函数
+        :return: 计算结果
+        """
+        calls = self._calls.setdefault(asyncio.get_running_loop(), {})
+        task = calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(func() if self.store is None else self._run_shared(key, func))
+            calls[key] = task
+
+            def done(finished):
+                calls.pop(key, None)
+                # 所有等待者都已取消时，避免 “异常未被获取” 的警告
+                if not finished.cancelled():
+                    finished.exception()
+
+            task.add_done_callback(done)
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            'in_flight': sum(len(calls) for calls in list(self._calls.values())),
+            'leaders': self.leaders,
+            'shared': self.shared,
+            'shared_across_processes': self.shared_across_processes,
+            'cross_process': self.store is not None,
+        }
+
+
+_store = None
+_singleflight = None
+_async_singleflight = None
+_singleflight_lock = threading.Lock()
+
+
+def _get_store():
+    global _store
+    if _store is None and get_setting('LLM_SINGLEFLIGHT_SHARED', False):
+        _store = SharedFlightStore(
+            get_setting('LLM_SINGLEFLIGHT_DIR', None),
+            result_ttl=get_setting('LLM_SINGLEFLIGHT_RESULT_TTL', 10),
+            lock_timeout=get_setting('LLM_SINGLEFLIGHT_LOCK_TIMEOUT', 120),
+        )
+    return _store
+
+
+def get_singleflight():
+    """
+    获取当前进程共享的 SingleFlight，LLM_SINGLEFLIGHT_SHARED 为 True 时同时合并其他进程的请求。
+    """
+    global _singleflight
+    if _singleflight is None:
+        with _singleflight_lock:
+            if _singleflight is None:
+                _singleflight = SingleFlight(_get_store())
+    return _singleflight
+
+
+def get_async_singleflight():
+    """
+    获取当前进程共享的 AsyncSingleFlight，LLM_SINGLEFLIGHT_SHARED 为 True 时同时合并其他进程的请求。
+    """
+    global _async_singleflight
+    if _async_singleflight is None:
+        with _singleflight_lock:
+            if _async_singleflight is None:
+                _async_singleflight = AsyncSingleFlight(_get_store())
+    return _async_singleflight
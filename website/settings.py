@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the website like this: BASE_DIR / 'subdir'.
@@ -84,6 +85,10 @@ DATABASES = {
     }
 }
 
+# 迁移文件没有维护，表结构以 database/text_error.sql 为准；运行测试（python manage.py test）时按模型直接建表
+if len(sys.argv) > 1 and sys.argv[1] == 'test':
+    MIGRATION_MODULES = {'index': None, 'user': None}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = [
@@ -222,3 +227,114 @@ STATICFILES_DIRS = [
 MEDIA_ROOT = os.path.join(BASE_DIR)
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# RAG 增强配置
+# 用于增强的文本，可以是单个 PDF，也可以是包含 PDF/DOCX 文件的目录
+RAG_PDF_PATH = os.path.join(BASE_DIR, 'llm', 'RAG', 'RAGResources', 'RAG.pdf')
+# 分词模型
+RAG_MODEL_PATH = os.path.join(BASE_DIR, 'llm', 'RAG', 'EmbeddingModels', 'm3e-base')
+# 向量库持久化目录，按源文档、分割参数和嵌入模型的哈希分目录保存
+RAG_INDEX_DIR = os.path.join(BASE_DIR, 'llm', 'RAG', 'IndexCache')
+# 检查源文件是否变化的间隔（秒），变化后重建向量库
+RAG_RELOAD_CHECK_INTERVAL = 5.0
+# 并发查询合并为一次批量嵌入的时间窗口（毫秒），0 表示逐个嵌入
+RAG_EMBED_BATCH_WINDOW_MS = 10
+# 单次批量嵌入的最大查询数量
+RAG_EMBED_MAX_BATCH_SIZE = 32
+# 检索结果缓存和查询向量缓存的条数（LRU），0 表示不缓存
+RAG_CACHE_SIZE = 1024
+# 检索结果缓存和查询向量缓存的有效期（秒）
+RAG_CACHE_TTL = 600
+# 已加载的用户知识库分区的内存预算（MB），超出后淘汰最久未使用的分区
+RAG_KNOWLEDGE_MEMORY_BUDGET_MB = 256
+# 向量索引类型：flat（精确）/ ivf_flat / ivf_pq / sq8（int8 标量量化），语料较大时使用压缩索引
+RAG_INDEX_TYPE = 'flat'
+# 倒排索引的聚类中心数量（样本不足时自动减少）
+RAG_INDEX_NLIST = 100
+# 乘积量化的子空间数量，需要整除向量维度（m3e-base 为 768）
+RAG_INDEX_PQ_M = 16
+# 倒排索引检索时访问的聚类数量，越大召回越高、速度越慢
+RAG_INDEX_NPROBE = 8
+# 检索方式：dense（向量）/ hybrid（jieba 分词的 BM25 预筛候选块，再做向量检索并融合排序）/ lexical（仅 BM25，不嵌入查询）
+# lexical 和 hybrid 模式同时在该用户的知识库中按 BM25 检索（倒排索引只在内存中，知识库变化后首次检索时重建）
+RAG_RETRIEVAL_MODE = 'dense'
+# hybrid 模式下 BM25 预筛的候选块数量
+RAG_LEXICAL_CANDIDATES = 50
+# 拼入 prompt 的上下文块数量
+RAG_TOP_K = 1
+# 构建向量库时解析文档的进程数，None 表示 CPU 核数
+RAG_INGEST_WORKERS = None
+# 构建向量库时每个嵌入批次的块数量
+RAG_INGEST_BATCH_SIZE = 64
+# 是否在进程启动时后台预热向量库
+RAG_WARM_ON_STARTUP = False
+
+# 大模型服务配置（OpenAI 兼容接口）
+LLM_URL = 'http://10.129.2.71:8000/v1/chat/completions'
+LLM_MODEL = 'gpt-3.5-turbo'
+# 每个模型服务的最大 keep-alive 连接数
+LLM_POOL_SIZE = 20
+# 异步客户端（ASGI 部署）的最大连接数
+LLM_ASYNC_POOL_SIZE = 100
+# 长文档纠错：每块的最大 token 数、同时纠错的最大块数、单个块的最大重试次数
+# （块级重试只针对读取超时、响应解析失败等错误，5xx 和连接错误由 LLM_MAX_RETRIES 控制）
+LLM_CHUNK_MAX_TOKENS = 512
+LLM_CHUNK_CONCURRENCY = 8
+LLM_CHUNK_MAX_RETRIES = 2
+# 句子级纠错缓存：是否启用、缓存目录（同一台机器上的多个进程共享）、容量上限（MB）
+LLM_CACHE_ENABLED = True
+LLM_CACHE_DIR = os.path.join(BASE_DIR, 'llm', 'CorrectionCache')
+LLM_CACHE_SIZE_LIMIT_MB = 512
+# 本地错误检测：字符 n-gram 语言模型（python manage.py build_detector_lm 生成）判定无错误的句子不再请求大模型
+LLM_DETECTOR_ENABLED = True
+LLM_DETECTOR_LM_PATH = os.path.join(BASE_DIR, 'llm', 'Detector', 'char_lm.pkl')
+# 自定义混淆集文件（每行 “错误写法 正确写法”），None 表示只使用 pycorrector 自带的同音字、形近字表
+LLM_DETECTOR_CONFUSION_PATH = None
+# 判定无错误的置信度阈值，越高越保守（python manage.py evaluate_detector 在标注样本上评估）
+LLM_DETECTOR_THRESHOLD = 0.95
+# 合并同时到达的相同纠错请求：是否同时合并同一台机器上其他进程的请求（文件锁 + 共享存储）、共享目录、
+# 结果在共享存储中的保留时间（秒）、等待其他进程计算的超时时间（秒）
+LLM_SINGLEFLIGHT_SHARED = False
+LLM_SINGLEFLIGHT_DIR = os.path.join(BASE_DIR, 'llm', 'SingleFlight')
+LLM_SINGLEFLIGHT_RESULT_TTL = 10
+LLM_SINGLEFLIGHT_LOCK_TIMEOUT = 120
+# 自适应并发限制（AIMD）：初始、最小、最大并发数，视为拥塞的耗时阈值（秒），排队等待超时（秒）
+LLM_LIMIT_INITIAL = 8
+LLM_LIMIT_MIN = 1
+LLM_LIMIT_MAX = 64
+LLM_LIMIT_LATENCY_THRESHOLD = 30.0
+LLM_LIMIT_QUEUE_TIMEOUT = 30.0
+# 熔断器：连续失败多少次后打开，打开后多久（秒）放行探测请求
+LLM_BREAKER_FAILURE_THRESHOLD = 5
+LLM_BREAKER_RESET_TIMEOUT = 30.0
+# 熔断或排队超时时，True 降级为返回原文（状态为未检测），False 直接返回 503
+LLM_FALLBACK_ON_UNAVAILABLE = True
+# 多句合并请求：把多个句子（包括同时到达的不同请求中的句子）合并为一次模型调用，共用纠错 prompt
+LLM_BATCH_ENABLED = False
+# 每批句子的最大 token 数、最大句子数，第一个句子到达后最多等待多久（秒）再发送
+LLM_BATCH_MAX_TOKENS = 1024
+LLM_BATCH_MAX_SENTENCES = 20
+LLM_BATCH_WINDOW = 0.02
+# 文档纠错任务队列（python manage.py correction_worker 启动工作进程）：工作线程数、每个用户同时处理的最大任务数、
+# 每段纠错的字数（每段完成后保存进度）、租约时长（秒，超时未续约的任务由其他工作进程接手）、
+# 最大尝试次数、失败重试的基础间隔（秒）、空闲时的轮询间隔（秒）
+LLM_JOB_WORKERS = 2
+LLM_JOB_USER_CONCURRENCY = 1
+LLM_JOB_SEGMENT_CHARS = 4000
+LLM_JOB_LEASE = 300
+LLM_JOB_MAX_ATTEMPTS = 3
+LLM_JOB_RETRY_DELAY = 30.0
+LLM_JOB_POLL_INTERVAL = 1.0
+# 多个模型服务副本的对话接口地址，按延迟和在途请求数负载均衡；为空时只使用 LLM_URL
+LLM_ENDPOINTS = []
+# 副本连续失败多少次后摘除，摘除后至少多久（秒）才尝试恢复，健康检查间隔（秒，0 表示不做主动检查）
+LLM_ENDPOINT_FAILURE_THRESHOLD = 3
+LLM_ENDPOINT_EJECTION_TIME = 30.0
+LLM_HEALTH_CHECK_INTERVAL = 10.0
+# 连接超时、读取超时（秒）
+LLM_CONNECT_TIMEOUT = 3.05
+LLM_READ_TIMEOUT = 120
+# 5xx 和连接错误的最大重试次数，重试间隔为带抖动的指数退避；配置了多个副本时每次重试重新选择副本
+LLM_MAX_RETRIES = 3
+LLM_BACKOFF_BASE = 0.5
+LLM_BACKOFF_MAX = 8.0